@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+'''
+Reserved addressing.
+The IPs of the VMs are picked before they are started, from the subnet of the
+bridge and the last octet of the mac address. A DHCP host reservation is added
+to the libvirt network of the bridge for each of them, so the VM gets exactly
+that IP and nothing has to be looked up after the boot.
+'''
+
+import shlex
+import ipaddress
+
+from do_automate.globals import *
+from do_automate.do_ip_discovery import read_dnsmasq_leases
+
+# The networks of the bridges are system networks, even when virsh runs for a user
+VIRSH = "virsh -c qemu:///system"
+
+# Addressing modes of the "addressing" config key
+ADDRESSING_MODES = ["dhcp", "reserved"]
+
+class da_addressing:
+	def __init__(self, log_obj, dac_object):
+		self.log_obj = log_obj
+		self.dac_obj = dac_object
+
+		# bridge -> libvirt network name
+		self.networks = None
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def __network_of_bridge(self, bridge):
+		if self.networks is None:
+			self.networks = {}
+			status, status_string = self.dac_obj.run_sudo_command_local_status(VIRSH + " net-list --name")
+			if status:
+				self.__log(ERROR, "Listing libvirt networks failed: ", status_string)
+				return None
+
+			for network in status_string.split():
+				status, info = self.dac_obj.run_sudo_command_local_status(VIRSH + " net-info " + shlex.quote(network))
+				if status:
+					continue
+				for line in info.splitlines():
+					if line.startswith("Bridge:"):
+						self.networks[line.split()[1]] = network
+
+		if bridge not in self.networks:
+			self.__log(ERROR, "No active libvirt network found for bridge {bridge}".format(bridge = bridge))
+			return None
+
+		return self.networks[bridge]
+
+	def __subnet_of_bridge(self, bridge):
+		command = ["ip", "-o", "-4", "addr", "show", "dev", bridge]
+		status, status_string = self.dac_obj.run_command_local(command)
+		if status or not status_string.split():
+			self.__log(ERROR, "Getting the IP of bridge {bridge} failed".format(bridge = bridge))
+			return None
+
+		# 6: virbr0    inet 192.168.122.1/24 brd 192.168.122.255 scope global virbr0
+		fields = status_string.split()
+		return ipaddress.ip_interface(fields[fields.index("inet") + 1])
+
+	def plan_ips(self, all_macs, bridges):
+		'''
+		all_macs holds NUM_OF_ETH_INT macs per VM, the n-th mac of a VM goes to the n-th bridge.
+		returns dict of mac -> ip, None if no valid plan could be made
+		'''
+		leases = read_dnsmasq_leases()
+		subnets = {}
+		all_ips = {}
+
+		for i, mac in enumerate(all_macs):
+			bridge = bridges[i % NUM_OF_ETH_INT]
+			if bridge not in subnets:
+				subnets[bridge] = self.__subnet_of_bridge(bridge)
+				if subnets[bridge] is None:
+					return None
+			bridge_if = subnets[bridge]
+
+			# The last octet of the mac picks the host, clear of the bridge and the network address
+			host = RESERVED_IP_OFFSET + int(mac.split(":")[-1], 16)
+			if host >= bridge_if.network.num_addresses - 1:
+				self.__log(ERROR, "Subnet {net} of {bridge} too small for mac {mac}".format(net = bridge_if.network,
+						bridge = bridge, mac = mac))
+				return None
+
+			ip = str(bridge_if.network.network_address + host)
+			if ip == str(bridge_if.ip):
+				self.__log(ERROR, "IP {ip} planned for mac {mac} belongs to bridge {bridge}".format(ip = ip, mac = mac, bridge = bridge))
+				return None
+
+			# Another machine already holding the IP would lose it, or keep it
+			for lease_mac, lease_ip in leases.items():
+				if lease_ip == ip and lease_mac != mac.lower():
+					self.__log(ERROR, "IP {ip} planned for mac {mac} is leased to {other}".format(ip = ip, mac = mac, other = lease_mac))
+					return None
+
+			all_ips[mac] = ip
+
+		return all_ips
+
+	def __update_host(self, action, bridge, host_xml):
+		network = self.__network_of_bridge(bridge)
+		if network is None:
+			return False
+
+		command = "{virsh} net-update {network} {action} ip-dhcp-host {xml} --live".format(virsh = VIRSH,
+				network = shlex.quote(network), action = action, xml = shlex.quote(host_xml))
+		status, status_string = self.dac_obj.run_sudo_command_local_status(command)
+		if status:
+			self.__log(DEBUG, command, status_string)
+			return False
+
+		return True
+
+	def reserve(self, all_ips, bridges, all_macs):
+		'''
+		Adds a DHCP host reservation for every mac -> ip of all_ips.
+		returns True on success
+		'''
+		for i, mac in enumerate(all_macs):
+			bridge = bridges[i % NUM_OF_ETH_INT]
+
+			# A reservation left behind by a VM which was not shut down through us
+			self.__update_host("delete", bridge, "<host mac='{mac}'/>".format(mac = mac))
+
+			if not self.__update_host("add", bridge, "<host mac='{mac}' ip='{ip}'/>".format(mac = mac, ip = all_ips[mac])):
+				self.__log(ERROR, "Reserving IP {ip} for mac {mac} on {bridge} failed".format(ip = all_ips[mac], mac = mac, bridge = bridge))
+				return False
+
+			self.__log(DEBUG, "Reserved IP {ip} for mac {mac} on {bridge}".format(ip = all_ips[mac], mac = mac, bridge = bridge))
+
+		return True
+
+	def release(self, all_macs, bridges):
+		'''
+		Removes the DHCP host reservations of the macs.
+		returns True if all of them were removed
+		'''
+		released = True
+		for i, mac in enumerate(all_macs):
+			if not self.__update_host("delete", bridges[i % NUM_OF_ETH_INT], "<host mac='{mac}'/>".format(mac = mac)):
+				self.__log(ERROR, "Removing the reservation of mac {mac} failed".format(mac = mac))
+				released = False
+
+		return released
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+'''
+Cache of built kernels.
+An entry holds the bzImage and the installed modules of one build. It is
+keyed by what goes into the build: the git HEAD of the kernel tree, a hash
+of its uncommitted changes, the .config (comments and order dropped) and
+the compiler and linker versions. When a build with the same key was done
+before, its result is copied out instead of building again.
+Entries not used for the longest time are removed once the cache grows
+beyond its size limit.
+The builds of out of tree modules are cached the same way, in a cache of
+their own, without a bzImage.
+'''
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+from do_automate.globals import *
+
+BUILD_CACHE_INFO_FILE = "info.json"
+BUILD_CACHE_BZIMAGE = "bzImage"
+BUILD_CACHE_MODULES = "modules"
+
+HASH_READ_SIZE = 1024 * 1024
+
+# Files kbuild leaves in the folder of an out of tree module, they are not part of its source
+BUILD_OUTPUT_SUFFIXES = (".o", ".ko", ".mod", ".mod.c", ".symvers", ".order", ".a")
+
+def tree_size(path):
+	size = 0
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			try:
+				size += os.lstat(os.path.join(root, name)).st_size
+			except OSError:
+				pass
+	return size
+
+def source_tree_hash(folder):
+	'''
+	returns a hash of the names and contents of the source files below folder.
+	Build output and hidden files (.git, .*.cmd, ...) are left out.
+	'''
+	hasher = hashlib.sha256()
+	for root, dirs, files in os.walk(folder):
+		dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+		for name in sorted(files):
+			if name.startswith(".") or name.endswith(BUILD_OUTPUT_SUFFIXES):
+				continue
+			path = os.path.join(root, name)
+			hasher.update(os.path.relpath(path, folder).encode() + b"\0")
+			try:
+				with open(path, 'rb') as f:
+					for data in iter(lambda: f.read(HASH_READ_SIZE), b""):
+						hasher.update(data)
+			except OSError:
+				pass
+	return hasher.hexdigest()
+
+def format_size(size):
+	for unit in ["B", "K", "M", "G"]:
+		if size < 1024:
+			return "{size:.0f}{unit}".format(size = size, unit = unit)
+		size /= 1024
+	return "{size:.1f}T".format(size = size)
+
+class da_build_cache:
+	def __init__(self, log_obj, cache_folder = BUILD_CACHE_FOLDER, max_bytes = BUILD_CACHE_MAX_BYTES):
+		self.log_obj = log_obj
+		self.cache_folder = cache_folder
+		self.max_bytes = max_bytes
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	@contextmanager
+	def __locked(self):
+		# Several do_qemu runs may share the cache
+		os.makedirs(self.cache_folder, exist_ok=True)
+		with open(os.path.join(self.cache_folder, ".lock"), 'w') as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+	def __entry(self, key):
+		return os.path.join(self.cache_folder, key)
+
+	def __hash_output(self, argv, cwd, hasher):
+		# The output (a diff of the tree) can be big, hash it as it comes
+		try:
+			proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=cwd)
+		except OSError as e:
+			self.__log(DEBUG, argv, e)
+			return False
+
+		for data in iter(lambda: proc.stdout.read(HASH_READ_SIZE), b""):
+			hasher.update(data)
+		return proc.wait() == 0
+
+	def __first_line(self, argv, cwd = None):
+		try:
+			output = subprocess.check_output(argv, stderr=subprocess.DEVNULL, cwd=cwd)
+		except (OSError, subprocess.CalledProcessError):
+			return None
+		lines = output.decode(errors="replace").splitlines()
+		return lines[0].strip() if lines else ""
+
+	def __dirty_hash(self, kernel_source_folder):
+		hasher = hashlib.sha256()
+		if not self.__hash_output(["git", "diff", "HEAD", "--binary"], kernel_source_folder, hasher):
+			return None
+
+		# New files are not in the diff
+		try:
+			output = subprocess.check_output(["git", "ls-files", "-z", "--others", "--exclude-standard"],
+					stderr=subprocess.DEVNULL, cwd=kernel_source_folder)
+		except (OSError, subprocess.CalledProcessError):
+			return None
+
+		for name in sorted(output.split(b"\0")):
+			if not name:
+				continue
+			hasher.update(name + b"\0")
+			try:
+				with open(os.path.join(os.fsencode(kernel_source_folder), name), 'rb') as f:
+					for data in iter(lambda: f.read(HASH_READ_SIZE), b""):
+						hasher.update(data)
+			except OSError:
+				pass
+
+		return hasher.hexdigest()
+
+	def __config_hash(self, kernel_build_folder):
+		# The header comments hold the date and version, the rest is order independent
+		try:
+			with open(os.path.join(kernel_build_folder, ".config")) as f:
+				options = [line.strip() for line in f
+						if line.startswith("CONFIG_") or (line.startswith("# CONFIG_") and line.rstrip().endswith(" is not set"))]
+		except OSError:
+			return None
+
+		return hashlib.sha256("\n".join(sorted(options)).encode()).hexdigest()
+
+	def build_key(self, kernel_source_folder, kernel_build_folder):
+		'''
+		returns (key, info) for the kernel tree and the .config in the build folder as they are now,
+		(None, None) if the build cannot be identified
+		'''
+		head = self.__first_line(["git", "rev-parse", "HEAD"], kernel_source_folder)
+		if not head:
+			self.__log(INFO, "{folder} is not a git tree, not using the build cache".format(folder = kernel_source_folder))
+			return None, None
+
+		dirty = self.__dirty_hash(kernel_source_folder)
+		config = self.__config_hash(kernel_build_folder)
+		if dirty is None or config is None:
+			self.__log(INFO, "Hashing {folder} failed, not using the build cache".format(folder = kernel_source_folder))
+			return None, None
+
+		toolchain = [self.__first_line(["gcc", "--version"]), self.__first_line(["ld", "--version"])]
+
+		info = {"source": os.path.realpath(kernel_source_folder), "head": head, "dirty": dirty,
+				"config": config, "toolchain": toolchain}
+		key = hashlib.sha256(json.dumps([head, dirty, config, toolchain]).encode()).hexdigest()[:32]
+
+		self.__log(DEBUG, "Build key {key}: ".format(key = key), info)
+		return key, info
+
+	def __read_info(self, key):
+		try:
+			with open(os.path.join(self.__entry(key), BUILD_CACHE_INFO_FILE)) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def __write_info(self, key, info):
+		info_file = os.path.join(self.__entry(key), BUILD_CACHE_INFO_FILE)
+		with open(info_file + ".tmp", 'w') as f:
+			json.dump(info, f, indent=8)
+		os.replace(info_file + ".tmp", info_file)
+
+	def restore(self, key, bzImage, modules_folder):
+		'''
+		Copies the bzImage and the modules of a cached build to bzImage and modules_folder.
+		bzImage is None for module builds.
+		returns True on a hit, False if there is no such build
+		'''
+		with self.__locked():
+			info = self.__read_info(key)
+			if info is None:
+				return False
+
+			entry = self.__entry(key)
+			try:
+				if bzImage:
+					shutil.copyfile(os.path.join(entry, BUILD_CACHE_BZIMAGE), bzImage)
+				shutil.rmtree(modules_folder, ignore_errors=True)
+				# modules_install leaves "build" and "source" links to the tree, keep them links
+				shutil.copytree(os.path.join(entry, BUILD_CACHE_MODULES), modules_folder, symlinks=True)
+			except OSError as e:
+				self.__log(ERROR, "Restoring build {key} failed: ".format(key = key), e)
+				return False
+
+			info["last_used"] = time.time()
+			info["hits"] = info.get("hits", 0) + 1
+			try:
+				self.__write_info(key, info)
+			except OSError:
+				pass
+
+		return True
+
+	def store(self, key, info, bzImage, modules_folder):
+		'''
+		Adds the bzImage and the modules in modules_folder to the cache, under key.
+		bzImage is None for module builds.
+		returns True on success
+		'''
+		with self.__locked():
+			entry = self.__entry(key)
+			# Filled next to the entry and renamed, so a half written entry is never used
+			tmp_entry = entry + ".tmp"
+			try:
+				shutil.rmtree(tmp_entry, ignore_errors=True)
+				os.makedirs(tmp_entry)
+				if bzImage:
+					shutil.copyfile(bzImage, os.path.join(tmp_entry, BUILD_CACHE_BZIMAGE))
+				shutil.copytree(modules_folder, os.path.join(tmp_entry, BUILD_CACHE_MODULES), symlinks=True)
+
+				info = dict(info, created = time.time(), last_used = time.time(), hits = 0, size = tree_size(tmp_entry))
+				with open(os.path.join(tmp_entry, BUILD_CACHE_INFO_FILE), 'w') as f:
+					json.dump(info, f, indent=8)
+
+				shutil.rmtree(entry, ignore_errors=True)
+				os.rename(tmp_entry, entry)
+			except OSError as e:
+				self.__log(ERROR, "Adding build {key} to the cache failed: ".format(key = key), e)
+				shutil.rmtree(tmp_entry, ignore_errors=True)
+				return False
+
+			self.__log(INFO, "Added build {key} to the cache ({size})".format(key = key, size = format_size(info["size"])))
+			self.__evict(keep = key)
+
+		return True
+
+	def __entries(self):
+		entries = []
+		try:
+			names = os.listdir(self.cache_folder)
+		except FileNotFoundError:
+			return entries
+
+		for key in names:
+			if key.startswith(".") or key.endswith(".tmp"):
+				continue
+			info = self.__read_info(key)
+			if info is not None:
+				entries.append(dict(info, key = key))
+
+		# Most recently used first
+		entries.sort(key = lambda info: info.get("last_used", 0), reverse = True)
+		return entries
+
+	def __evict(self, keep = None):
+		# Least recently used go first, till the rest fits
+		total = 0
+		for info in self.__entries():
+			total += info.get("size", 0)
+			if total > self.max_bytes and info["key"] != keep:
+				self.__log(INFO, "Removing build {key} from the cache ({size})".format(key = info["key"],
+						size = format_size(info.get("size", 0))))
+				shutil.rmtree(self.__entry(info["key"]), ignore_errors=True)
+				total -= info.get("size", 0)
+
+	def entries(self):
+		'''
+		returns the info of all cached builds, most recently used first
+		'''
+		with self.__locked():
+			return self.__entries()
+
+	def remove(self, key_prefix):
+		'''
+		Removes the builds whose key starts with key_prefix, all of them for "all".
+		returns the number of builds removed
+		'''
+		removed = 0
+		with self.__locked():
+			for info in self.__entries():
+				if key_prefix == "all" or info["key"].startswith(key_prefix):
+					shutil.rmtree(self.__entry(info["key"]), ignore_errors=True)
+					removed += 1
+		return removed
+
+	def print_entries(self):
+		entries = self.entries()
+		total = sum(info.get("size", 0) for info in entries)
+		print("{count} builds, {size} of {max_size}, in {folder}".format(count = len(entries), size = format_size(total),
+				max_size = format_size(self.max_bytes), folder = self.cache_folder))
+
+		for info in entries:
+			if "head" in info:
+				version = info["head"][:12] + ("" if info.get("dirty") == hashlib.sha256().hexdigest() else "+dirty")
+			else:
+				version = info.get("kernel_key", "")[:12]
+			print("{key}\t{size}\t{used}\t{hits} hits\t{version}\t{source}".format(key = info["key"][:12],
+					size = format_size(info.get("size", 0)),
+					used = time.strftime('%Y-%m-%d %H:%M', time.localtime(info.get("last_used", 0))),
+					hits = info.get("hits", 0), version = version, source = info.get("source", "")))
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+'''
+ccache for the kernel and module builds.
+When ccache is installed, the builds run with CC="ccache gcc" and one cache
+in the data folder, shared by all kernel trees. Paths below the tree are
+hashed relative to it (CCACHE_BASEDIR), so the server and storage trees,
+and a tree checked out again, hit the same objects.
+'''
+
+import os
+import shutil
+import subprocess
+
+from do_automate.globals import *
+
+class da_ccache:
+	def __init__(self, log_obj, cache_folder = CCACHE_FOLDER, max_size = CCACHE_MAX_SIZE):
+		self.log_obj = log_obj
+		self.cache_folder = cache_folder
+		self.max_size = max_size
+
+		self.ccache = shutil.which("ccache")
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def available(self):
+		return self.ccache is not None
+
+	def make_args(self):
+		'''
+		returns the variables to add to the make command line
+		'''
+		if not self.available():
+			return []
+		# Goes to the sub makes of the module Makefiles too
+		return ["CC=ccache gcc"]
+
+	def env(self, base_dir):
+		'''
+		returns the environment for a build below base_dir, None for the environment of this process
+		'''
+		if not self.available():
+			return None
+
+		env = os.environ.copy()
+		env["CCACHE_DIR"] = self.cache_folder
+		env["CCACHE_MAXSIZE"] = self.max_size
+		env["CCACHE_BASEDIR"] = os.path.realpath(base_dir)
+		return env
+
+	def stats(self):
+		'''
+		returns dict of the ccache counters, None if ccache cannot tell
+		'''
+		if not self.available():
+			return None
+
+		env = os.environ.copy()
+		env["CCACHE_DIR"] = self.cache_folder
+		try:
+			output = subprocess.check_output([self.ccache, "--print-stats"], stderr=subprocess.DEVNULL, env=env)
+		except (OSError, subprocess.CalledProcessError):
+			# ccache older than 3.7
+			return None
+
+		stats = {}
+		for line in output.decode(errors="replace").splitlines():
+			fields = line.split("\t")
+			if len(fields) == 2 and fields[1].isdigit():
+				stats[fields[0]] = int(fields[1])
+		return stats
+
+	def log_stats(self, what, before, after):
+		# Other runs may use the cache at the same time, so the counters are only close
+		if before is None or after is None:
+			return
+
+		def delta(name):
+			return after.get(name, 0) - before.get(name, 0)
+
+		hits = delta("direct_cache_hit") + delta("preprocessed_cache_hit")
+		misses = delta("cache_miss")
+		if not hits + misses:
+			self.__log(INFO, "{what}: nothing compiled through ccache".format(what = what))
+			return
+
+		self.__log(INFO, "{what}: ccache {hits} hits, {misses} misses, {rate:.0f}% hit rate".format(what = what,
+				hits = hits, misses = misses, rate = 100 * hits / (hits + misses)))
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
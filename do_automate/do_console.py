@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+'''
+Serial consoles of the VMs started with the "pipe" option.
+qemu talks to the console through the fifos <uuid>.in and <uuid>.out in the
+pipes folder. One thread reads all the .out fifos of this process (epoll
+through selectors) into a rolling buffer per VM, so nothing the guest prints
+is lost between commands, and expect() returns as soon as the text waited
+for shows up.
+'''
+
+import os
+import re
+import time
+import shlex
+import codecs
+import select
+import selectors
+import threading
+import uuid as uuid_lib
+
+from do_automate.globals import *
+
+# Bytes of console output kept per VM, older output is dropped once it was consumed
+CONSOLE_BUFFER_SIZE = 1024 * 1024
+
+# Output nobody consumed is dropped too beyond this, for consoles nobody reads
+CONSOLE_UNCONSUMED_MAX = 16 * 1024 * 1024
+
+CONSOLE_READ_SIZE = 65536
+
+# Prompts of a shell, at the end of the output
+SHELL_PROMPT_RE = r"[#$>] ?$"
+
+def console_fifos(vm_uuid):
+	return PIPES_FOLDER + "/" + str(vm_uuid) + ".in", PIPES_FOLDER + "/" + str(vm_uuid) + ".out"
+
+class vm_console:
+	def __init__(self, vm_uuid):
+		self.vm_uuid = vm_uuid
+		self.fifo_in, self.fifo_out = console_fifos(vm_uuid)
+
+		# Opened read-write, so that opening never blocks and the fifos never
+		# hit EOF while qemu restarts. We never read from fd_in, qemu does.
+		self.fd_out = os.open(self.fifo_out, os.O_RDWR | os.O_NONBLOCK)
+		try:
+			self.fd_in = os.open(self.fifo_in, os.O_RDWR | os.O_NONBLOCK)
+		except OSError:
+			os.close(self.fd_out)
+			raise
+
+		self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+		# Reentrant, run() holds it across expect()
+		self.cond = threading.Condition(threading.RLock())
+		self.buf = ""
+		# expect() searches from here on, everything before was consumed
+		self.pos = 0
+		# Offset of buf[0] in all the output of the console
+		self.base = 0
+
+	def feed(self):
+		# Called by the reader thread when fd_out is readable
+		try:
+			data = os.read(self.fd_out, CONSOLE_READ_SIZE)
+		except OSError:
+			# Nothing to read after all, or the console was closed meanwhile
+			return
+
+		with self.cond:
+			self.buf += self.decoder.decode(data)
+			if len(self.buf) > CONSOLE_BUFFER_SIZE:
+				# Only consumed output goes, expect() and run() still need the rest
+				self.__drop(min(len(self.buf) - CONSOLE_BUFFER_SIZE, self.pos))
+			if len(self.buf) > CONSOLE_UNCONSUMED_MAX:
+				self.__drop(len(self.buf) - CONSOLE_BUFFER_SIZE)
+			self.cond.notify_all()
+
+	def __drop(self, drop):
+		# Called with cond held
+		self.buf = self.buf[drop:]
+		self.pos = max(0, self.pos - drop)
+		self.base += drop
+
+	def close(self):
+		os.close(self.fd_in)
+		os.close(self.fd_out)
+
+	def expect(self, pattern, timeout):
+		'''
+		Waits till pattern (a regex, multiline) matches the output not consumed yet.
+		Consumes the output up to the end of the match.
+		returns the match object, None on timeout
+		'''
+		regex = re.compile(pattern, re.MULTILINE)
+		deadline = time.monotonic() + timeout
+
+		with self.cond:
+			while True:
+				match = regex.search(self.buf, self.pos)
+				if match:
+					self.pos = match.end()
+					return match
+
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return None
+				self.cond.wait(remaining)
+
+	def flush(self):
+		'''
+		Consumes everything printed till now.
+		returns the consumed text
+		'''
+		with self.cond:
+			text = self.buf[self.pos:]
+			self.pos = len(self.buf)
+			return text
+
+	def send(self, text, timeout = 5):
+		'''
+		Types text on the console.
+		returns True if all of it was written within timeout seconds
+		'''
+		data = text.encode()
+		deadline = time.monotonic() + timeout
+		while data:
+			try:
+				written = os.write(self.fd_in, data)
+				data = data[written:]
+			except BlockingIOError:
+				# qemu is not reading its input, wait for room in the fifo
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				select.select([], [self.fd_in], [], remaining)
+
+		return True
+
+	def __expect_from(self, pattern, start, timeout):
+		'''
+		expect(), also taking the output from the offset start (in all the output of the console) to the match.
+		Both under one lock, so the buffer is not trimmed in between.
+		returns (match, output, offset of the end of the match), match None on timeout
+		'''
+		with self.cond:
+			match = self.expect(pattern, timeout)
+			if not match:
+				return None, "", start
+			output = self.buf[max(start - self.base, 0):match.start()]
+			return match, output, self.base + match.end()
+
+	def run(self, command, timeout, sudo = False, password = ""):
+		'''
+		Runs the command in the shell logged in on the console.
+		The output is framed by sentinel lines, so it is taken the moment the command is done.
+		With sudo, the password is typed at the prompt of sudo, which does not echo it.
+		returns (exit code, output), exit code None on timeout
+		'''
+		token = uuid_lib.uuid4().hex[:12]
+		begin = "__DA_BEGIN_{t}__".format(t = token)
+		end = "__DA_END_{t}_".format(t = token)
+		prompt = "__DA_PASSWORD_{t}__".format(t = token)
+
+		# The terminal echoes the typed line too. The empty quotes keep the
+		# sentinels from showing up in one piece there, the shell joins them.
+		if sudo:
+			command = "sudo -S -p {prompt_1}\"\"{prompt_2} sh -c {cmd}".format(prompt_1 = prompt[:6], prompt_2 = prompt[6:],
+					cmd = shlex.quote(command))
+
+		line = "echo {begin_1}\"\"{begin_2}; {command}; echo {end_1}\"\"{end_2}$?__\n".format(
+				begin_1 = begin[:6], begin_2 = begin[6:], command = command, end_1 = end[:6], end_2 = end[6:])
+
+		self.flush()
+		if not self.send(line):
+			return None, ""
+
+		match, output, start = self.__expect_from(begin + r"\r?\n", 0, timeout)
+		if not match:
+			return None, ""
+
+		end_re = end + r"(\d+)__"
+		prompted = False
+		if sudo:
+			# No prompt when sudo still has the credentials, or needs no password
+			match, output, prompt_end = self.__expect_from(re.escape(prompt) + "|" + end_re, start, timeout)
+			if not match:
+				return None, ""
+			if match.group(0) == prompt:
+				prompted = True
+				start = prompt_end
+				if not self.send(password + "\n"):
+					return None, ""
+
+				match, output, prompt_end = self.__expect_from(re.escape(prompt) + "|" + end_re, start, timeout)
+				if not match:
+					return None, ""
+				if match.group(0) == prompt:
+					# Wrong password, stop sudo asking again
+					self.send("\x03")
+					return None, ""
+		else:
+			match, output, end_offset = self.__expect_from(end_re, start, timeout)
+			if not match:
+				return None, ""
+
+		output = output.replace("\r", "")
+		if prompted and output.startswith("\n"):
+			# sudo ends the line of its prompt once the password is in
+			output = output[1:]
+		return int(match.group(1)), output.rstrip("\n")
+
+	def login(self, username, password, login_timeout, prompt_timeout):
+		'''
+		Logs in on the console, unless a shell is there already.
+		returns True once the shell answers
+		'''
+		# Gets a fresh prompt, in case the console was quiet before we started reading
+		self.send("\n")
+		match = self.expect(r"login: ?$|" + SHELL_PROMPT_RE, login_timeout)
+		if not match:
+			return False
+
+		if "login" not in match.group(0):
+			# Somebody (maybe an earlier run) is logged in already
+			returncode, output = self.run("true", prompt_timeout)
+			return returncode == 0
+
+		self.send(username + "\n")
+		if not self.expect(r"[Pp]assword: ?$", prompt_timeout):
+			return False
+
+		self.send(password + "\n")
+		returncode, output = self.run("true", prompt_timeout)
+		return returncode == 0
+
+class console_mux:
+	'''
+	The consoles of all the VMs of this process, served by one reader thread.
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.consoles = {}
+		self.selector = None
+		self.thread = None
+		self.wake_r, self.wake_w = None, None
+
+	def __start(self):
+		self.selector = selectors.DefaultSelector()
+		self.wake_r, self.wake_w = os.pipe()
+		self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+		self.thread = threading.Thread(target=self.__read_loop, daemon=True)
+		self.thread.start()
+
+	def __wake(self):
+		os.write(self.wake_w, b"x")
+
+	def __read_loop(self):
+		while True:
+			for key, events in self.selector.select():
+				if key.data is None:
+					# Consoles were added or removed, the selector has them already
+					os.read(self.wake_r, CONSOLE_READ_SIZE)
+					continue
+				key.data.feed()
+
+	def open(self, vm_uuid):
+		'''
+		returns the console of the VM, starting to read it if needed. None if the fifos cannot be opened
+		'''
+		with self.lock:
+			if vm_uuid in self.consoles:
+				return self.consoles[vm_uuid]
+
+			try:
+				console = vm_console(vm_uuid)
+			except OSError:
+				return None
+
+			if self.thread is None:
+				self.__start()
+
+			self.consoles[vm_uuid] = console
+			self.selector.register(console.fd_out, selectors.EVENT_READ, console)
+			self.__wake()
+
+			return console
+
+	def close(self, vm_uuid):
+		with self.lock:
+			console = self.consoles.pop(vm_uuid, None)
+			if console is None:
+				return
+
+			self.selector.unregister(console.fd_out)
+			self.__wake()
+			console.close()
+
+# One reader for all the consoles of this process
+shared_console_mux = console_mux()
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
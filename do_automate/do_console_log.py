@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+'''
+Console logs of the VMs.
+qemu writes the console of a VM to its stdout. The privileged helper hands
+that to this file, run as a script under the invoking user, which appends
+it to vm_consoles/<uuid>.log and rotates the log by size. Nobody has to read
+the console for the VM to keep going, and the boot logs are kept.
+
+console_logs searches and tails these logs for do_qemu -L. The files are
+mmapped, so large logs are scanned without reading them into memory.
+
+This file is executed as a script by the privileged helper, so it must only import from the standard library.
+'''
+
+import os
+import re
+import sys
+import glob
+import mmap
+
+# Defaults of the drain script, the caller passes the configured values
+CONSOLE_LOG_MAX_BYTES = 10 * 1024 * 1024
+CONSOLE_LOG_BACKUPS = 3
+
+CONSOLE_READ_SIZE = 65536
+
+class rotating_log:
+	def __init__(self, log_file, max_bytes, backups):
+		self.log_file = log_file
+		self.max_bytes = max_bytes
+		self.backups = backups
+
+		self.f = open(self.log_file, 'ab')
+		self.size = self.f.tell()
+
+	def __rotate(self):
+		self.f.close()
+		# <uuid>.log.2 -> <uuid>.log.3, ..., <uuid>.log -> <uuid>.log.1
+		for i in range(self.backups - 1, 0, -1):
+			older = "{log}.{i}".format(log = self.log_file, i = i)
+			if os.path.exists(older):
+				os.replace(older, "{log}.{i}".format(log = self.log_file, i = i + 1))
+		if self.backups > 0:
+			os.replace(self.log_file, self.log_file + ".1")
+		else:
+			os.remove(self.log_file)
+
+		self.f = open(self.log_file, 'ab')
+		self.size = 0
+
+	def write(self, data):
+		if self.size and self.size + len(data) > self.max_bytes:
+			self.__rotate()
+
+		self.f.write(data)
+		# Keep the log current for tail and grep
+		self.f.flush()
+		self.size += len(data)
+
+	def close(self):
+		self.f.close()
+
+def drain(log_file, max_bytes, backups):
+	log = rotating_log(log_file, max_bytes, backups)
+	stdin = sys.stdin.buffer.raw
+	while True:
+		data = stdin.read(CONSOLE_READ_SIZE)
+		if not data:
+			# qemu is gone
+			break
+		log.write(data)
+	log.close()
+
+def log_files_of(log_folder, vm_uuid):
+	'''
+	returns the log files of the VM, oldest first
+	'''
+	log_file = os.path.join(log_folder, vm_uuid + ".log")
+	rotated = glob.glob(log_file + ".*")
+	rotated.sort(key = lambda name: int(name.rsplit(".", 1)[1]) if name.rsplit(".", 1)[1].isdigit() else 0, reverse = True)
+	return [name for name in rotated + [log_file] if os.path.isfile(name)]
+
+class console_logs:
+	def __init__(self, log_folder):
+		self.log_folder = log_folder
+
+	def all_uuids(self):
+		uuids = set()
+		for name in os.listdir(self.log_folder):
+			if ".log" in name:
+				uuids.add(name[:name.index(".log")])
+		return sorted(uuids)
+
+	def __mapped(self, log_file):
+		'''
+		returns the file mmapped read only, None for empty or vanished files
+		'''
+		try:
+			with open(log_file, 'rb') as f:
+				return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			return None
+
+	def grep(self, pattern, vm_uuid):
+		'''
+		yields each line of the console logs of the VM matching the regex pattern
+		'''
+		regex = re.compile(pattern.encode())
+		for log_file in log_files_of(self.log_folder, vm_uuid):
+			mm = self.__mapped(log_file)
+			if mm is None:
+				continue
+
+			with mm:
+				pos = 0
+				while True:
+					match = regex.search(mm, pos)
+					if not match:
+						break
+					line_start = mm.rfind(b"\n", 0, match.start()) + 1
+					line_end = mm.find(b"\n", match.end())
+					if line_end == -1:
+						line_end = len(mm)
+					yield mm[line_start:line_end].decode(errors = "replace").rstrip("\r")
+					# One hit per line is enough
+					pos = line_end + 1
+					if pos >= len(mm):
+						break
+
+	def tail(self, lines, vm_uuid):
+		'''
+		returns the last lines of the console logs of the VM
+		'''
+		collected = []
+		for log_file in reversed(log_files_of(self.log_folder, vm_uuid)):
+			mm = self.__mapped(log_file)
+			if mm is None:
+				continue
+
+			with mm:
+				start = len(mm)
+				# A trailing newline does not start another line
+				if start and mm[start - 1:start] == b"\n":
+					start -= 1
+				while len(collected) < lines and start > 0:
+					newline = mm.rfind(b"\n", 0, start)
+					collected.append(mm[newline + 1:start].decode(errors = "replace").rstrip("\r"))
+					start = max(newline, 0)
+
+			if len(collected) >= lines:
+				break
+
+		return list(reversed(collected))
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("Usage: do_console_log.py <log file> [max bytes] [backups]")
+		raise SystemExit(1)
+
+	drain(sys.argv[1],
+		int(sys.argv[2]) if len(sys.argv) > 2 else CONSOLE_LOG_MAX_BYTES,
+		int(sys.argv[3]) if len(sys.argv) > 3 else CONSOLE_LOG_BACKUPS)
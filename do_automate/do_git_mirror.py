@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+
+'''
+Local mirrors of the kernel git trees given as a url.
+Each remote gets one bare mirror, cloned once (without the file contents,
+"blobless", where the remote supports it) and brought up to date with an
+incremental fetch on later runs. Each ref is checked out in a worktree of
+its own, which stays between runs: moving it to a new commit only rewrites
+the files which changed, so the objects of the earlier build stay valid for
+everything else.
+'''
+
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager
+
+from do_automate.globals import *
+
+# Branches and tags of the remote, same names in the mirror
+MIRROR_FETCH_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+class da_git_mirror:
+	def __init__(self, log_obj, mirrors_folder = KERNEL_MIRRORS_FOLDER, worktrees_folder = KERNEL_SOURCES_FOLDER):
+		self.log_obj = log_obj
+		self.mirrors_folder = mirrors_folder
+		self.worktrees_folder = worktrees_folder
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def __git(self, *args, cwd = None):
+		'''
+		returns (returncode, output), output being stderr on failure
+		'''
+		try:
+			proc = subprocess.run(["git"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+		except OSError as e:
+			return -1, str(e)
+
+		if proc.returncode:
+			return proc.returncode, proc.stderr.decode(errors="replace").strip()
+		return 0, proc.stdout.decode(errors="replace").strip()
+
+	@contextmanager
+	def __locked(self, url):
+		# Several do_qemu runs may use the same mirror
+		os.makedirs(self.mirrors_folder, exist_ok=True)
+		with open(self.mirror_path(url) + ".lock", 'w') as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+	def __url_id(self, url):
+		return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+	def mirror_path(self, url):
+		return os.path.join(self.mirrors_folder, self.__url_id(url) + ".git")
+
+	def worktree_path(self, url, ref):
+		# The ref goes into the name readable, the hash keeps different refs apart
+		name = re.sub(r"[^A-Za-z0-9._-]", "_", ref)[:40]
+		return os.path.join(self.worktrees_folder, "{url_id}-{name}-{ref_id}".format(url_id = self.__url_id(url),
+				name = name, ref_id = hashlib.sha256(ref.encode()).hexdigest()[:8]))
+
+	def __clone(self, url, mirror):
+		# Cloned next to the mirror and renamed, so a broken clone is never used
+		tmp_mirror = mirror + ".tmp"
+		shutil.rmtree(tmp_mirror, ignore_errors=True)
+
+		self.__log(INFO, "Cloning {url} into the mirror {mirror}".format(url = url, mirror = mirror))
+		status, output = self.__git("clone", "--bare", "--filter=blob:none", url, tmp_mirror)
+		if status:
+			# git older than 2.19, the blobs come along then
+			self.__log(DEBUG, "Blobless clone failed, cloning all of it: ", output)
+			shutil.rmtree(tmp_mirror, ignore_errors=True)
+			status, output = self.__git("clone", "--bare", url, tmp_mirror)
+		if status:
+			self.__log(ERROR, "Cloning {url} failed: ".format(url = url), output)
+			shutil.rmtree(tmp_mirror, ignore_errors=True)
+			return False
+
+		status, output = self.__git("config", "--replace-all", "remote.origin.fetch", MIRROR_FETCH_REFSPECS[0], cwd = tmp_mirror)
+		if not status:
+			status, output = self.__git("config", "--add", "remote.origin.fetch", MIRROR_FETCH_REFSPECS[1], cwd = tmp_mirror)
+		if status:
+			self.__log(ERROR, "Setting up the mirror of {url} failed: ".format(url = url), output)
+			shutil.rmtree(tmp_mirror, ignore_errors=True)
+			return False
+
+		os.rename(tmp_mirror, mirror)
+		return True
+
+	def update(self, url):
+		'''
+		Clones the mirror of url, or fetches what is new in the remote.
+		returns True on success
+		'''
+		mirror = self.mirror_path(url)
+		with self.__locked(url):
+			if not os.path.isdir(mirror):
+				return self.__clone(url, mirror)
+
+			self.__log(INFO, "Fetching {url} into the mirror {mirror}".format(url = url, mirror = mirror))
+			status, output = self.__git("fetch", "--prune", "origin", cwd = mirror)
+			if status:
+				self.__log(ERROR, "Fetching {url} failed: ".format(url = url), output)
+				return False
+
+		return True
+
+	def __resolve(self, mirror, ref):
+		status, commit = self.__git("rev-parse", "--verify", "--quiet", ref + "^{commit}", cwd = mirror)
+		if not status:
+			return commit
+
+		# Not a branch or tag of the remote, maybe a commit the branches do not have (yet)
+		status, output = self.__git("fetch", "origin", ref, cwd = mirror)
+		if status:
+			self.__log(DEBUG, "Fetching {ref} failed: ".format(ref = ref), output)
+			return None
+		status, commit = self.__git("rev-parse", "--verify", "--quiet", "FETCH_HEAD^{commit}", cwd = mirror)
+		return None if status else commit
+
+	def checkout(self, url, ref, worktree):
+		'''
+		Checks out ref (a branch, tag or commit of the mirror, HEAD for the default branch) in worktree,
+		creating the worktree the first time.
+		returns the commit checked out, None on failure
+		'''
+		mirror = self.mirror_path(url)
+		with self.__locked(url):
+			commit = self.__resolve(mirror, ref)
+			if not commit:
+				self.__log(ERROR, "{ref} not found in {url}".format(ref = ref, url = url))
+				return None
+
+			if os.path.isfile(os.path.join(worktree, ".git")):
+				# Only the files which differ are written, the others keep their times
+				status, output = self.__git("checkout", "--detach", "--force", commit, cwd = worktree)
+			else:
+				# Drops the worktrees whose folders were deleted
+				self.__git("worktree", "prune", cwd = mirror)
+				shutil.rmtree(worktree, ignore_errors=True)
+				os.makedirs(os.path.dirname(worktree), exist_ok=True)
+				status, output = self.__git("worktree", "add", "--detach", worktree, commit, cwd = mirror)
+			if status:
+				self.__log(ERROR, "Checking out {ref} in {worktree} failed: ".format(ref = ref, worktree = worktree), output)
+				return None
+
+		return commit
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
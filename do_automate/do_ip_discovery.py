@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+'''
+Finds the IPs of VMs from their MAC addresses.
+The IPs are looked up in the leases of the libvirt dnsmasq instances and
+in the kernel neighbour table (/proc/net/arp). Instead of polling at a fixed
+interval, the lookup is repeated as soon as the kernel reports a neighbour
+change over netlink, or a lease file changes.
+'''
+
+import os
+import glob
+import json
+import time
+import select
+import socket
+
+from do_automate.globals import *
+from do_automate.do_wait import wait_cancelled
+
+# Where libvirt keeps the leases handed out by its dnsmasq instances
+LIBVIRT_DNSMASQ_FOLDER = "/var/lib/libvirt/dnsmasq/"
+
+PROC_NET_ARP = "/proc/net/arp"
+
+# Netlink multicast group of neighbour table changes, from linux/rtnetlink.h
+RTMGRP_NEIGH = 0x4
+
+# ARP entry flag of a resolved neighbour, from linux/if_arp.h
+ATF_COM = 0x2
+
+# Lease files are checked at least this often (seconds),
+# even when no neighbour event comes in
+LEASE_CHECK_INTERVAL = 0.2
+
+def read_proc_arp():
+	'''
+	returns dict of mac -> ip of the resolved entries of the neighbour table
+	'''
+	ips = {}
+	try:
+		with open(PROC_NET_ARP) as f:
+			# Skip the header line
+			lines = f.readlines()[1:]
+	except OSError:
+		return ips
+
+	for line in lines:
+		fields = line.split()
+		# IP address, HW type, Flags, HW address, Mask, Device
+		if len(fields) < 4:
+			continue
+		if not int(fields[2], 16) & ATF_COM:
+			continue
+		ips[fields[3].lower()] = fields[0]
+
+	return ips
+
+def read_dnsmasq_leases(folder = LIBVIRT_DNSMASQ_FOLDER):
+	'''
+	Reads both the .status files (json, used by libvirt's leaseshelper)
+	and the classic dnsmasq .leases files.
+	Expired leases are skipped.
+	returns dict of mac -> ip
+	'''
+	ips = {}
+	now = time.time()
+
+	for status_file in glob.glob(folder + "*.status"):
+		try:
+			with open(status_file) as f:
+				leases = json.load(f)
+		except (OSError, ValueError):
+			continue
+
+		for lease in leases:
+			if int(lease.get("expiry-time", now)) < now:
+				continue
+			if "mac-address" in lease and "ip-address" in lease:
+				ips[lease["mac-address"].lower()] = lease["ip-address"]
+
+	for leases_file in glob.glob(folder + "*.leases"):
+		try:
+			with open(leases_file) as f:
+				lines = f.readlines()
+		except OSError:
+			continue
+
+		for line in lines:
+			# expiry time, MAC, IP, hostname, client id
+			fields = line.split()
+			# Skips the "duid" line. An expiry time of 0 means infinite lease
+			if len(fields) < 3 or not fields[0].isdigit():
+				continue
+			if fields[0] == "0" or int(fields[0]) >= now:
+				ips[fields[1].lower()] = fields[2]
+
+	return ips
+
+class ip_discovery:
+	def __init__(self, log_obj, lease_folder = LIBVIRT_DNSMASQ_FOLDER):
+		self.log_obj = log_obj
+		self.lease_folder = lease_folder
+		self.lease_mtimes = None
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def __open_neigh_socket(self):
+		try:
+			nl_sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+			nl_sock.bind((0, RTMGRP_NEIGH))
+			nl_sock.setblocking(False)
+		except (OSError, AttributeError) as e:
+			# No netlink here, fall back to checking at LEASE_CHECK_INTERVAL
+			self.__log(DEBUG, "Neighbour events not available: ", e)
+			return None
+
+		return nl_sock
+
+	def __drain(self, nl_sock):
+		# We rescan the tables anyway, the content of the events does not matter
+		try:
+			while nl_sock.recv(65536):
+				pass
+		except (BlockingIOError, InterruptedError):
+			pass
+
+	def __leases_changed(self):
+		mtimes = {}
+		for lease_file in glob.glob(self.lease_folder + "*.status") + glob.glob(self.lease_folder + "*.leases"):
+			try:
+				mtimes[lease_file] = os.stat(lease_file).st_mtime_ns
+			except OSError:
+				pass
+
+		changed = mtimes != self.lease_mtimes
+		self.lease_mtimes = mtimes
+		return changed
+
+	def __lookup(self, pending, found, start):
+		known = read_dnsmasq_leases(self.lease_folder)
+		known.update(read_proc_arp())
+
+		for mac in list(pending):
+			if mac in known:
+				found[mac] = (known[mac], time.monotonic() - start)
+				pending.discard(mac)
+				self.__log(DEBUG, "Found IP {ip} for {mac}".format(ip = known[mac], mac = mac))
+
+	def resolve(self, macs, timeout):
+		'''
+		Waits till all macs have an IP, or till timeout seconds are over.
+		returns dict of mac -> (ip, seconds it took to find it),
+		the macs not found in time are left out
+		'''
+		pending = set(mac.lower() for mac in macs)
+		found = {}
+		start = time.monotonic()
+		deadline = start + timeout
+
+		nl_sock = self.__open_neigh_socket()
+		try:
+			self.__leases_changed()
+			self.__lookup(pending, found, start)
+
+			while pending:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					self.__log(DEBUG, "No IP found for ", sorted(pending))
+					break
+				if wait_cancelled.is_set():
+					self.__log(INFO, "Cancelled waiting for the IPs of ", sorted(pending))
+					break
+
+				wait = min(LEASE_CHECK_INTERVAL, remaining)
+				if nl_sock is not None:
+					ready, _, _ = select.select([nl_sock], [], [], wait)
+					if ready:
+						self.__drain(nl_sock)
+				else:
+					wait_cancelled.wait(wait)
+					ready = []
+
+				if ready or self.__leases_changed():
+					self.__lookup(pending, found, start)
+		finally:
+			if nl_sock is not None:
+				nl_sock.close()
+
+		# Hand back the macs as they were given
+		return {mac: found[mac.lower()] for mac in macs if mac.lower() in found}
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+'''
+The options of a kernel .config, read in one pass into a dict of symbol -> value.
+Values are kept as written after the "=" ("y", "m", "0x1000", "\"string\""),
+options written as "# CONFIG_X is not set" get "n". Options missing from the
+file (their dependencies are off, or the tree does not have them) are not in
+the dict.
+Comparing such a state with the options wanted gives the changes to make, so
+the .config is only written when something has to change. Writing it
+although nothing changed would make kbuild redo its configuration.
+'''
+
+KCONFIG_NOT_SET = "n"
+
+def parse_config(config_file):
+	'''
+	returns dict of symbol -> value of the .config, None if it cannot be read
+	'''
+	state = {}
+	try:
+		with open(config_file) as f:
+			for line in f:
+				line = line.strip()
+				if line.startswith("CONFIG_") and "=" in line:
+					symbol, value = line.split("=", 1)
+					state[symbol] = value
+				elif line.startswith("# CONFIG_") and line.endswith(" is not set"):
+					state[line.split(" ")[1]] = KCONFIG_NOT_SET
+	except OSError:
+		return None
+
+	return state
+
+def config_delta(state, wanted):
+	'''
+	returns dict of symbol -> value of the wanted options state does not have.
+	An option wanted as a module is fine built in.
+	'''
+	delta = {}
+	for symbol, value in wanted.items():
+		current = state.get(symbol)
+		if current == value or (value == "m" and current == "y"):
+			continue
+		delta[symbol] = value
+
+	return delta
+
+def config_summary(state):
+	'''
+	returns dict with the number of options built in and built as modules
+	'''
+	values = list(state.values())
+	return {"built_in": values.count("y"), "modules": values.count("m")}
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
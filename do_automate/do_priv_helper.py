@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+'''
+Privileged helper.
+Started once per session through sudo, it reads requests from stdin
+(one json object per line) and writes one json reply per request to stdout.
+This way only one sudo authentication is needed, and the host password
+never shows up on a command line.
+
+This file is executed as a script by sudo, so it must only import from the standard library.
+'''
+
+import os
+import sys
+import json
+import shlex
+import select
+import atexit
+import threading
+import subprocess
+
+# Seconds to wait for the helper to come up (sudo authentication included)
+HELPER_START_TIMEOUT = 15
+
+# Appends its stdin to a rotating log, used for the console output of qemu
+CONSOLE_DRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "do_console_log.py")
+
+class priv_helper:
+	def __init__(self):
+		self.proc = None
+		self.lock = threading.Lock()
+
+	def is_running(self):
+		return self.proc is not None and self.proc.poll() is None
+
+	def start(self, host_password):
+		'''
+		Starts the helper through sudo, feeding it the host password on stdin.
+		returns True if the helper is up and answering
+		'''
+		with self.lock:
+			if self.is_running():
+				return True
+
+			self.proc = subprocess.Popen(["sudo", "-S", "-p", "", sys.executable, os.path.abspath(__file__)],
+					stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+			# sudo reads the password up to the newline, the rest of stdin is for the helper.
+			# When sudo needs no password, the helper skips this empty line.
+			try:
+				self.proc.stdin.write((host_password + "\n").encode())
+				self.proc.stdin.flush()
+			except BrokenPipeError:
+				self.proc = None
+				return False
+
+			reply = self.__request_locked({"op": "ping"}, HELPER_START_TIMEOUT)
+			if not reply or "pid" not in reply:
+				# Most likely a wrong password, sudo is waiting for another try
+				self.proc.kill()
+				self.proc = None
+				return False
+
+		atexit.register(self.stop)
+		return True
+
+	def stop(self):
+		with self.lock:
+			if not self.is_running():
+				return
+			# The helper exits on EOF, processes it spawned keep running
+			self.proc.stdin.close()
+			self.proc.wait()
+			self.proc = None
+
+	def __request_locked(self, request, timeout=None):
+		try:
+			self.proc.stdin.write((json.dumps(request) + "\n").encode())
+			self.proc.stdin.flush()
+		except (BrokenPipeError, ValueError):
+			return None
+
+		if timeout is not None:
+			ready, _, _ = select.select([self.proc.stdout], [], [], timeout)
+			if not ready:
+				return None
+
+		line = self.proc.stdout.readline()
+		if not line:
+			return None
+
+		return json.loads(line.decode())
+
+	def request(self, request):
+		'''
+		Sends one request and waits for its reply.
+		returns the reply dict, None if the helper is gone
+		'''
+		with self.lock:
+			if not self.is_running():
+				return None
+			return self.__request_locked(request)
+
+	def run(self, command):
+		'''
+		Runs the shell command as root and waits for it.
+		returns returncode and stdout of the command
+		'''
+		reply = self.request({"op": "run", "command": command})
+		if reply is None:
+			return None, ""
+		return reply.get("returncode"), reply.get("output", "")
+
+	def spawn(self, command, shell=True, console_log=None):
+		'''
+		Starts the command as root in its own session, without waiting for it.
+		With shell=False the command is split and executed directly,
+		so the returned pid is the pid of the command itself.
+		console_log is None, or a dict with "file", "max_bytes" and "backups":
+		the output of the command then goes to that rotating log, written
+		as the user who started us.
+		returns the pid, None on failure
+		'''
+		reply = self.request({"op": "spawn", "command": command, "shell": shell, "console_log": console_log})
+		if reply is None:
+			return None
+		return reply.get("pid")
+
+# One helper per session, shared by all da_command objects
+shared_priv_helper = priv_helper()
+
+def start_console_drain(console_log, children):
+	'''
+	Starts the drain script on the read end of a new pipe, as the user behind sudo.
+	returns the write end for the output of the command
+	'''
+	read_end, write_end = os.pipe()
+
+	# Without sudo in between, the drain runs as ourselves
+	user = int(os.environ["SUDO_UID"]) if "SUDO_UID" in os.environ else None
+	group = int(os.environ["SUDO_GID"]) if "SUDO_GID" in os.environ else None
+
+	try:
+		drain = subprocess.Popen([sys.executable, CONSOLE_DRAIN_SCRIPT, console_log["file"],
+				str(console_log["max_bytes"]), str(console_log["backups"])],
+				stdin=read_end, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+				start_new_session=True, user=user, group=group)
+	except OSError:
+		os.close(write_end)
+		raise
+	finally:
+		os.close(read_end)
+
+	children.append(drain)
+	return write_end
+
+def handle_request(request, children):
+	op = request.get("op")
+
+	if op == "ping":
+		return {"pid": os.getpid()}
+
+	if op == "run":
+		proc = subprocess.run(request["command"], shell=True, stdin=subprocess.DEVNULL,
+				stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		return {"returncode": proc.returncode, "output": proc.stdout.decode(errors="replace")}
+
+	if op == "spawn":
+		command = request["command"]
+		if not request.get("shell", True):
+			command = shlex.split(command)
+
+		output = subprocess.DEVNULL
+		console_log = request.get("console_log")
+		if console_log:
+			try:
+				output = start_console_drain(console_log, children)
+			except OSError as e:
+				return {"error": "console log: " + str(e)}
+
+		try:
+			proc = subprocess.Popen(command, shell=request.get("shell", True), stdin=subprocess.DEVNULL,
+					stdout=output, stderr=output, start_new_session=True)
+		except OSError as e:
+			return {"error": str(e)}
+		finally:
+			if output is not subprocess.DEVNULL:
+				# The command and the drain have their ends of the pipe now
+				os.close(output)
+		children.append(proc)
+		return {"pid": proc.pid}
+
+	return {"error": "unknown op {op}".format(op = op)}
+
+def serve():
+	children = []
+	for line in sys.stdin:
+		line = line.strip()
+		if not line or not line.startswith("{"):
+			# The password line, when sudo did not need it
+			continue
+
+		try:
+			reply = handle_request(json.loads(line), children)
+		except Exception as e:
+			reply = {"error": repr(e)}
+
+		sys.stdout.write(json.dumps(reply) + "\n")
+		sys.stdout.flush()
+
+		# Reap the spawned processes which are done
+		children[:] = [child for child in children if child.poll() is None]
+
+if __name__ == "__main__":
+	serve()
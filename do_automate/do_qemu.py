@@ -1,17 +1,33 @@
 #!/usr/bin/python3
 
-import subprocess
+import os
+import re
 import time
 import sys
+import json
+import hashlib
+import shutil
 import numbers
+import tempfile
+import threading
+from datetime import datetime
 from urllib.parse import urlparse
 
 from do_automate.globals import *
 from do_automate.util import *
+from do_automate.do_trace import span
+from do_automate.do_qmp import qmp_socket_path
+from do_automate.do_wait import da_wait
+from do_automate.do_console import shared_console_mux, console_fifos
+from do_automate.do_build_cache import da_build_cache, source_tree_hash, tree_size, format_size
+from do_automate.do_ccache import da_ccache
+from do_automate.do_kconfig import parse_config, config_delta, config_summary
+from do_automate.do_git_mirror import da_git_mirror
 
 # GLOBALS
 qemu_cmd = "qemu-system-x86_64 {kvm_option} -smp {cpu} -m {ram}M -nographic {mode} \
 		-monitor unix:{monitor_file},server,nowait \
+		-qmp unix:{qmp_file},server,nowait \
 		-drive id=d0,file={qcow_image},if=none,format=qcow2 \
 		-device virtio-blk-pci,drive=d0,scsi=off -kernel {bzImage} \
 		-append 'root=/dev/{blk_dev} rw console=ttyS0' \
@@ -40,6 +56,143 @@ basic_modules = [
 "CONFIG_NET_FAILOVER",
 ]
 
+# Config of the running host kernel, the starting point for cloned kernel trees
+HOST_KERNEL_CONFIG = "/boot/config-" + os.uname().release
+
+# Starting points for the .config ("kernel_config"), the make targets which create it.
+# "host" copies the config of the running host kernel, a distro config with thousands of modules.
+KERNEL_CONFIG_BASES = {
+	"host": [],
+	"defconfig": ["defconfig"],
+	"kvm_guest": ["defconfig", "kvm_guest.config"],
+	"tinyconfig": ["tinyconfig", "kvm_guest.config"],
+}
+
+# What the userspace of the VM images needs on top of a minimal base, set =y.
+# defconfig has most of these, tinyconfig none.
+guest_userspace_options = [
+"CONFIG_MODULES",
+"CONFIG_MODULE_UNLOAD",
+"CONFIG_MULTIUSER",
+"CONFIG_PROC_FS",
+"CONFIG_SYSFS",
+"CONFIG_DEVTMPFS",
+"CONFIG_DEVTMPFS_MOUNT",
+"CONFIG_TMPFS",
+"CONFIG_SHMEM",
+"CONFIG_FUTEX",
+"CONFIG_EPOLL",
+"CONFIG_SIGNALFD",
+"CONFIG_TIMERFD",
+"CONFIG_EVENTFD",
+"CONFIG_POSIX_TIMERS",
+"CONFIG_FHANDLE",
+"CONFIG_INOTIFY_USER",
+"CONFIG_CGROUPS",
+"CONFIG_BINFMT_ELF",
+"CONFIG_BINFMT_SCRIPT",
+"CONFIG_UNIX",
+"CONFIG_INET",
+"CONFIG_PACKET",
+]
+
+# Options of the test profiles ("config_profiles"), built as modules
+KERNEL_CONFIG_PROFILES = {
+	"null_blk": ["CONFIG_BLK_DEV_NULL_BLK"],
+	"brd": ["CONFIG_BLK_DEV_RAM"],
+	"loop": ["CONFIG_BLK_DEV_LOOP"],
+	"rdma_rxe": ["CONFIG_INFINIBAND", "CONFIG_RDMA_RXE"],
+}
+
+# Kernel trees checked out by this process: (url, ref) -> worktree
+shared_sources = {}
+
+# Kernels built by this process, for all VM classes: build key -> output folder
+shared_builds = {}
+
+# Classes build one at a time, so a class finds the build of the classes before it
+kernel_build_lock = threading.Lock()
+
+# Kernel build stats, per kernel tree
+BUILD_STATS_FILE = default_data_path + "/build_stats.json"
+
+# Seconds between two build progress messages
+BUILD_PROGRESS_INTERVAL = 30
+
+# Lines of kbuild output for a compiled object, like "  CC [M]  fs/ext4/inode.o"
+build_object_re = re.compile(r"^\s+(CC|AS)(\s+\[M\])?\s+\S+\.o$")
+
+# First real error in a build log
+build_error_re = re.compile(r"(: (fatal )?error:)|(\*\*\* .*Error \d+)")
+
+def format_duration(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	return "{m}m{s:02d}s".format(m = minutes, s = seconds)
+
+def format_change(new, old):
+	if not old:
+		return "n/a"
+	return "{change:+.0f}%".format(change = 100 * (new - old) / old)
+
+def first_build_error(build_log, context = 5):
+	# Compiler errors come first, make's "*** Error" lines only report them again
+	first_make_error = None
+	try:
+		with open(build_log, errors="replace") as f:
+			lines = []
+			for line in f:
+				if lines:
+					lines.append(line)
+					if len(lines) > context:
+						break
+				elif build_error_re.search(line):
+					if "***" not in line:
+						lines.append(line)
+					elif first_make_error is None:
+						first_make_error = line
+	except OSError:
+		return ""
+
+	if lines:
+		return "".join(lines)
+	return first_make_error or ""
+
+class build_progress:
+	'''
+	Counts the objects compiled while a build runs and logs the progress,
+	with an estimate of the time left based on the previous build of the same tree.
+	'''
+	def __init__(self, log_obj, previous_stats):
+		self.log_obj = log_obj
+		self.previous_stats = previous_stats
+
+		self.objects = 0
+		self.start = time.time()
+		self.last_report = self.start
+
+	def elapsed(self):
+		return time.time() - self.start
+
+	def eta(self):
+		if not self.previous_stats or not self.previous_stats.get("objects") or not self.objects:
+			return None
+		done = min(self.objects / self.previous_stats["objects"], 1.0)
+		return self.elapsed() * (1 - done) / done
+
+	def line(self, line):
+		if build_object_re.match(line):
+			self.objects += 1
+
+		now = time.time()
+		if now - self.last_report < BUILD_PROGRESS_INTERVAL:
+			return
+		self.last_report = now
+
+		eta = self.eta()
+		self.log_obj.log(INFO, "Build progress: {objects} objects compiled, {elapsed} elapsed, {eta}".format(
+				objects = self.objects, elapsed = format_duration(self.elapsed()),
+				eta = "ETA {t}".format(t = format_duration(eta)) if eta is not None else "no ETA yet"))
+
 class auto_qemu:
 	def __init__(self, log_obj, linux_kernel_folder = None, vm_share_folder = None, shared_9p_tag = None):
 		# The default folder where the linux code with be checked out in case a git url is supplied
@@ -60,6 +213,11 @@ class auto_qemu:
 		self.dac_obj = da_command(self.log_obj)
 		self.dag_obj = da_get(self.log_obj, self.dac_obj)
 		self.dau_obj = da_util(self.log_obj, self.dac_obj)
+		self.wait_obj = da_wait(self.log_obj)
+		self.cache_obj = da_build_cache(self.log_obj)
+		self.module_cache_obj = da_build_cache(self.log_obj, MODULE_CACHE_FOLDER, MODULE_CACHE_MAX_BYTES)
+		self.ccache_obj = da_ccache(self.log_obj)
+		self.mirror_obj = da_git_mirror(self.log_obj)
 
 		# Ready for spinning up VMs?
 		self.vm_params_set = False
@@ -68,11 +226,7 @@ class auto_qemu:
 		self.__log(INFO, "Current directory : ", current_directory)
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
-
-		self.log_obj.log(log_level, message)
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
 
 	def set_vm_params(self, vm_params_dict, build_option):
 		'''
@@ -87,7 +241,8 @@ class auto_qemu:
                                         'password': password,
                                         'bridges': [bridge_1, bridge_2],
                                         'kernel_code': kernel_code,
-                                        'modules': modules_install }
+                                        'modules': modules_install,
+                                        'ips': {mac: ip} (only with reserved addressing) }
 		'''
 		if (not self.linux_kernel_folder) or (not self.vm_share_folder) or (not self.shared_9p_tag):
 			self.__log(INFO, "Please instantiate the do_qemu object with valid values")
@@ -120,11 +275,15 @@ class auto_qemu:
 		self.local_kernel_code = True
 		url_check = urlparse(self.kernel_code)
 		try:
-			if all([url_check.scheme, url_check.netloc]):
+			# file:///path has no host, it is a url all the same
+			if url_check.scheme and (url_check.netloc or url_check.scheme == "file"):
 				self.local_kernel_code = False
 		except ValueError:
 			self.local_kernel_code = True
 
+		# Branch, tag or commit of a kernel git url, the default branch of the remote if not given
+		self.kernel_ref = vm_params_dict.get("kernel_ref", "HEAD")
+
 		if "modules" in vm_params_dict:
 			self.modules_install = vm_params_dict['modules']
 		else:
@@ -141,6 +300,9 @@ class auto_qemu:
 		self.vm_uuids = vm_params_dict["uuids"]
 		self.all_mac_addrs = vm_params_dict["macs"]
 
+		# mac -> IP, when the IPs are reserved up front
+		self.reserved_ips = vm_params_dict.get("ips")
+
 		# Init some default values
 		self.bzImage = self.linux_kernel_folder + "/bzImage"
 		self.host_password = ""
@@ -153,8 +315,21 @@ class auto_qemu:
 
 		self.build_option = build_option
 
+		# Reuse the bzImage and modules of an earlier build of the same tree and .config
+		self.use_build_cache = vm_params_dict.get("build_cache", True)
+
+		# Identifies the kernel build, the modules built against it are cached under it
+		self.kernel_build_key = None
+
+		# Compile through ccache, when it is installed
+		self.use_ccache = vm_params_dict.get("ccache", True) and self.ccache_obj.available()
+
 		self.mode = vm_params_dict["mode"]
 
+		# Where the .config starts from, None for the .config of a local tree or the host config for a cloned one
+		self.kernel_config = vm_params_dict.get("kernel_config")
+		self.config_profiles = vm_params_dict.get("config_profiles", [])
+
 		self.the_modules = basic_modules.copy()
 		if "scsi_images" in vm_params_dict:
 			self.the_modules.extend(["CONFIG_SCSI", "CONFIG_BLK_DEV_SD", "CONFIG_MEGARAID_SAS"])
@@ -162,6 +337,14 @@ class auto_qemu:
 		else:
 			self.scsi_images = []
 
+		if self.kernel_config not in [None, "host"]:
+			self.the_modules.extend(guest_userspace_options)
+
+		# Options set =m, the rest of the_modules =y
+		self.the_module_options = []
+		for profile in self.config_profiles:
+			self.the_module_options.extend(KERNEL_CONFIG_PROFILES.get(profile, []))
+
 		# Do some sanity checks
 		if not self.__sanity_check():
 			self.__log(ERROR, "Sanity check failed")
@@ -200,27 +383,39 @@ class auto_qemu:
 			self.__log(ERROR, "No bridge given")
 			return False
 
+		if self.kernel_config is not None and self.kernel_config not in KERNEL_CONFIG_BASES:
+			self.__log(ERROR, "Unknown kernel_config {base}, the possible values are {bases}".format(base = self.kernel_config,
+					bases = list(KERNEL_CONFIG_BASES)))
+			return False
+
+		for profile in self.config_profiles:
+			if profile not in KERNEL_CONFIG_PROFILES:
+				self.__log(ERROR, "Unknown config profile {profile}, the possible values are {profiles}".format(profile = profile,
+						profiles = list(KERNEL_CONFIG_PROFILES)))
+				return False
+
 		return True
 
 	def __check_host_dependencies(self):
 		self.__log(DEBUG, "Checking host dependencies")
-		command = "dpkg -s qemu"
-		status, status_string = self.dac_obj.run_command_local(command)
+		all_bridges = [self.bridge_1]
+		if self.bridge_1 != self.bridge_2:
+			all_bridges.append(self.bridge_2)
+
+		# All the checks are independent, run them at once
+		all_argv = [["dpkg", "-s", "qemu"]]
+		for bridge in all_bridges:
+			all_argv.append(["ip", "-o", "-4", "a", "show", "dev", bridge])
+		all_results = self.dac_obj.run_commands_local(all_argv, timeout=30)
+
+		status, status_string = all_results[0]
 		if status:
 			self.__log(ERROR, "Fail! ", status_string)
 			return False
 
-		command = "ip -o -4 a | grep {bridge} | awk '{{print $2}}'".format(bridge = self.bridge_1)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status or status_string.rstrip() != self.bridge_1:
-			self.__log(ERROR, "Fail! Network bridge {bridge} not found".format(bridge = self.bridge_1), status_string)
-			return False
-
-		if self.bridge_1 != self.bridge_2:
-			command = "ip -o -4 a | grep {bridge} | awk '{{print $2}}'".format(bridge = self.bridge_2)
-			status, status_string = self.dac_obj.run_command_local(command)
-			if status or status_string.rstrip() != self.bridge_2:
-				self.__log(ERROR, "Fail! Network bridge {bridge} not found".format(bridge = self.bridge_2), status_string)
+		for bridge, (status, status_string) in zip(all_bridges, all_results[1:]):
+			if status or bridge not in status_string.split():
+				self.__log(ERROR, "Fail! Network bridge {bridge} not found".format(bridge = bridge), status_string)
 				return False
 
 		if "virbr" not in self.bridge_1 or "virbr" not in self.bridge_2:
@@ -252,10 +447,16 @@ class auto_qemu:
 		if not self.pipe:
 			return True
 
-		command = "mkfifo {pipe_folder}/{uuid}.in {pipe_folder}/{uuid}.out".format(pipe_folder = PIPES_FOLDER, uuid = uuid)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+		try:
+			for fifo in console_fifos(uuid):
+				os.mkfifo(fifo)
+		except OSError as e:
+			self.__log(ERROR, "Creating pipe files failed: ", e)
+			return False
+
+		# Start reading before qemu does its first write, so no console output is lost
+		if shared_console_mux.open(uuid) is None:
+			self.__log(ERROR, "Opening pipe files failed")
 			return False
 		return True
 
@@ -263,74 +464,176 @@ class auto_qemu:
 		if not self.pipe:
 			return True
 
-		command = "rm {pipe_folder}/{uuid}.in {pipe_folder}/{uuid}.out".format(pipe_folder = PIPES_FOLDER, uuid = uuid)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, "Problem deleting stale pipe files ", status, status_string)
+		shared_console_mux.close(uuid)
+		try:
+			for fifo in console_fifos(uuid):
+				os.remove(fifo)
+		except OSError as e:
+			self.__log(ERROR, "Problem deleting stale pipe files ", e)
 			# Lets not fail here. It really isnt a big deal that rm failed.
 		return True
 
 
-	def __install_ext_module(self, module_path):
+	def __make_args(self):
+		# Every make of a tree has to use the same CC, or kbuild rebuilds everything
+		if not self.use_ccache:
+			return []
+		return self.ccache_obj.make_args()
+
+	def __make_env(self, base_dir):
+		if not self.use_ccache:
+			return None
+		return self.ccache_obj.env(base_dir)
+
+	def __kernel_make(self, *targets):
+		command = ["make", "-C", self.kernel_source_folder]
+		if os.path.realpath(self.linux_kernel_folder) != os.path.realpath(self.kernel_source_folder):
+			command.append("O={folder}".format(folder = self.linux_kernel_folder))
+		return command + list(targets) + self.__make_args()
+
+	def __kernel_make_env(self):
+		return self.__make_env(os.path.commonpath([os.path.realpath(self.kernel_source_folder),
+				os.path.realpath(self.linux_kernel_folder)]))
+
+	def __ccache_stats(self):
+		if not self.use_ccache:
+			return None
+		return self.ccache_obj.stats()
+
+	def __make_ext_module(self, module_path, install_folder):
+		name = os.path.basename(os.path.normpath(module_path))
 		self.__log(INFO, "Doing make and install of external module ", module_path)
+
+		build_log = default_data_path + "/logs/module_" + name + "_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
 		# For some reason "make -C" option does not work for IBNBD
-		command = "cd {folder} && make KDIR={linux_kernel_folder}".format(folder = module_path, linux_kernel_folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
+		command = ["make", "KDIR={linux_kernel_folder}".format(linux_kernel_folder = self.linux_kernel_folder)] + self.__make_args()
+		status = self.dac_obj.run_command_local_stream(command, build_log, cwd=module_path, env=self.__make_env(module_path))
 		if status:
-			self.__log(ERROR, status, status_string)
+			self.__log(ERROR, "make of module {name} failed with {status}. Log: {log}".format(name = name, status = status, log = build_log))
+			self.__log(ERROR, "First error of module {name}:\n".format(name = name) + first_build_error(build_log))
 			return False
 
-		command = "cd {folder} && make INSTALL_MOD_PATH={vm_share_folder} KDIR={linux_kernel_folder} modules_install".format(
-				folder = module_path, vm_share_folder = self.vm_share_folder, linux_kernel_folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
+		command = ["make", "INSTALL_MOD_PATH={install_folder}".format(install_folder = install_folder),
+				"KDIR={linux_kernel_folder}".format(linux_kernel_folder = self.linux_kernel_folder), "modules_install"] + self.__make_args()
+		status, status_string = self.dac_obj.run_command_local(command, cwd=module_path, env=self.__make_env(module_path))
 		if status:
-			self.__log(ERROR, status, status_string)
+			self.__log(ERROR, "modules_install of module {name} failed with {status}: ".format(name = name, status = status), status_string)
 			return False
 
 		return True
 
-	def __login_to_vm_pipe(self, uuid):
-		if not self.pipe:
-			return True
+	def __merge_module_files(self, install_folder):
+		# The module index files (lib/modules/<version>/modules.*) only know this module, depmod redoes them later.
+		# Files are replaced, never written in place, since the shared folder is linked to the kernel build.
+		for root, dirs, files in os.walk(install_folder):
+			rel_root = os.path.relpath(root, install_folder)
+			is_version_folder = os.path.dirname(rel_root) == os.path.join("lib", "modules")
+			for name in files:
+				if is_version_folder and name.startswith("modules."):
+					continue
+
+				dst = os.path.join(self.vm_share_folder, rel_root, name)
+				try:
+					os.makedirs(os.path.dirname(dst), exist_ok=True)
+					shutil.copy2(os.path.join(root, name), dst + ".tmp")
+					os.replace(dst + ".tmp", dst)
+				except OSError as e:
+					self.__log(ERROR, "Installing {file} failed: ".format(file = dst), e)
+					return False
 
-		global vm_comm_delay_mult
+		return True
 
-		status_string = "this passes butter"
-		this_pipe_in = PIPES_FOLDER + "/" + uuid + ".in"
-		this_pipe_out = PIPES_FOLDER + "/" + uuid + ".out"
+	def __install_ext_module(self, module_path):
+		# Runs in parallel with the other modules
+		module_key = None
+		if self.use_build_cache and self.kernel_build_key:
+			module_key = hashlib.sha256(json.dumps([self.kernel_build_key, source_tree_hash(module_path)]).encode()).hexdigest()[:32]
 
-		# Flush all the bootup logs till the login console is launched
-		while status_string and "login:" not in status_string[-10:]:
-			command = "timeout 5 cat {pipe}".format(pipe = this_pipe_out)
-			status_string = self.dac_obj.run_sudo_command_local_ret_out(command)
-			if not status_string:
-				self.__log(DEBUG, "__run_sudo_command_local_ret_out Failed:", status_string)
-				return False
+		# Installed here first, to cache exactly the files of this module
+		install_folder = tempfile.mkdtemp(prefix="module_", dir=default_data_path)
+		try:
+			if module_key and self.module_cache_obj.restore(module_key, None, install_folder):
+				self.__log(INFO, "Module {module} unchanged, installing it from the cache".format(module = module_path))
+			else:
+				if not self.__make_ext_module(module_path, install_folder):
+					return False
+
+				if module_key:
+					self.module_cache_obj.store(module_key, {"source": os.path.realpath(module_path), "kernel_key": self.kernel_build_key},
+							None, install_folder)
+
+			return self.__merge_module_files(install_folder)
+		finally:
+			shutil.rmtree(install_folder, ignore_errors=True)
+
+	def __depmod(self):
+		depmod = shutil.which("depmod") or "/sbin/depmod"
+		if not os.access(depmod, os.X_OK):
+			# Same as kbuild, the VM can still run depmod itself
+			self.__log(INFO, "depmod not found, the module index files of the shared folder are not updated")
+			return True
 
-		command = "{username}\n".format(username = self.my_username)
 		try:
-			with open(this_pipe_in, 'w') as f:
-				f.write(command)
-		except:
-			self.__log(DEBUG, "__run_sudo_command_local Failed with Exception: " + str(sys.exc_info()[0]))
+			versions = os.listdir(self.vm_share_folder + "/lib/modules")
+		except OSError as e:
+			self.__log(ERROR, "No modules in the shared folder: ", e)
 			return False
 
-		time.sleep(1 * vm_comm_delay_mult)
-		command = "{password}\n".format(password = self.my_password)
-		try:
-			with open(this_pipe_in, 'w') as f:
-				f.write(command)
-		except:
-			self.__log(DEBUG, "__run_sudo_command_local Failed with Exception: " + str(sys.exc_info()[0]))
+		for version in versions:
+			command = [depmod, "-a", "-b", self.vm_share_folder, version]
+			status, status_string = self.dac_obj.run_command_local(command)
+			if status:
+				self.__log(ERROR, "depmod for {version} failed: ".format(version = version), status, status_string)
+				return False
+
+		return True
+
+	def __install_ext_modules(self):
+		all_modules = []
+		for module in self.modules_install:
+			if not self.dau_obj.is_path_absolute(module):
+				module = current_directory + "/" + module
+			all_modules.append(module)
+
+		if self.use_build_cache and self.kernel_build_key is None:
+			# The kernel was not built by this run
+			self.kernel_build_key, _ = self.cache_obj.build_key(self.kernel_source_folder, self.linux_kernel_folder)
+
+		def install(module):
+			with span("external module", module = module):
+				return self.__install_ext_module(module)
+
+		stats_before = self.__ccache_stats()
+		executor = da_parallel(self.log_obj, min(len(all_modules), os.cpu_count() or 1))
+		results = executor.run(install, all_modules)
+
+		# A module may need the Module.symvers of another module, which was not built yet.
+		# Those are tried again once the others are done, one by one, in the given order.
+		for module in all_modules:
+			if not results[module]["status"]:
+				self.__log(INFO, "Trying module {module} again, after the others".format(module = module))
+				results[module] = executor.run(install, [module])[module]
+
+		if self.use_ccache:
+			self.ccache_obj.log_stats("Modules", stats_before, self.__ccache_stats())
+
+		if executor.log_summary(results, "Module"):
 			return False
-		time.sleep(1 * vm_comm_delay_mult)
 
-		# Flush once more to keep the console clean
-		command = "timeout {this_timeout} cat {pipe}".format(this_timeout = 3 * vm_comm_delay_mult, pipe = this_pipe_out)
-		status_string = self.dac_obj.run_sudo_command_local_ret_out(command)
-		self.__log(DEBUG, "status_string ", status_string)
-		if not status_string:
-			self.__log(DEBUG, "__run_sudo_command_local_ret_out Failed:", status_string)
+		return self.__depmod()
+
+	def __login_to_vm_pipe(self, uuid):
+		if not self.pipe:
+			return True
+
+		console = shared_console_mux.open(uuid)
+		if console is None:
+			self.__log(ERROR, "Opening the console fifos of VM {uuid} failed".format(uuid = uuid))
+			return False
+
+		# The reader started with the VM, so the whole boot log is searched for the login prompt
+		if not console.login(self.my_username, self.my_password, PIPE_LOGIN_TIMEOUT, PIPE_PROMPT_TIMEOUT):
+			self.__log(ERROR, "Login on the console of VM {uuid} failed".format(uuid = uuid))
 			return False
 
 		return True
@@ -374,6 +677,21 @@ class auto_qemu:
 
 		return all_args
 
+	def __take_qmp_socket(self, vm_uuid):
+		qmp_file = qmp_socket_path(vm_uuid)
+
+		# qemu creates the socket early in its startup
+		if not self.wait_obj.until("QMP socket of VM " + str(vm_uuid), lambda: os.path.exists(qmp_file), QMP_SOCKET_TIMEOUT):
+			return False
+
+		command = "chown {uid} {qmp_file}".format(uid = os.getuid(), qmp_file = qmp_file)
+		status, status_string = self.dac_obj.run_sudo_command_local_status(command)
+		if status:
+			self.__log(DEBUG, status, status_string)
+			return False
+
+		return True
+
 	def __spin_up_qemu_vm(self, vm_iter):
 		vm_uuid = self.vm_uuids[vm_iter]
 
@@ -383,16 +701,17 @@ class auto_qemu:
 
 		# Check if the host system is a VM or not
 		kvm_enable = ""
-		command = "dmesg | grep -i Hypervisor"
+		command = ["dmesg"]
 		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
+		if status or "hypervisor" not in status_string.lower():
 			kvm_enable = "-enable-kvm"
 
 		opt_qemu_args = self.__get_optional_qemu_args(vm_uuid, vm_iter)
 
 		cmd = qemu_cmd.format(kvm_option = kvm_enable, \
 					cpu = self.vm_cpus, ram = self.vm_ram, \
-					monitor_file = default_data_path + "vm_monitors/" + str(vm_uuid), \
+					monitor_file = MONITORS_FOLDER + str(vm_uuid), \
+					qmp_file = qmp_socket_path(vm_uuid), \
 					mode = qemu_mode, \
 					qcow_image = self.qcow_image[vm_iter], \
 					bzImage = self.bzImage, blk_dev = self.block_dev, \
@@ -405,14 +724,21 @@ class auto_qemu:
 
 		self.__log(INFO, "Starting VM with command: {cmd}\n".format(cmd = cmd))
 
-		pid = self.dac_obj.run_sudo_command_local_get_pid(cmd)
+		with span("spawn VM", vm_uuid):
+			pid = self.dac_obj.run_sudo_command_local_get_pid(cmd, CONSOLE_LOGS_FOLDER + str(vm_uuid) + ".log")
+		if pid is None:
+			self.__log(ERROR, "Starting qemu failed")
+			return False
+
+		self.all_pids.append(pid)
 
-		# Dont ask why +2
-		self.all_pids.append(pid+2)
+		# qemu runs as root, hand its QMP socket to us
+		if not self.__take_qmp_socket(vm_uuid):
+			self.__log(INFO, "QMP socket of VM {uuid} not usable, falling back to ssh for its lifecycle".format(uuid = vm_uuid))
 
 		return True
 
-	def __generate_vm_details(self, vm_iter):
+	def __generate_vm_details(self, vm_iter, found_ips):
 		my_mac_addr = []
 		list_of_ips = [None, None]
 		vm_uuid = self.vm_uuids[vm_iter]
@@ -420,7 +746,7 @@ class auto_qemu:
 		self.__log(INFO, "Attempting to get IPs and verify pipes communication of the launched VM")
 		for i in range(NUM_OF_ETH_INT):
 			my_mac_addr.append(str(self.all_mac_addrs[(vm_iter*NUM_OF_ETH_INT)+i]))
-			my_ip = self.dag_obj.get_ip_from_mac(my_mac_addr[i])
+			my_ip = found_ips.get(my_mac_addr[i])
 			if my_ip is None:
 				self.__log(ERROR, "Cannot find IP of the launched VM.\nIs the bridge configured properly?")
 				self.__log(ERROR, "Manual check required. Exiting")
@@ -428,13 +754,14 @@ class auto_qemu:
 			list_of_ips[i] = my_ip
 			self.__log(DEBUG, "Done! IP: {ip}\n".format(ip = my_ip))
 
-		if not self.__login_to_vm_pipe(vm_uuid):
-			self.__log(DEBUG, "__login_to_vm_pipe Failed")
-			return False
+		with span("pipe login", vm_uuid):
+			if not self.__login_to_vm_pipe(vm_uuid):
+				self.__log(DEBUG, "__login_to_vm_pipe Failed")
+				return False
 
-		if not self.__verify_pipe_comm(vm_uuid):
-			self.__log(DEBUG, "__verify_pipe_comm Failed")
-			return False
+			if not self.__verify_pipe_comm(vm_uuid):
+				self.__log(DEBUG, "__verify_pipe_comm Failed")
+				return False
 
 		# VM up and running, now create the details dict to be stored
 		this_vm_details = {}
@@ -453,11 +780,11 @@ class auto_qemu:
 
 		return this_vm_details
 
-	def __add_kernel_config_options(self, list_of_options):
-
+	def __add_kernel_config_options(self, options):
+		# options is dict of option -> value, "y" or "m"
 		all_lines = []
-		for the_mod in list_of_options:
-			this_str = the_mod + "=y\n"
+		for the_mod, value in options.items():
+			this_str = the_mod + "=" + value + "\n"
 			all_lines.append(this_str)
 
 		try:
@@ -467,10 +794,11 @@ class auto_qemu:
 			self.__log(ERROR, "Something went wrong while saving .config-fragment file")
 			return False
 
-		command = "cd {kernel_folder} && bash ./scripts/kconfig/merge_config.sh .config \
-				{default_data_folder}/.config-fragment".format( \
-				kernel_folder = self.linux_kernel_folder, default_data_folder = default_data_path)
-		status, status_string = self.dac_obj.run_command_local(command)
+		command = ["bash", "./scripts/kconfig/merge_config.sh"]
+		if os.path.realpath(self.linux_kernel_folder) != os.path.realpath(self.kernel_source_folder):
+			command += ["-O", self.linux_kernel_folder]
+		command += [self.linux_kernel_folder + "/.config", default_data_path + "/.config-fragment"]
+		status, status_string = self.dac_obj.run_command_local(command, cwd=self.kernel_source_folder)
 		if status:
 			self.__log(ERROR, status, status_string)
 			return False
@@ -478,94 +806,249 @@ class auto_qemu:
 		return True
 
 	def __check_kernel_config_file(self):
-		try:
-			with open(self.linux_kernel_folder + "/.config") as f:
-				all_lines = f.readlines()
-		except FileNotFoundError:
+		config_file = self.linux_kernel_folder + "/.config"
+		state = parse_config(config_file)
+		if state is None:
 			self.__log(ERROR, ".config file not found in kernel folder")
 			return False
 
-		the_modules_copy = self.the_modules.copy()
-		for i in range(len(all_lines)):
-			this_str = all_lines[i]
-			for the_mod in self.the_modules:
-				if the_mod in this_str:
-					if the_mod + "=" == this_str[:-2]:
-						if this_str[-2:] != "y\n":
-							# This option is not set to y, lets change that
-							this_str = this_str[:-2] + "y\n"
-							all_lines[i] = this_str
-							self.__log(INFO, "Changed module option: ", this_str[:-1])
-						the_modules_copy.remove(the_mod)
-						break
-					elif "not set" in this_str:
-						if the_mod in this_str.split(' '):
-							# This option is not set at all, lets change that
-							this_str = the_mod + "=y\n"
-							all_lines[i] = this_str
-							the_modules_copy.remove(the_mod)
-							self.__log(INFO, "Changed module option: ", this_str[:-1])
-							break
+		wanted = dict.fromkeys(self.the_modules, "y")
+		wanted.update(dict.fromkeys(self.the_module_options, "m"))
 
-		try:
-			with open(self.linux_kernel_folder + "/.config", 'w') as f:
-				f.writelines(all_lines)
-		except:
-			self.__log(ERROR, "Something went wrong while saving .config file")
+		delta = config_delta(state, wanted)
+		if not delta:
+			# Not even rewritten, kbuild goes by its mtime
+			self.__log(INFO, ".config has all the module options, leaving it as it is")
+			return True
+
+		for the_mod, value in delta.items():
+			self.__log(INFO, "Changing module option: {option}={value} (was {old})".format(option = the_mod, value = value,
+					old = state.get(the_mod, "not in .config")))
+
+		# All in one merge, Kconfig resolves their dependencies together
+		if not self.__add_kernel_config_options(delta):
+			self.__log(ERROR, "__add_kernel_config_options() Failed")
 			return False
 
-		if the_modules_copy:
-			self.__log(INFO, "The following module options were not found at all", the_modules_copy)
-			self.__log(INFO, "Attempting to add those options")
-			if not self.__add_kernel_config_options(the_modules_copy):
-				self.__log(ERROR, "__add_kernel_config_options() Failed")
-				return False
-			# Recurse
-			if not self.__check_kernel_config_file():
-				self.__log(ERROR, "__check_kernel_config_file recurse failed")
+		state = parse_config(config_file)
+		if state is None:
+			self.__log(ERROR, ".config file not found in kernel folder after merging")
+			return False
+
+		left = config_delta(state, delta)
+		if left:
+			# Their dependencies are off, or this tree does not have them
+			self.__log(ERROR, "The following module options could not be set, building without them", list(left))
+
+		return True
+
+	def __update_git_tree(self):
+		if shared_sources.get((self.kernel_code, self.kernel_ref)) == self.kernel_source_folder:
+			self.__log(INFO, "{repo} {ref} already checked out by this run".format(repo = self.kernel_code, ref = self.kernel_ref))
+			return True
+
+		# Only what is new in the remote is fetched, and only the changed files of the worktree are written,
+		# so the objects of the last build of this ref stay valid
+		with span("git fetch", repo = self.kernel_code):
+			if not self.mirror_obj.update(self.kernel_code):
 				return False
 
+		with span("git checkout", ref = self.kernel_ref):
+			commit = self.mirror_obj.checkout(self.kernel_code, self.kernel_ref, self.kernel_source_folder)
+		if not commit:
+			return False
+		self.__log(INFO, "{repo} {ref} ({commit}) checked out in {folder}\n".format(repo = self.kernel_code, ref = self.kernel_ref,
+				commit = commit[:12], folder = self.kernel_source_folder))
+
+		shared_sources[(self.kernel_code, self.kernel_ref)] = self.kernel_source_folder
 		return True
 
-	def __clone_git_repo(self):
-		# Delete folder if already exists
-		command = "rm -rf {folder}/".format(folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+	def __set_kernel_folders(self):
+		'''
+		Picks the kernel source tree, the folder the kernel is built in (linux_kernel_folder),
+		and the output folder which gets the bzImage and the installed modules.
+		Local trees are built in place, they bring their own .config.
+		Cloned trees are kept clean and built out of tree (O=), one build folder per .config,
+		so classes with different options do not rebuild each other's objects.
+		'''
+		if self.local_kernel_code:
+			# This is path to the local folder which has the kernel code
+			self.kernel_source_folder = self.dau_obj.check_and_make_path_abs(self.kernel_code)
+			self.linux_kernel_folder = self.kernel_source_folder
+			build_id = os.path.realpath(self.kernel_source_folder)
+		else:
+			self.kernel_source_folder = self.mirror_obj.worktree_path(self.kernel_code, self.kernel_ref)
+			if self.__config_label() == "host":
+				try:
+					with open(HOST_KERNEL_CONFIG) as f:
+						base_config = f.read()
+				except OSError as e:
+					self.__log(ERROR, "Reading the host kernel config failed: ", e)
+					return False
+			else:
+				# Made from the tree, the tree is part of the build key
+				base_config = self.kernel_config
+			build_id = [self.kernel_code, base_config, sorted(self.the_modules), self.kernel_ref]
+			if self.the_module_options:
+				build_id.append(sorted(self.the_module_options))
+			build_id = json.dumps(build_id)
+
+		self.kernel_output_folder = KERNEL_BUILDS_FOLDER + hashlib.sha256(build_id.encode()).hexdigest()[:16]
+		if not self.local_kernel_code:
+			self.linux_kernel_folder = self.kernel_output_folder + "/obj"
+
+		self.__log(DEBUG, "Kernel source {src}, built in {build}, output in {out}".format(src = self.kernel_source_folder,
+				build = self.linux_kernel_folder, out = self.kernel_output_folder))
+		return True
+
+	def __config_label(self):
+		# What the .config starts from, for the logs and the build stats
+		if self.kernel_config:
+			return self.kernel_config
+		return "tree" if self.local_kernel_code else "host"
+
+	def __prepare_build_folder(self):
+		if not self.dac_obj.make_dirs_local(self.kernel_output_folder):
 			return False
 
-		# create the folder
-		command = "mkdir -p {folder}".format(folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+		# A local tree brings its own .config, unless kernel_config says otherwise
+		if self.linux_kernel_folder == self.kernel_source_folder and self.kernel_config is None:
+			return True
+
+		if not self.dac_obj.make_dirs_local(self.linux_kernel_folder):
 			return False
-		self.__log(INFO, "Main folder for cloning: {path}".format(path = self.linux_kernel_folder))
 
-		# Confirm that the folder exists
-		command = "ls {folder}".format(folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+		return self.__make_base_config()
+
+	def __make_base_config(self):
+		base = self.__config_label()
+		config_file = self.linux_kernel_folder + "/.config"
+		if self.linux_kernel_folder == self.kernel_source_folder:
+			self.__log(INFO, "Replacing the .config of {tree} with a {base} config, the old one is kept as .config.old".format(
+					tree = self.kernel_source_folder, base = base))
+
+		if base == "host":
+			if os.path.exists(config_file) and not self.dac_obj.copy_file_local(config_file, config_file + ".old"):
+				return False
+			# Same options as the host kernel, the fixups come on top
+			return self.dac_obj.copy_file_local(HOST_KERNEL_CONFIG, config_file)
+
+		# The fixups (basic_modules, SCSI, profiles) come on top
+		for target in KERNEL_CONFIG_BASES[base]:
+			command = self.__kernel_make(target)
+			with span("make " + target):
+				status, status_string = self.dac_obj.run_command_local(command, env=self.__kernel_make_env())
+			if status:
+				self.__log(ERROR, status, status_string)
+				return False
+
+		return True
+
+	def __config_snapshot(self):
+		# The .config as it was before this run, with its times
+		config_file = self.linux_kernel_folder + "/.config"
+		try:
+			with open(config_file, 'rb') as f:
+				return f.read(), os.stat(config_file)
+		except OSError:
+			return None
+
+	def __keep_config_times(self, snapshot):
+		'''
+		The base config of a cloned tree, or of a given kernel_config, is made again on every run.
+		When the final .config is the same as before, its times are put back, so kbuild does not redo its configuration.
+		'''
+		if snapshot is None:
+			return
+
+		config_file = self.linux_kernel_folder + "/.config"
+		content, old_stat = snapshot
+		try:
+			with open(config_file, 'rb') as f:
+				if f.read() != content:
+					return
+			os.utime(config_file, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns))
+		except OSError:
+			return
+		self.__log(DEBUG, ".config unchanged since the last build")
+
+	def __config_summary(self):
+		'''
+		returns dict with the number of options of the .config built in and built as modules
+		'''
+		return config_summary(parse_config(self.linux_kernel_folder + "/.config") or {})
+
+	def __install_kernel_output(self):
+		# Each class gets its own copy of the modules, since its external modules go in there too
+		if not self.dac_obj.copy_file_local(self.kernel_output_folder + "/bzImage", self.bzImage):
 			return False
 
-		self.__log(INFO, "Cloning the repo {repo} into {folder}".format(repo = self.kernel_code, folder = self.linux_kernel_folder))
-		# clone repo into TMP_PATH
-		command = "git clone --depth=1 {repo} {folder}".format(repo = self.kernel_code, folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+		if not self.dac_obj.remove_tree_local(self.vm_share_folder) or \
+				not self.dac_obj.link_tree_local(self.kernel_output_folder + "/modules", self.vm_share_folder):
 			return False
-		self.__log(INFO, "Done cloning.\n")
+		self.__log(INFO, "Folder shared with the VM: {path}".format(path = self.vm_share_folder))
 
-		# copy the default config file to the linux folder
-		command = "cp /boot/config-$(uname -r) {folder}/.config".format(folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
+		return True
+
+	def __read_build_stats(self):
+		# Stats of the previous build of this kernel tree, to estimate the time left
+		try:
+			with open(BUILD_STATS_FILE) as f:
+				return json.load(f).get(os.path.realpath(self.linux_kernel_folder))
+		except (OSError, ValueError):
+			return None
+
+	def __save_build_stats(self, stats, key = None):
+		try:
+			with open(BUILD_STATS_FILE) as f:
+				all_stats = json.load(f)
+		except (OSError, ValueError):
+			all_stats = {}
+
+		all_stats[key or os.path.realpath(self.linux_kernel_folder)] = stats
+		try:
+			with open(BUILD_STATS_FILE, 'w') as f:
+				json.dump(all_stats, f, indent=8)
+		except OSError:
+			self.__log(DEBUG, "Saving build stats failed")
+
+	def __report_config_change(self, stats):
+		'''
+		Logs how the build compares to the last builds of the same tree from the other kernel_config bases
+		'''
+		key = "configs " + os.path.realpath(self.kernel_source_folder)
+		try:
+			with open(BUILD_STATS_FILE) as f:
+				by_config = json.load(f).get(key, {})
+		except (OSError, ValueError):
+			by_config = {}
+
+		label = self.__config_label()
+		for other, other_stats in by_config.items():
+			if other == label:
+				continue
+			# With ccache the times also depend on what was in the cache
+			self.__log(INFO, ("{label} config vs {other} config: build {time} vs {other_time} ({time_change}), "
+					"bzImage {bz} vs {other_bz} ({bz_change}), modules {mod} vs {other_mod} ({mod_change})").format(
+					label = label, other = other,
+					time = format_duration(stats["duration"]), other_time = format_duration(other_stats["duration"]),
+					time_change = format_change(stats["duration"], other_stats["duration"]),
+					bz = format_size(stats["bzImage_size"]), other_bz = format_size(other_stats["bzImage_size"]),
+					bz_change = format_change(stats["bzImage_size"], other_stats["bzImage_size"]),
+					mod = format_size(stats["modules_size"]), other_mod = format_size(other_stats["modules_size"]),
+					mod_change = format_change(stats["modules_size"], other_stats["modules_size"])))
+
+		by_config[label] = stats
+		self.__save_build_stats(by_config, key)
+
+	def __make_olddefconfig(self):
+		# Take the default for new config options, same as answering every prompt with enter
+		command = self.__kernel_make("olddefconfig")
+		with span("make olddefconfig"):
+			status, status_string = self.dac_obj.run_command_local(command, env=self.__kernel_make_env())
 		if status:
 			self.__log(ERROR, status, status_string)
 			return False
-		self.__log(INFO, "Done!\n")
 
 		return True
 
@@ -574,46 +1057,61 @@ class auto_qemu:
 		self.__log(INFO, "This may take some time, so sit back.")
 
 		# Start the make
-		command = "yes '' | make -C {folder} -j$(nproc)".format(folder = self.linux_kernel_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
-			return False
+		build_log = default_data_path + "/logs/build_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
+		self.__log(INFO, "Build output goes to {log}".format(log = build_log))
 
-		self.__log(INFO, "Done make. Copying the bzImage to default data folder for step 2")
+		if self.use_ccache:
+			self.__log(INFO, "Compiling through ccache, cache in {folder}".format(folder = CCACHE_FOLDER))
+		stats_before = self.__ccache_stats()
 
-		# copy bzImage to the default path folder for step 2
-		command = "cp {folder}/arch/x86_64/boot/bzImage {path}".format(folder = self.linux_kernel_folder, path = self.bzImage)
-		status, status_string = self.dac_obj.run_command_local(command)
+		progress = build_progress(self.log_obj, self.__read_build_stats())
+		command = self.__kernel_make("-j{jobs}".format(jobs = os.cpu_count()))
+		with span("make", folder = self.linux_kernel_folder):
+			status = self.dac_obj.run_command_local_stream(command, build_log, progress.line, env=self.__kernel_make_env())
 		if status:
-			self.__log(ERROR, status, status_string)
+			self.__log(ERROR, "make failed with {status}, after {elapsed}. Log: {log}".format(status = status,
+					elapsed = format_duration(progress.elapsed()), log = build_log))
+			self.__log(ERROR, "First error:\n" + first_build_error(build_log))
 			return False
-		self.__log(INFO, "Got the bzImage.\n")
 
-		# Delete vm_share folder if already exists
-		command = "rm -rf {folder}/".format(folder = self.vm_share_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+		self.__log(INFO, "Build took {elapsed}, {objects} objects compiled".format(
+				elapsed = format_duration(progress.elapsed()), objects = progress.objects))
+		self.__save_build_stats({"objects": progress.objects, "duration": progress.elapsed()})
+		if self.use_ccache:
+			self.ccache_obj.log_stats("Kernel build", stats_before, self.__ccache_stats())
+
+		self.__log(INFO, "Done make. Copying the bzImage to the output folder")
+
+		# The output folder keeps the build, while the build folder may be rebuilt for another class
+		if not self.dac_obj.copy_file_local(self.linux_kernel_folder + "/arch/x86_64/boot/bzImage", self.kernel_output_folder + "/bzImage"):
 			return False
+		self.__log(INFO, "Got the bzImage.\n")
 
-		# create vm_share folder
-		command = "mkdir -p {folder}".format(folder = self.vm_share_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
-		if status:
-			self.__log(ERROR, status, status_string)
+		# Delete modules folder if already exists, and create it again
+		modules_folder = self.kernel_output_folder + "/modules"
+		if not self.dac_obj.remove_tree_local(modules_folder) or \
+				not self.dac_obj.make_dirs_local(modules_folder):
 			return False
-		self.__log(INFO, "Folder shared with the VM: {path}".format(path = self.vm_share_folder))
 
-		self.__log(INFO, "Installing modules to shared folder")
-		# Do modules_install to vm_share folder so that it can be shared with the VM
-		command = "make -C {folder} INSTALL_MOD_PATH={vm_share_folder} modules_install".format(folder = self.linux_kernel_folder, vm_share_folder = self.vm_share_folder)
-		status, status_string = self.dac_obj.run_command_local(command)
+		self.__log(INFO, "Installing modules to the output folder")
+		command = self.__kernel_make("INSTALL_MOD_PATH={modules_folder}".format(modules_folder = modules_folder), "modules_install")
+		with span("modules_install"):
+			status, status_string = self.dac_obj.run_command_local(command, env=self.__kernel_make_env())
 		if status:
 			self.__log(ERROR, status, status_string)
 			return False
 		self.__log(INFO, "modules_install done.\n")
 
+		try:
+			bzImage_size = os.path.getsize(self.kernel_output_folder + "/bzImage")
+		except OSError:
+			bzImage_size = 0
+		config_stats = dict(self.__config_summary(), duration = progress.elapsed(), bzImage_size = bzImage_size,
+				modules_size = tree_size(modules_folder))
+		self.__log(INFO, "{label} config: bzImage {bz}, modules {mod}".format(label = self.__config_label(),
+				bz = format_size(bzImage_size), mod = format_size(config_stats["modules_size"])))
+		self.__report_config_change(config_stats)
+
 		return True
 
 	def __build_and_create_image(self):
@@ -623,23 +1121,78 @@ class auto_qemu:
 		and builds the bzImage for the VMs
 		'''
 
-		if self.local_kernel_code:
-			# This is path to the local folder which has the kernel code
-			self.linux_kernel_folder = self.dau_obj.check_and_make_path_abs(self.kernel_code)
-		else:
-			if not self.__clone_git_repo():
-				self.__log(ERROR, "__clone_git_repo failed")
+		with kernel_build_lock:
+			if not self.__build_kernel_once():
 				return False
 
-		# check and configure the .config file
-		if not self.__check_kernel_config_file():
-			self.__log(ERROR, "__check_kernel_config_file failed")
+			if not self.__install_kernel_output():
+				self.__log(ERROR, "__install_kernel_output failed")
+				return False
+
+		return True
+
+	def __build_kernel_once(self):
+		# Called with kernel_build_lock held
+		if not self.__set_kernel_folders():
+			self.__log(ERROR, "__set_kernel_folders failed")
 			return False
 
-		if not self.__build_kernel_code():
-			self.__log(ERROR, "__build_kernel_code failed")
+		if not self.local_kernel_code:
+			if not self.__update_git_tree():
+				self.__log(ERROR, "__update_git_tree failed")
+				return False
+
+		previous_config = self.__config_snapshot()
+
+		if not self.__prepare_build_folder():
+			self.__log(ERROR, "__prepare_build_folder failed")
 			return False
 
+		# check and configure the .config file
+		with span(".config fixups"):
+			if not self.__check_kernel_config_file():
+				self.__log(ERROR, "__check_kernel_config_file failed")
+				return False
+
+		# The .config is final after this, so it can go into the build key
+		if not self.__make_olddefconfig():
+			self.__log(ERROR, "__make_olddefconfig failed")
+			return False
+
+		self.__keep_config_times(previous_config)
+
+		summary = self.__config_summary()
+		self.__log(INFO, "Kernel config from {label}: {built_in} options built in, {modules} modules".format(
+				label = self.__config_label(), **summary))
+
+		build_key, build_info = self.cache_obj.build_key(self.kernel_source_folder, self.linux_kernel_folder)
+		self.kernel_build_key = build_key
+
+		if build_key and shared_builds.get(build_key) == self.kernel_output_folder:
+			self.__log(INFO, "Same kernel tree and .config as a class before, using its build")
+			return True
+
+		with span("build cache lookup"):
+			restored = build_key and self.use_build_cache and \
+					self.cache_obj.restore(build_key, self.kernel_output_folder + "/bzImage", self.kernel_output_folder + "/modules")
+		if restored:
+			self.__log(INFO, "Tree and .config unchanged, using cached build {key}".format(key = build_key))
+		else:
+			if not self.__build_kernel_code():
+				self.__log(ERROR, "__build_kernel_code failed")
+				return False
+
+			if build_key and self.use_build_cache:
+				# A build which cannot be cached is still a good build
+				with span("build cache store"):
+					self.cache_obj.store(build_key, build_info, self.kernel_output_folder + "/bzImage", self.kernel_output_folder + "/modules")
+
+		# The output folder holds this build now, not the one it had before
+		for key in [key for key, folder in shared_builds.items() if folder == self.kernel_output_folder]:
+			del shared_builds[key]
+		if build_key:
+			shared_builds[build_key] = self.kernel_output_folder
+
 		return True
 
 	def __launch_vms(self):
@@ -647,13 +1200,20 @@ class auto_qemu:
 
 		for i in range(self.num_of_vm):
 			# Run the command
+			# Returns once qemu is up far enough to serve its QMP socket
 			if not self.__spin_up_qemu_vm(i):
 				self.__log(ERROR, "Spinning up VM failed")
-			# Let qemu breath
-			time.sleep(1)
+
+		if self.reserved_ips:
+			found_ips = self.reserved_ips
+		else:
+			# Wait for the IPs of all the VMs together, each one is taken as soon as its lease shows up
+			all_macs = [str(mac) for mac in self.all_mac_addrs[:self.num_of_vm * NUM_OF_ETH_INT]]
+			with span("IP discovery", num_of_macs = len(all_macs)):
+				found_ips = self.dag_obj.get_ips_from_macs(all_macs)
 
 		for i in range(self.num_of_vm):
-			vm_details = self.__generate_vm_details(i)
+			vm_details = self.__generate_vm_details(i, found_ips)
 
 			if (not vm_details):
 				self.__log(ERROR, "self.__spin_up_qemu_vm() Failed")
@@ -666,46 +1226,59 @@ class auto_qemu:
 
 		return True
 
-	def start_auto(self, host_password):
+	# The phases of start_auto. They can be run one by one, e.g. by a task graph,
+	# as long as the order stays the same.
+	def check_host(self, host_password):
 		if not self.vm_params_set:
 			self.__log(ERROR, "VM params for this object not set correctly.")
 			return False
 
 		self.dac_obj.set_param(None, None, host_password)
 
-		if not self.__check_host_dependencies():
-			self.__log(ERROR, "Host dependency check failure")
-			return False
+		with span("host dependency check"):
+			if not self.__check_host_dependencies():
+				self.__log(ERROR, "Host dependency check failure")
+				return False
 		self.__log(INFO, "Host dependency check passed\n\n")
 
+		return True
+
+	def build_kernel(self):
 		if (self.build_option == "all" or self.build_option == "kernel") and self.kernel_code:
 			self.__log(INFO, "******** Starting step 1 ********")
 			self.__log(INFO, "This will take a long time..\n")
-			if not self.__build_and_create_image():
-				self.__log(ERROR, "Failure in step 1")
-				return False
+			with span("step 1: build kernel"):
+				if not self.__build_and_create_image():
+					self.__log(ERROR, "Failure in step 1")
+					return False
 			self.__log(INFO, "******** Step 1 Finished ********\n")
 		else:
-			self.linux_kernel_folder = self.dau_obj.check_and_make_path_abs(self.kernel_code)
+			# The external modules still need the build folder
+			if not self.__set_kernel_folders():
+				return False
 			self.__log(INFO, "Skip building kernel.")
 			self.__log(INFO, "Skipping step 1\n")
 
+		return True
+
+	def build_modules(self):
 		# Make and install given modules
 		if (self.build_option == "all" or self.build_option == "module") and self.modules_install:
 			self.__log(INFO, "Make and install given modules")
-			for module in self.modules_install:
-				if not self.dau_obj.is_path_absolute(module):
-					module = current_directory + "/" + module
-				if not self.__install_ext_module(module):
-					self.__log(ERROR, "Failure during module installation")
-					return False
+			if not self.__install_ext_modules():
+				self.__log(ERROR, "Failure during module installation")
+				return False
 			self.__log(INFO, "Done!\n")
 
+		return True
+
+	def launch(self):
 		self.__log(INFO, "******** Starting step 2 ********")
-		if not self.__launch_vms():
-			# Should we check and shutdown VMs here?
-			self.__log(ERROR, "Failure in step 2")
-			return False
+		with span("step 2: launch VMs", num_of_vm = self.num_of_vm):
+			if not self.__launch_vms():
+				# Should we check and shutdown VMs here?
+				self.__log(ERROR, "Failure in step 2")
+				return False
 		self.__log(INFO, "******** Step 2 Finished ********\n\n")
 
 		# TODO
@@ -718,6 +1291,12 @@ class auto_qemu:
 
 		return {"all_ips": self.all_ips, "all_pids": self.all_pids}
 
+	def start_auto(self, host_password):
+		if not self.check_host(host_password) or not self.build_kernel() or not self.build_modules():
+			return False
+
+		return self.launch()
+
 	def build_new(self, config_file, git_repo):
 		# If you have an existing object, and want to reinitialize it.
 		self.__log(INFO, "Reconfiguring parameters from config file")
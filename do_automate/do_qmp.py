@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+'''
+Client for the QMP socket of the VMs.
+Every VM is started with "-qmp unix:<monitor folder>/<uuid>.qmp,server,nowait".
+Through it we ask qemu for the run state, and power down, reset or stop
+the VM without going through the guest network.
+'''
+
+import json
+import time
+import select
+import socket
+
+from do_automate.globals import *
+
+# Seconds to wait for the greeting and for replies to commands
+QMP_REPLY_TIMEOUT = 5
+
+def qmp_socket_path(vm_uuid):
+	return MONITORS_FOLDER + str(vm_uuid) + ".qmp"
+
+class da_qmp:
+	'''
+	One QMP connection. qemu serves one client at a time on the socket,
+	so keep the connections short.
+	'''
+	def __init__(self, log_obj, vm_uuid):
+		self.log_obj = log_obj
+		self.vm_uuid = vm_uuid
+		self.socket_path = qmp_socket_path(vm_uuid)
+
+		self.sock = None
+		self.buf = b""
+		self.events = []
+
+		# Set when connect() found nobody behind the socket, so qemu is gone
+		self.gone = False
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def __read_message(self, deadline):
+		'''
+		returns the next json message, None on timeout or when qemu closed the socket
+		'''
+		while b"\n" not in self.buf:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return None
+
+			ready, _, _ = select.select([self.sock], [], [], remaining)
+			if not ready:
+				return None
+
+			try:
+				data = self.sock.recv(65536)
+			except OSError:
+				data = b""
+			if not data:
+				return None
+			self.buf += data
+
+		line, self.buf = self.buf.split(b"\n", 1)
+		try:
+			return json.loads(line.decode(errors="replace"))
+		except ValueError:
+			self.__log(DEBUG, "Skipping malformed QMP message: ", line)
+			return self.__read_message(deadline)
+
+	def connect(self):
+		'''
+		Connects and leaves the capabilities negotiation mode.
+		returns True on success, False if nobody is serving the socket
+		'''
+		try:
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.connect(self.socket_path)
+		except (ConnectionRefusedError, FileNotFoundError) as e:
+			self.__log(DEBUG, "Nobody serving {path}: ".format(path = self.socket_path), e)
+			self.gone = True
+			self.close()
+			return False
+		except OSError as e:
+			self.__log(DEBUG, "Connecting to {path} failed: ".format(path = self.socket_path), e)
+			self.close()
+			return False
+
+		greeting = self.__read_message(time.monotonic() + QMP_REPLY_TIMEOUT)
+		if not greeting or "QMP" not in greeting:
+			self.__log(DEBUG, "No QMP greeting on {path}: ".format(path = self.socket_path), greeting)
+			self.close()
+			return False
+
+		if self.command("qmp_capabilities") is None:
+			self.close()
+			return False
+
+		return True
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+	def command(self, name, **arguments):
+		'''
+		Runs one QMP command. Events which come in before the reply are kept for wait_event().
+		returns the "return" value of the reply, None on error
+		'''
+		if self.sock is None:
+			return None
+
+		request = {"execute": name}
+		if arguments:
+			request["arguments"] = arguments
+
+		try:
+			self.sock.sendall((json.dumps(request) + "\n").encode())
+		except OSError as e:
+			self.__log(DEBUG, "Sending {name} failed: ".format(name = name), e)
+			return None
+
+		deadline = time.monotonic() + QMP_REPLY_TIMEOUT
+		while True:
+			message = self.__read_message(deadline)
+			if message is None:
+				self.__log(DEBUG, "No reply to {name}".format(name = name))
+				return None
+
+			if "event" in message:
+				self.events.append(message)
+				continue
+
+			if "error" in message:
+				self.__log(DEBUG, "{name} failed: ".format(name = name), message["error"])
+				return None
+
+			return message.get("return")
+
+	def wait_event(self, names, timeout):
+		'''
+		Waits for the first of the events in names.
+		returns the event, None on timeout or when the socket closed first
+		'''
+		for event in self.events:
+			if event["event"] in names:
+				self.events.remove(event)
+				return event
+
+		if self.sock is None:
+			return None
+
+		deadline = time.monotonic() + timeout
+		while True:
+			message = self.__read_message(deadline)
+			if message is None:
+				return None
+
+			if message.get("event") in names:
+				return message
+
+	def query_status(self):
+		'''
+		returns the run state ("running", "paused", "shutdown", ...), None on error
+		'''
+		status = self.command("query-status")
+		if status is None:
+			return None
+		return status.get("status")
+
+	def powerdown(self, timeout):
+		'''
+		Sends the ACPI power button press and waits for the guest to shut down.
+		returns True if the SHUTDOWN event came in time
+		'''
+		if self.command("system_powerdown") is None:
+			return False
+		return self.wait_event(["SHUTDOWN"], timeout) is not None
+
+	def reset(self, timeout = QMP_REPLY_TIMEOUT):
+		'''
+		Resets the VM like the reset button would.
+		returns True if the RESET event came in time
+		'''
+		if self.command("system_reset") is None:
+			return False
+		return self.wait_event(["RESET"], timeout) is not None
+
+	def quit(self):
+		'''
+		Stops qemu right away, without the guest shutting down.
+		returns True if qemu took the command
+		'''
+		return self.command("quit") is not None
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
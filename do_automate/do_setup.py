@@ -4,12 +4,22 @@ import os
 import subprocess
 from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
 
+from do_automate.globals import DEFAULT_DATA_FOLDER_NAME, GUEST_IMAGE_MARKER_SUFFIX
+
 default_path = "/tmp/"
 BRIDGE_2_NAME = "bridge_2"
 
 # Get current directory path
 current_directory = os.getcwd()
 
+def get_keys_folder():
+	# We run through sudo, the keys belong in the data folder of the calling user
+	data_path = os.environ.get('DO_AUTOMATE_DATA')
+	if not data_path:
+		data_path = os.path.expanduser("~" + os.environ.get('SUDO_USER', ""))
+
+	return data_path + "/" + DEFAULT_DATA_FOLDER_NAME + "/keys/"
+
 def define_args():
 	parser = ArgumentParser(add_help=False, formatter_class=RawTextHelpFormatter)
 	opt_arg = parser.add_argument_group('optional arguments')
@@ -44,13 +54,20 @@ class do_setup:
 		print(message)
 
 	def __run_command_local(self, command):
+		# A list is executed directly as argv, a string goes through the shell
 		self.__log(command)
 		try:
-			s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
+			if isinstance(command, list):
+				s = subprocess.check_output(command, stderr=subprocess.DEVNULL).decode('utf-8')
+			else:
+				s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
 			returncode = 0
 		except subprocess.CalledProcessError as e:
 			s = e.output
 			returncode = e.returncode
+		except OSError as e:
+			s = str(e)
+			returncode = 127
 		self.__log(returncode, s)
                 # failure returns a positive returncode
                 # success return 0 as returncode
@@ -139,114 +156,205 @@ class do_setup:
 
 		return False
 
+	def __setup_guest_keys(self, mount_point):
+		keys_folder = get_keys_folder()
+		client_key = keys_folder + "id_ed25519"
+		host_keys_file = keys_folder + "guest_host_keys"
+
+		# The folders makedirs creates (e.g. the data folder on a fresh install), they go to the user later
+		created_folders = []
+		folder = os.path.normpath(keys_folder)
+		while not os.path.exists(folder):
+			created_folders.append(folder)
+			folder = os.path.dirname(folder)
+
+		try:
+			os.makedirs(keys_folder, exist_ok=True)
+		except OSError as e:
+			self.__log("Fail! ", e)
+			return False
+
+		# One client key is shared by all the images
+		if not os.path.exists(client_key):
+			command = ["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-C", "do_automate", "-f", client_key]
+			status, status_string = self.__run_command_local(command)
+			if status:
+				self.__log("Fail! ", status_string)
+				return False
+
+		# Replace the host keys of the image with a single one, which do_qemu pins
+		command = "rm -f {mount_p}/etc/ssh/ssh_host_* && ssh-keygen -q -t ed25519 -N '' -C do_automate_guest -f {mount_p}/etc/ssh/ssh_host_ed25519_key".format(mount_p = mount_point)
+		status, status_string = self.__run_command_local(command)
+		if status:
+			self.__log("Fail! ", status_string)
+			return False
+
+		command = "cat {mount_p}/etc/ssh/ssh_host_ed25519_key.pub >> {host_keys}".format(mount_p = mount_point, host_keys = host_keys_file)
+		status, status_string = self.__run_command_local(command)
+		if status:
+			self.__log("Fail! ", status_string)
+			return False
+
+		command = "mkdir -p -m 700 {mount_p}/root/.ssh && cp {key}.pub {mount_p}/root/.ssh/authorized_keys && chmod 600 {mount_p}/root/.ssh/authorized_keys".format(mount_p = mount_point, key = client_key)
+		status, status_string = self.__run_command_local(command)
+		if status:
+			self.__log("Fail! ", status_string)
+			return False
+
+		# Passwordless sudo, so that remote commands need no password round trip
+		command = "echo '%sudo ALL=(ALL:ALL) NOPASSWD: ALL' > {mount_p}/etc/sudoers.d/do_automate && chmod 440 {mount_p}/etc/sudoers.d/do_automate".format(mount_p = mount_point)
+		status, status_string = self.__run_command_local(command)
+		if status:
+			self.__log("Fail! ", status_string)
+			return False
+
+		if os.environ.get('SUDO_UID'):
+			# We run as root, do_qemu runs as the user and has to create its folders in the data folder
+			owner = "{uid}:{gid}".format(uid = os.environ.get('SUDO_UID'), gid = os.environ.get('SUDO_GID'))
+			command = ["chown", "-R", owner, keys_folder]
+			status, status_string = self.__run_command_local(command)
+			# The data folder too, an earlier run may have created it as root
+			data_folder = os.path.dirname(os.path.normpath(keys_folder))
+			if data_folder not in created_folders:
+				created_folders.append(data_folder)
+			if not status:
+				command = ["chown", owner] + created_folders
+				status, status_string = self.__run_command_local(command)
+			if status:
+				self.__log("Fail! ", status_string)
+				return False
+
+		self.__log("Guest keys are in {keys}".format(keys = keys_folder))
+		return True
+
 	def create_qcow_image(self):
 		self.__log("Creating qcow image file.")
-		command = "mktemp"
+		command = ["mktemp"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
 		tmp_file = status_string.rstrip()
-		command = "dd if=/dev/zero of={i_file} bs=1M count=4096".format(i_file = tmp_file)
+		command = ["dd", "if=/dev/zero", "of={i_file}".format(i_file = tmp_file), "bs=1M", "count=4096"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "losetup -fP {i_file}".format(i_file = tmp_file)
+		command = ["losetup", "-fP", tmp_file]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "losetup | grep {i_file} | awk '{{print $1}}'".format(i_file = tmp_file)
+		command = ["losetup", "-j", tmp_file, "-O", "NAME", "-n"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		loop_dev = status_string.rstrip()
-		command = "parted {loop_d} mklabel gpt mkpart primary ext4 2048 100%".format(loop_d = loop_dev)
+		loop_dev = status_string.strip()
+		command = ["parted", loop_dev, "mklabel", "gpt", "mkpart", "primary", "ext4", "2048", "100%"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "mkfs.ext4 {loop_d}p1".format(loop_d = loop_dev)
+		command = ["mkfs.ext4", loop_dev + "p1"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "mktemp -d"
+		command = ["mktemp", "-d"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
 		mount_point = status_string.rstrip()
-		command = "mount {loop_d}p1 {mount_p}".format(loop_d = loop_dev, mount_p = mount_point)
+		command = ["mount", loop_dev + "p1", mount_point]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "debootstrap --include=libpam-systemd,iproute2,network-manager,openssh-server,sudo,infiniband-diags,rdma-core,psmisc,ibverbs-utils,ethtool stable {mount_p} http://deb.debian.org/debian/".format(mount_p = mount_point)
+		command = ["debootstrap", "--include=libpam-systemd,iproute2,network-manager,openssh-server,sudo,infiniband-diags,rdma-core,psmisc,ibverbs-utils,ethtool",
+				"stable", mount_point, "http://deb.debian.org/debian/"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "mkdir -p {mount_p}/lib/modules".format(mount_p = mount_point)
-		status, status_string = self.__run_command_local(command)
-		if status:
-			self.__log("Fail! ", status_string)
+		try:
+			os.makedirs(mount_point + "/lib/modules", exist_ok=True)
+		except OSError as e:
+			self.__log("Fail! ", e)
 			return False
 
-		command = "sed -i 's/^\(.\|\)PermitRootLogin.*/PermitRootLogin yes/g' {mount_p}/etc/ssh/sshd_config".format(mount_p = mount_point)
+		command = ["sed", "-i", "s/^\\(.\\|\\)PermitRootLogin.*/PermitRootLogin yes/g", mount_point + "/etc/ssh/sshd_config"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "openssl passwd -1 root"
+		command = ["openssl", "passwd", "-1", "root"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
 		root_password = status_string.rstrip()
-		command = "sed -i 's|^root:x|root:{root_p}|g' {mount_p}/etc/passwd".format(root_p = root_password, mount_p = mount_point)
+		command = ["sed", "-i", "s|^root:x|root:{root_p}|g".format(root_p = root_password), mount_point + "/etc/passwd"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "sed -i 's|^root:x|root:{root_p}|g' {mount_p}/etc/passwd-".format(root_p = root_password, mount_p = mount_point)
+		command = ["sed", "-i", "s|^root:x|root:{root_p}|g".format(root_p = root_password), mount_point + "/etc/passwd-"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "umount {mount_p} && losetup -d {loop_d}".format(mount_p = mount_point, loop_d = loop_dev)
+		if not self.__setup_guest_keys(mount_point):
+			self.__log("Fail! __setup_guest_keys()")
+			return False
+
+		command = ["umount", mount_point]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "qemu-img convert -f raw -O qcow2 {i_file} {path}/debian.qcow2".format(i_file = tmp_file, path = current_directory)
+		command = ["losetup", "-d", loop_dev]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
-		command = "rm -rf {mount_p} {i_file}".format(mount_p = mount_point, i_file = tmp_file)
+		command = ["qemu-img", "convert", "-f", "raw", "-O", "qcow2", tmp_file, current_directory + "/debian.qcow2"]
 		status, status_string = self.__run_command_local(command)
 		if status:
 			self.__log("Fail! ", status_string)
 			return False
 
+		try:
+			os.rmdir(mount_point)
+			os.remove(tmp_file)
+		except OSError as e:
+			self.__log("Fail! ", e)
+			return False
+
+		# Tells do_qemu that the VMs of this image have our keys
+		try:
+			with open(current_directory + "/debian.qcow2" + GUEST_IMAGE_MARKER_SUFFIX, 'w') as f:
+				f.write("Made by do_automate_setup -i, its VMs must present one of the host keys in {keys}\n".format(keys = get_keys_folder()))
+		except OSError as e:
+			self.__log("Fail! ", e)
+			return False
+
 		self.__log("All done!")
 		self.__log("The create debian image is {path}/debian.qcow2".format(path = current_directory))
 
@@ -444,7 +552,7 @@ class do_setup:
 		return True
 
 	def insert_modules(self):
-		command = "modprobe kvm"
+		command = ["modprobe", "kvm"]
 
 		status, status_string = self.__run_command_local(command)
 		if status:
@@ -17,11 +17,7 @@ class softROCE:
 		self.log_obj = log_obj
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
-
-		self.log_obj.log(log_level, message)
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
 
 	def __run_command_remote(self, command):
 		return self.my_ssh.run_command(self.my_username, self.my_password, self.my_ip, command)
@@ -33,15 +29,11 @@ class softROCE:
 		self.__log(DEBUG, "In cim", self.my_ip, self.my_username, self.my_password)
 		self.__log(INFO, "Checking and adding module rdma_rxe..")
 
-		status, status_string = self.__run_sudo_command_remote("modprobe rdma_rxe")
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
-
-		# Check once that the module exists
-		status, status_string = self.__run_sudo_command_remote("lsmod | grep rdma_rxe")
+		# Insert the module and check once that it exists, in one round trip
+		commands = ["modprobe rdma_rxe", "lsmod | grep rdma_rxe"]
+		status, results, stderroutput = self.my_ssh.run_batch(self.my_username, self.my_password, self.my_ip, commands, sudo=True)
 		if not status:
-			self.__log(ERROR, status_string)
+			self.__log(ERROR, results[-1]["stderr"] if results else stderroutput)
 			return False
 
 		self.__log(INFO, "Done!\n")
@@ -1,27 +1,403 @@
 # Taken from https://gist.github.com/vladwa/bc49621782736a825844ee4c2a7dacae
 # Changes added
 
+import os
+import base64
+import select
+import shlex
+import threading
+import time
 import paramiko
 
+from do_automate.globals import GUEST_CLIENT_KEY, GUEST_HOST_KEYS_FILE
+
+# Seconds between keepalive packets sent on idle pooled transports
+SSH_KEEPALIVE_INTERVAL = 15
+
+# Bytes read from a channel at once while streaming output
+STREAM_CHUNK_SIZE = 32768
+
+# Marks the start of a step result in the output of a batch script
+BATCH_STEP_MARKER = "__DA_BATCH_STEP__"
+
+# Each step runs with its output captured to files, and its result is
+# printed as one marker line followed by base64 encoded stdout and stderr.
+# Execution stops at the first failing step.
+batch_script_head = '''d=$(mktemp -d) || exit 1
+trap 'rm -rf "$d"' EXIT
+step() {{
+	s=$(date +%s%N)
+	( eval "$2" ) >"$d/out" 2>"$d/err" </dev/null
+	rc=$?
+	e=$(date +%s%N)
+	echo "{marker} $1 $rc $((e - s))"
+	base64 -w0 "$d/out"; echo
+	base64 -w0 "$d/err"; echo
+	return $rc
+}}
+'''.format(marker = BATCH_STEP_MARKER)
+
+def read_channel_lines(chan, pending):
+	"""Reads whatever output is available on chan, without blocking.
+	:param pending: dict with the partial last "stdout" and "stderr" line, kept between calls.
+	returns list of (stream, line) tuples (empty if nothing arrived yet), with any
+	remaining partial lines added, or None once the command exited and all output was read.
+	"""
+	lines = []
+	for stream, ready, recv in (("stdout", chan.recv_ready, chan.recv),
+			("stderr", chan.recv_stderr_ready, chan.recv_stderr)):
+		if not ready():
+			continue
+		pending[stream] += recv(STREAM_CHUNK_SIZE)
+		*complete, pending[stream] = pending[stream].split(b"\n")
+		for line in complete:
+			lines.append((stream, line.decode(errors="replace") + "\n"))
+
+	if lines or not chan.exit_status_ready() or chan.recv_ready() or chan.recv_stderr_ready():
+		return lines
+
+	# Done. Hand out the last lines without a trailing newline
+	for stream in ("stdout", "stderr"):
+		if pending[stream]:
+			lines.append((stream, pending[stream].decode(errors="replace")))
+			pending[stream] = b""
+
+	return lines if lines else None
+
+class ssh_job:
+	'''
+	Handle of a command running on its own channel of a pooled transport.
+	The output is collected in stdout and stderr (lists of lines) as it is polled.
+	'''
+	def __init__(self, ssh_obj, ssh_username, ssh_password, ssh_machine, command, sudo=False):
+		self.ssh_obj = ssh_obj
+		self.ssh_username = ssh_username
+		self.ssh_password = ssh_password
+		self.ssh_machine = ssh_machine
+		self.command = command
+		self.sudo = sudo
+
+		self.stdout = []
+		self.stderr = []
+		self.exit_code = None
+
+		# Remote pid, the first line printed by the wrapper shell
+		self.pid = None
+		self.pending = {"stdout": b"", "stderr": b""}
+
+		# Exec into the command from a shell printing its pid, so that kill() can find it
+		wrapper = "sh -c %s" % shlex.quote("echo $$; exec sh -c %s" % shlex.quote(command))
+		self.chan = ssh_obj.start_channel(ssh_username, ssh_password, ssh_machine, wrapper, sudo)
+
+	def poll(self):
+		"""Collects the output available so far.
+		returns None while the job runs, the exit code once it is done.
+		"""
+		if self.exit_code is not None:
+			return self.exit_code
+
+		lines = read_channel_lines(self.chan, self.pending)
+		for stream, line in lines or []:
+			if stream == "stdout" and self.pid is None:
+				self.pid = line.strip()
+			elif stream == "stdout":
+				self.stdout.append(line)
+			else:
+				self.stderr.append(line)
+
+		if lines is None:
+			self.exit_code = self.chan.recv_exit_status()
+			self.chan.close()
+
+		return self.exit_code
+
+	def wait(self, timeout=None):
+		"""Waits for the job to finish.
+		returns the exit code, or None if the timeout (in seconds) expired first.
+		"""
+		deadline = None if timeout is None else time.time() + timeout
+		while self.poll() is None:
+			if deadline is not None and time.time() >= deadline:
+				return None
+			select.select([self.chan], [], [], 0.1)
+
+		return self.exit_code
+
+	def kill(self, signal="TERM"):
+		"""Sends signal to the whole process group of the job.
+		returns True if the signal was delivered.
+		"""
+		if self.poll() is not None:
+			return True
+
+		# The pid line may still be on its way
+		if self.pid is None and self.wait(1) is not None:
+			return True
+		if not self.pid or not self.pid.isdigit():
+			return False
+
+		command = "kill -{sig} -- -$(ps -o pgid= -p {pid} | tr -d ' ')".format(sig = signal, pid = self.pid)
+		exit_code, stdoutput, stderroutput = self.ssh_obj.run_command_status(self.ssh_username, self.ssh_password,
+				self.ssh_machine, command, self.sudo)
+		return not exit_code
+
+class pinned_host_key_policy(paramiko.MissingHostKeyPolicy):
+	'''
+	Accepts a host only if it presents one of the guest host keys baked into
+	our images. The IPs of the VMs change, so the keys are not tied to a hostname.
+	'''
+	def __init__(self, host_keys_file):
+		self.host_keys = set()
+		# One of the pinned keys, for the error
+		self.expected_key = None
+		with open(host_keys_file) as f:
+			for line in f:
+				fields = line.split()
+				if len(fields) >= 2:
+					self.host_keys.add((fields[0], fields[1]))
+					if self.expected_key is None:
+						entry = paramiko.hostkeys.HostKeyEntry.from_line("* " + fields[0] + " " + fields[1])
+						self.expected_key = entry.key if entry else None
+
+	def missing_host_key(self, client, hostname, key):
+		if (key.get_name(), key.get_base64()) not in self.host_keys:
+			# Not an SSHException the caller falls back from, the VM is not who it should be
+			raise paramiko.BadHostKeyException(hostname, key, self.expected_key or key)
+
+# IPs of the VMs whose images were made by do_automate_setup -i, only these have to present a pinned host key
+pinned_hosts = set()
+pinned_hosts_lock = threading.Lock()
+
+def set_host_key_pinning(ips, pinned):
+	with pinned_hosts_lock:
+		for ip in ips:
+			if pinned:
+				pinned_hosts.add(ip)
+			else:
+				pinned_hosts.discard(ip)
+
+def is_host_key_pinned(ip):
+	with pinned_hosts_lock:
+		return ip in pinned_hosts
+
+class ssh_pool:
+	'''
+	Keeps authenticated SSH connections alive, keyed by (ip, username),
+	so that consecutive commands to the same VM reuse one transport
+	instead of doing a full handshake and auth every time.
+	'''
+	def __init__(self, keepalive = SSH_KEEPALIVE_INTERVAL):
+		self.keepalive = keepalive
+
+		self.connections = {}
+		self.key_locks = {}
+		self.lock = threading.Lock()
+
+		# Counters, to see how many handshakes the pool saves
+		self.hits = 0
+		self.misses = 0
+		self.reconnects = 0
+
+	def __key_lock(self, key):
+		with self.lock:
+			if key not in self.key_locks:
+				self.key_locks[key] = threading.Lock()
+			return self.key_locks[key]
+
+	def __is_alive(self, client):
+		transport = client.get_transport()
+		return transport is not None and transport.is_active()
+
+	def get_connection(self, ssh_machine, ssh_username, connect_func):
+		"""Returns a live connection for (ssh_machine, ssh_username).
+		:param connect_func: Called without arguments to establish a new connection on a miss.
+		returns connection Object
+		"""
+		key = (ssh_machine, ssh_username)
+
+		# Connecting to one VM should not block commands to the others
+		with self.__key_lock(key):
+			with self.lock:
+				client = self.connections.get(key)
+
+			if client is not None:
+				if self.__is_alive(client):
+					with self.lock:
+						self.hits += 1
+					return client
+
+				# Transport went away, most likely the VM rebooted
+				client.close()
+				with self.lock:
+					self.reconnects += 1
+
+			client = connect_func()
+			transport = client.get_transport()
+			if transport is not None and self.keepalive:
+				transport.set_keepalive(self.keepalive)
+
+			with self.lock:
+				self.misses += 1
+				self.connections[key] = client
+
+		return client
+
+	def drop(self, ssh_machine, ssh_username=None):
+		"""Closes and forgets the pooled connections to ssh_machine.
+		If ssh_username is None, connections of all users are dropped.
+		"""
+		with self.lock:
+			keys = [key for key in self.connections
+				if key[0] == ssh_machine and (ssh_username is None or key[1] == ssh_username)]
+			clients = [self.connections.pop(key) for key in keys]
+
+		for client in clients:
+			client.close()
+
+	def close_all(self):
+		with self.lock:
+			clients = list(self.connections.values())
+			self.connections = {}
+
+		for client in clients:
+			client.close()
+
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses, "reconnects": self.reconnects,
+				"open": len(self.connections)}
+
+# Shared by every SSH object, unless one is given its own pool
+shared_ssh_pool = ssh_pool()
+
 class SSH:
-	def __init__(self):
-		pass
+	def __init__(self, pool = None):
+		self.pool = pool if pool is not None else shared_ssh_pool
+
+	def __connect_with_key(self, ssh_machine, ssh_username, policy):
+		client = paramiko.SSHClient()
+		client.set_missing_host_key_policy(policy)
+		client.connect(hostname=ssh_machine, username=ssh_username, key_filename=GUEST_CLIENT_KEY,
+				look_for_keys=False, allow_agent=False, timeout=10)
+		# Images carrying our key also have passwordless sudo
+		client.da_key_auth = True
+		return client
 
 	def get_ssh_connection(self, ssh_machine, ssh_username, ssh_password):
 		"""Establishes a ssh connection to execute command.
+		VMs of images made by do_automate_setup -i must present a pinned host key and are
+		logged into with the key created along with it. Other images use password/agent login.
 		:param ssh_machine: IP of the machine to which SSH connection to be established.
 		:param ssh_username: User Name of the machine to which SSH connection to be established..
 		:param ssh_password: Password of the machine to which SSH connection to be established..
 		returns connection Object
 		"""
+		if is_host_key_pinned(ssh_machine) and os.path.exists(GUEST_CLIENT_KEY) and os.path.exists(GUEST_HOST_KEYS_FILE):
+			policy = pinned_host_key_policy(GUEST_HOST_KEYS_FILE)
+			try:
+				return self.__connect_with_key(ssh_machine, ssh_username, policy)
+			except paramiko.AuthenticationException:
+				# The host key was fine, but the image does not take our client key
+				pass
+		else:
+			policy = paramiko.AutoAddPolicy()
+
 		client = paramiko.SSHClient()
-		client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+		client.set_missing_host_key_policy(policy)
 		if ssh_password:
 			client.connect(hostname=ssh_machine, username=ssh_username, password=ssh_password, look_for_keys=False, allow_agent=False, timeout=10)
 		else:
 			client.connect(hostname=ssh_machine, username=ssh_username, allow_agent=True, timeout=10)
+		client.da_key_auth = False
 		return client
 
+	def get_pooled_connection(self, ssh_machine, ssh_username, ssh_password):
+		"""Same as get_ssh_connection, but reuses a live connection from the pool.
+		The returned connection must not be closed by the caller.
+		"""
+		return self.pool.get_connection(ssh_machine, ssh_username,
+				lambda: self.get_ssh_connection(ssh_machine, ssh_username, ssh_password))
+
+	def drop_connection(self, ssh_machine, ssh_username=None):
+		"""Forgets the pooled connection(s) to ssh_machine, e.g. after a shutdown."""
+		self.pool.drop(ssh_machine, ssh_username)
+
+	def __open_channel(self, ssh_username, ssh_password, ssh_machine):
+		conn = self.get_pooled_connection(ssh_machine, ssh_username, ssh_password)
+		try:
+			chan = conn.get_transport().open_session()
+		except (paramiko.SSHException, EOFError, OSError, AttributeError):
+			# The pooled transport looked alive but is not (VM rebooted under us).
+			# Reconnect once and retry.
+			self.pool.drop(ssh_machine, ssh_username)
+			conn = self.get_pooled_connection(ssh_machine, ssh_username, ssh_password)
+			chan = conn.get_transport().open_session()
+
+		return chan, conn.da_key_auth
+
+	def start_channel(self, ssh_username, ssh_password, ssh_machine, command, sudo=False):
+		"""Starts a command on a new channel of the pooled transport, without waiting for it.
+		:param sudo: Run the command through sudo, feeding the password if there is one.
+		returns the channel
+		"""
+		chan, key_auth = self.__open_channel(ssh_username, ssh_password, ssh_machine)
+
+		feed_password = False
+		if sudo and key_auth:
+			command = "sudo -n %s" % command
+		elif sudo:
+			command = "sudo -S -p '' %s" % command
+			feed_password = bool(ssh_password)
+
+		chan.exec_command(command)
+		if feed_password:
+			chan.sendall((ssh_password + "\n").encode())
+
+		return chan
+
+	def stream_command(self, ssh_username, ssh_password, ssh_machine, command="ls", sudo=False):
+		"""Executes a command over a established SSH connection, yielding its output as it arrives.
+		:param sudo: Run the command through sudo, feeding the password if there is one.
+		yields ("stdout", line) and ("stderr", line) tuples while the command runs,
+		and ("exit", exit code) once it is done.
+		"""
+		chan = self.start_channel(ssh_username, ssh_password, ssh_machine, command, sudo)
+		try:
+			pending = {"stdout": b"", "stderr": b""}
+			while True:
+				lines = read_channel_lines(chan, pending)
+				if lines is None:
+					break
+				if not lines:
+					select.select([chan], [], [], 0.1)
+
+				for stream_line in lines:
+					yield stream_line
+
+			yield "exit", chan.recv_exit_status()
+		finally:
+			chan.close()
+
+	def start_job(self, ssh_username, ssh_password, ssh_machine, command, sudo=False):
+		"""Starts a command in the background and returns an ssh_job handle for it.
+		Several jobs can run on the same VM at once over one transport.
+		"""
+		return ssh_job(self, ssh_username, ssh_password, ssh_machine, command, sudo)
+
+	def run_command_status(self, ssh_username, ssh_password, ssh_machine, command="ls", sudo=False):
+		"""Executes a command over a established SSH connection.
+		:param sudo: Run the command through sudo, feeding the password if there is one.
+		returns exit code of the command, and lists of its stdout and stderr lines.
+		"""
+		chan = self.start_channel(ssh_username, ssh_password, ssh_machine, command, sudo)
+		try:
+			stdoutput = [line for line in chan.makefile("r")]
+			stderroutput = [line for line in chan.makefile_stderr("r")]
+
+			return chan.recv_exit_status(), stdoutput, stderroutput
+		finally:
+			chan.close()
+
 	def run_command(self, ssh_username, ssh_password, ssh_machine, command="ls", jobid="None"):
 		"""Executes a command over a established SSH connectio.
 		:param ssh_machine: IP of the machine to which SSH connection to be established.
@@ -29,21 +405,14 @@ class SSH:
 		:param ssh_password: Password of the machine to which SSH connection to be established..
 		returns status of the command executed and Output of the command.
 		"""
-		conn = self.get_ssh_connection(ssh_machine=ssh_machine, ssh_username=ssh_username, ssh_password=ssh_password)
-
-		stdin, stdout, stderr = conn.exec_command(command=command)
-
-		stdoutput = [line for line in stdout]
-		stderroutput = [line for line in stderr]
+		exit_code, stdoutput, stderroutput = self.run_command_status(ssh_username, ssh_password, ssh_machine, command)
 
         # Check exit code.
-		if not stdout.channel.recv_exit_status():
-			conn.close()
+		if not exit_code:
 			if not stdoutput:
 				stdoutput = True
 			return True, stdoutput
 		else:
-			conn.close()
 			return False, stderroutput
 
 	def run_sudo_command(self, ssh_username, ssh_password, ssh_machine, command="ls", jobid="None"):
@@ -53,23 +422,53 @@ class SSH:
 		:param ssh_password: Password of the machine to which SSH connection to be established..
 		returns status of the command executed and Output of the command.
 		"""
-		conn = self.get_ssh_connection(ssh_machine=ssh_machine, ssh_username=ssh_username, ssh_password=ssh_password)
-		command = "sudo -S -p '' %s" % command
-
-		stdin, stdout, stderr = conn.exec_command(command=command)
-		if ssh_password:
-			stdin.write(ssh_password + "\n")
-			stdin.flush()
-
-		stdoutput = [line for line in stdout]
-		stderroutput = [line for line in stderr]
+		exit_code, stdoutput, stderroutput = self.run_command_status(ssh_username, ssh_password, ssh_machine, command, sudo=True)
 
         # Check exit code.
-		if not stdout.channel.recv_exit_status():
-			conn.close()
+		if not exit_code:
 			if not stdoutput:
 				stdoutput = True
 			return True, stdoutput
 		else:
-			conn.close()
 			return False, stderroutput
+
+	def __parse_batch_output(self, commands, stdoutput):
+		results = []
+		lines = [line.rstrip("\n") for line in stdoutput]
+		i = 0
+		while i < len(lines):
+			fields = lines[i].split(" ")
+			if fields[0] != BATCH_STEP_MARKER or len(fields) != 4 or i + 2 >= len(lines):
+				i += 1
+				continue
+
+			step = int(fields[1])
+			results.append({"command": commands[step],
+					"exit_code": int(fields[2]),
+					"stdout": base64.b64decode(lines[i + 1]).decode(errors="replace"),
+					"stderr": base64.b64decode(lines[i + 2]).decode(errors="replace"),
+					"duration": int(fields[3]) / 1e9})
+			i += 3
+
+		return results
+
+	def run_batch(self, ssh_username, ssh_password, ssh_machine, commands, sudo=False):
+		"""Executes an ordered list of commands as one remote script, in one round trip.
+		Execution stops at the first failing command.
+		:param commands: List of shell commands.
+		:param sudo: Run the whole script through sudo.
+		returns status, a list with one result dict per executed command
+		(command, exit_code, stdout, stderr, duration in seconds),
+		and the stderr lines of the script itself.
+		"""
+		script = batch_script_head
+		for i in range(len(commands)):
+			script += "step {i} {command} || exit $?\n".format(i = i, command = shlex.quote(commands[i]))
+
+		command = "bash -c %s" % shlex.quote(script)
+		exit_code, stdoutput, stderroutput = self.run_command_status(ssh_username, ssh_password, ssh_machine, command, sudo)
+
+		results = self.__parse_batch_output(commands, stdoutput)
+		status = not exit_code and len(results) == len(commands)
+
+		return status, results, stderroutput
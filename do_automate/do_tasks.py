@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+'''
+Runs the steps of a do_qemu run as a graph of tasks.
+A task starts as soon as the tasks it depends on are done and the resources
+it needs are free, so independent work (e.g. building the kernel of one VM
+class while the VMs of another one boot) overlaps. A task whose dependency
+failed is skipped.
+At the end, the chain of tasks which decided the total run time (the
+critical path) is logged.
+'''
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from do_automate.globals import *
+from do_automate.do_trace import span
+from do_automate.do_wait import cancel_waits
+
+TASK_PENDING = "pending"
+TASK_RUNNING = "running"
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+TASK_SKIPPED = "skipped"
+
+class da_task:
+	def __init__(self, name, func, deps, resources):
+		self.name = name
+		self.func = func
+		self.deps = deps
+		self.resources = resources
+
+		self.state = TASK_PENDING
+		self.error = ""
+		self.start = None
+		self.end = None
+
+	def duration(self):
+		if self.start is None or self.end is None:
+			return 0
+		return self.end - self.start
+
+class da_task_graph:
+	def __init__(self, log_obj, resources = None, max_workers = DEFAULT_PARALLEL_JOBS):
+		'''
+		resources is a dict of resource name -> amount available, e.g. {"build": 1}.
+		A task needing a resource not in there is not limited by it.
+		'''
+		self.log_obj = log_obj
+		self.available = dict(resources or {})
+		self.max_workers = max(1, int(max_workers))
+
+		# In the order added
+		self.tasks = {}
+		self.start = None
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def add(self, name, func, deps = [], resources = {}):
+		'''
+		Adds the task name, which calls func(). func returns something truthy on success.
+		deps are the names of tasks (added before) which have to succeed first.
+		'''
+		for dep in deps:
+			if dep not in self.tasks:
+				raise ValueError("Task {name} depends on unknown task {dep}".format(name = name, dep = dep))
+
+		self.tasks[name] = da_task(name, func, list(deps), dict(resources))
+		return name
+
+	def __run_one(self, task):
+		with span(task.name):
+			try:
+				ok = bool(task.func())
+				error = "" if ok else "returned failure"
+			except Exception as e:
+				ok = False
+				error = "Exception occurred: " + repr(e)
+		return ok, error
+
+	def __fits(self, task):
+		return all(self.available.get(name, amount) >= amount for name, amount in task.resources.items())
+
+	def __take(self, task, sign):
+		for name, amount in task.resources.items():
+			if name in self.available:
+				self.available[name] -= sign * amount
+
+	def __next_ready(self):
+		for task in self.tasks.values():
+			if task.state != TASK_PENDING:
+				continue
+
+			dep_states = [self.tasks[dep].state for dep in task.deps]
+			if any(state in (TASK_FAILED, TASK_SKIPPED) for state in dep_states):
+				task.state = TASK_SKIPPED
+				self.__log(INFO, "Skipping {name}, a task it needs failed".format(name = task.name))
+				# Its dependents may be skipped now too
+				return self.__next_ready()
+
+			if all(state == TASK_DONE for state in dep_states) and self.__fits(task):
+				return task
+
+		return None
+
+	def run(self):
+		'''
+		Runs all tasks.
+		returns True if all of them succeeded
+		'''
+		self.start = time.time()
+		running = {}
+
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			try:
+				while True:
+					while len(running) < self.max_workers:
+						task = self.__next_ready()
+						if task is None:
+							break
+
+						self.__take(task, 1)
+						task.state = TASK_RUNNING
+						task.start = time.time()
+						self.__log(DEBUG, "Starting {name}".format(name = task.name))
+						running[executor.submit(self.__run_one, task)] = task
+
+					if not running:
+						break
+
+					done, _ = wait(running, return_when=FIRST_COMPLETED)
+					for future in done:
+						task = running.pop(future)
+						task.end = time.time()
+						self.__take(task, -1)
+
+						ok, task.error = future.result()
+						task.state = TASK_DONE if ok else TASK_FAILED
+						if not ok:
+							self.__log(ERROR, "{name} failed after {secs:.1f}s: {err}".format(name = task.name,
+									secs = task.duration(), err = task.error))
+						else:
+							self.__log(DEBUG, "{name} done after {secs:.1f}s".format(name = task.name, secs = task.duration()))
+			except KeyboardInterrupt:
+				# Get the workers out of their waits, so that the executor can shut down
+				cancel_waits()
+				for future in running:
+					future.cancel()
+				raise
+
+		# Left over when they need more of a resource than there is
+		for task in self.tasks.values():
+			if task.state == TASK_PENDING:
+				task.state = TASK_SKIPPED
+				self.__log(ERROR, "{name} never got the resources it needs: ".format(name = task.name), task.resources)
+
+		return all(task.state == TASK_DONE for task in self.tasks.values())
+
+	def critical_path(self):
+		'''
+		returns the tasks which decided the run time, first to last.
+		Going back from the task which finished last, each step is the dependency which finished
+		last, as that is the one the task had to wait for.
+		'''
+		finished = [task for task in self.tasks.values() if task.end is not None]
+		if not finished:
+			return []
+
+		path = [max(finished, key = lambda task: task.end)]
+		while True:
+			deps = [self.tasks[dep] for dep in path[-1].deps if self.tasks[dep].end is not None]
+			if not deps:
+				break
+			path.append(max(deps, key = lambda task: task.end))
+
+		return list(reversed(path))
+
+	def log_report(self):
+		for task in self.tasks.values():
+			self.__log(INFO, "{name}: {state} ({secs:.1f}s)".format(name = task.name, state = task.state, secs = task.duration()))
+
+		path = self.critical_path()
+		if not path:
+			return
+
+		total = path[-1].end - self.start
+		self.__log(0, "Critical path ({secs:.1f}s in total):".format(secs = total))
+		previous_end = self.start
+		for task in path:
+			# Time spent waiting for a resource shows up as a gap before the task
+			waited = task.start - previous_end
+			self.__log(0, "  {name}: {secs:.1f}s{wait}".format(name = task.name, secs = task.duration(),
+					wait = ", after waiting {w:.1f}s for resources".format(w = waited) if waited >= 0.1 else ""))
+			previous_end = task.end
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
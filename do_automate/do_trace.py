@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+'''
+Timing spans for the phases of a run.
+The spans are saved in the trace event format, which can be opened in
+chrome://tracing or https://ui.perfetto.dev
+Spans tagged with a VM uuid get their own lane, so the phases of different
+VMs can be compared side by side.
+'''
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+class tracer:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.events = []
+		self.lanes = {}
+		self.start = time.perf_counter()
+
+	def __now_us(self):
+		return (time.perf_counter() - self.start) * 1000000
+
+	def __lane(self, uuid):
+		# One lane per VM uuid, otherwise one lane per thread
+		if uuid is not None:
+			key = "VM " + str(uuid)
+		else:
+			key = threading.current_thread().name
+
+		with self.lock:
+			if key not in self.lanes:
+				self.lanes[key] = len(self.lanes) + 1
+				self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(),
+						"tid": self.lanes[key], "args": {"name": key}})
+			return self.lanes[key]
+
+	@contextmanager
+	def span(self, name, uuid = None, **args):
+		'''
+		Times the with block as one span named name.
+		The extra keyword arguments are shown with the span in the viewer.
+		'''
+		tid = self.__lane(uuid)
+		begin = self.__now_us()
+		try:
+			yield
+		finally:
+			event = {"name": name, "ph": "X", "ts": begin, "dur": self.__now_us() - begin,
+					"pid": os.getpid(), "tid": tid, "args": dict(args)}
+			if uuid is not None:
+				event["args"]["uuid"] = str(uuid)
+
+			with self.lock:
+				self.events.append(event)
+
+	def has_spans(self):
+		with self.lock:
+			return any(event["ph"] == "X" for event in self.events)
+
+	def save(self, trace_file):
+		'''
+		Writes all spans recorded till now to trace_file.
+		returns True on success
+		'''
+		with self.lock:
+			trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+		try:
+			with open(trace_file, 'w') as f:
+				json.dump(trace, f)
+		except OSError:
+			return False
+
+		return True
+
+# One tracer per run, shared by all the classes
+shared_tracer = tracer()
+
+def span(name, uuid = None, **args):
+	return shared_tracer.span(name, uuid, **args)
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
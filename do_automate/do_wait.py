@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+'''
+Waiting for things to happen.
+Every wait has a deadline. The condition is checked right away, then again
+after delays which grow exponentially (with some jitter, so that many VMs
+waited on in parallel do not check in lock step) up to a maximum.
+All waits can be cancelled at once with cancel_waits(), e.g. on Ctrl-C.
+'''
+
+import time
+import random
+import threading
+
+from do_automate.globals import *
+
+# Delay before the second check of a condition, in seconds
+WAIT_FIRST_DELAY = 0.05
+
+# Delays between checks never grow beyond this, in seconds
+WAIT_MAX_DELAY = 2
+
+WAIT_BACKOFF_FACTOR = 2
+
+# The delays are varied randomly by up to this fraction
+WAIT_JITTER = 0.2
+
+# Set to cancel all running and future waits
+wait_cancelled = threading.Event()
+
+def cancel_waits():
+	wait_cancelled.set()
+
+class da_wait:
+	def __init__(self, log_obj, cancel_event = wait_cancelled):
+		self.log_obj = log_obj
+		self.cancel_event = cancel_event
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def until(self, what, condition, timeout, first_delay = WAIT_FIRST_DELAY, max_delay = WAIT_MAX_DELAY):
+		'''
+		Calls condition() till it returns something truthy, or till timeout seconds are over.
+		what describes the wait for the log.
+		returns the value returned by condition(), None on timeout or cancel
+		'''
+		start = time.monotonic()
+		deadline = start + timeout
+		delay = first_delay
+		checks = 0
+
+		while True:
+			checks += 1
+			value = condition()
+			if value:
+				self.__log(DEBUG, "{what}: ready after {secs:.2f}s, {checks} checks".format(what = what,
+						secs = time.monotonic() - start, checks = checks))
+				return value
+
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				self.__log(ERROR, "Timed out after {secs:g}s waiting for {what}".format(secs = timeout, what = what))
+				return None
+
+			sleep_for = min(delay * random.uniform(1 - WAIT_JITTER, 1 + WAIT_JITTER), remaining)
+			if self.cancel_event.wait(sleep_for):
+				self.__log(INFO, "Cancelled waiting for {what}".format(what = what))
+				return None
+
+			delay = min(delay * WAIT_BACKOFF_FACTOR, max_delay)
+
+	def sleep(self, seconds):
+		'''
+		Sleeps, unless cancelled.
+		returns False if cancelled
+		'''
+		return not self.cancel_event.wait(seconds)
+
+if __name__ == "__main__":
+	print("Do not call me directly, I am an introvert!")
@@ -3,6 +3,10 @@
 from os import getcwd,environ
 from os.path import expanduser,isdir
 from datetime import datetime
+import copy
+import queue
+import atexit
+import threading
 
 DEFAULT_DATA_FOLDER_NAME = "do_automate_data"
 
@@ -26,6 +30,43 @@ IMGS_FODLER = default_data_path + "/vm_imgs/"
 # Path defaults
 PIPES_FOLDER = default_data_path + "/vm_pipes/"
 
+# Monitor and QMP unix sockets of the VMs
+MONITORS_FOLDER = default_data_path + "vm_monitors/"
+
+# Console output of the VMs, one rotating log per VM uuid
+CONSOLE_LOGS_FOLDER = default_data_path + "vm_consoles/"
+CONSOLE_LOG_MAX_BYTES = 10 * 1024 * 1024
+CONSOLE_LOG_BACKUPS = 3
+
+# Mirrors of the kernel git urls, one per url
+KERNEL_MIRRORS_FOLDER = default_data_path + "kernel_mirrors/"
+
+# Worktrees of the mirrors, one per url and ref
+KERNEL_SOURCES_FOLDER = default_data_path + "kernel_sources/"
+
+# Kernel builds, one per kernel tree (or per .config, for cloned trees)
+KERNEL_BUILDS_FOLDER = default_data_path + "kernel_builds/"
+
+# Built kernels (bzImage and modules), reused while the tree and .config do not change
+BUILD_CACHE_FOLDER = default_data_path + "build_cache/"
+BUILD_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+# Built out of tree modules, reused while the module source and the kernel build do not change
+MODULE_CACHE_FOLDER = default_data_path + "module_cache/"
+MODULE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# ccache objects of the kernel and module builds, size as ccache takes it
+CCACHE_FOLDER = default_data_path + "ccache/"
+CCACHE_MAX_SIZE = "20G"
+
+# Keys created by "do_automate_setup -i" and baked into the image.
+# The client key logs into the VMs, the host keys file pins the keys the VMs present.
+KEYS_FOLDER = default_data_path + "/keys/"
+GUEST_CLIENT_KEY = KEYS_FOLDER + "id_ed25519"
+GUEST_HOST_KEYS_FILE = KEYS_FOLDER + "guest_host_keys"
+# Next to each image made by "do_automate_setup -i": <image>.da_keys. VMs of such images must present a pinned host key.
+GUEST_IMAGE_MARKER_SUFFIX = ".da_keys"
+
 # Log related
 ERROR = 1
 INFO = 2
@@ -40,28 +81,146 @@ log_dict = {
 # CONST
 NUM_OF_ETH_INT = 2
 
-# Dynamic delay multiplier, used for heavy/slow VMs
-vm_comm_delay_mult = 1
+# Returncode of a local command which ran into its timeout, same as timeout(1)
+LOCAL_TIMEOUT_RETURNCODE = 124
+
+# Default number of VMs handled at once by "-C" commands
+DEFAULT_PARALLEL_JOBS = 8
+
+# Seconds to wait for the IPs of freshly started VMs
+IP_DISCOVERY_TIMEOUT = 500
+
+# Reserved addressing: host number of a VM IP in the bridge subnet is this
+# plus the last octet of its mac address
+RESERVED_IP_OFFSET = 100
+
+# Seconds to wait for qemu to create the QMP socket of a new VM
+QMP_SOCKET_TIMEOUT = 10
+
+# Seconds a guest gets to shut down after the power button press over QMP
+QMP_POWERDOWN_TIMEOUT = 60
+
+# Phase deadlines, in seconds
+# VM answering pings after it got its IP
+VM_NETWORK_TIMEOUT = 150
+# VM going down after the reboot command was sent over ssh
+VM_REBOOT_DOWN_TIMEOUT = 60
+# VM going down after the reboot command over ssh failed, it may have gone down before answering
+VM_REBOOT_NO_ANSWER_TIMEOUT = 10
+# Login prompt showing up on the serial console
+PIPE_LOGIN_TIMEOUT = 300
+# Password prompt and shell showing up on the serial console, after the login prompt
+PIPE_PROMPT_TIMEOUT = 30
+
+# Records waiting to be written to the log file
+LOG_QUEUE_SIZE = 10000
+
+# Seconds log() waits for room in a full queue, before an INFO or DEBUG record is dropped.
+# ERROR records wait as long as it takes.
+LOG_QUEUE_TIMEOUT = 1
+
+# Longest message written, the start is cut off
+LOG_MAX_MESSAGE = 2000
 
 class do_automate_log:
+	'''
+	log() prints to the console right away (when the level says so),
+	and queues the record for the log file. A background thread formats the
+	queued records and writes them through a single open file handle.
+	Extra arguments to log() are only turned into strings when the record
+	is actually printed or written. Dicts, lists and sets are copied when
+	queued, as callers may change them afterwards.
+	When the writer falls behind by LOG_QUEUE_SIZE records, log() waits for
+	room; only INFO and DEBUG records are dropped (and counted), and only
+	after LOG_QUEUE_TIMEOUT seconds.
+	'''
 	def __init__(self, log_file, log_level):
 		# Set up log stuff
 		self.local_log_file = log_file
 		self.log_level = log_level
 
-	def log(self, log_level, log_str):
-		# Limit logging to 2000 characters
-		log_str = ("..." + log_str[-2000:]) if len(log_str) > 2000 else log_str
+		self.log_file = open(self.local_log_file, 'a')
+		self.records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+		self.dropped = 0
+		self.dropped_lock = threading.Lock()
+
+		self.writer = threading.Thread(target=self.__write_records, daemon=True)
+		self.writer.start()
+		atexit.register(self.close)
 
+	def __format(self, log_str, args):
+		for arg in args:
+			try:
+				log_str += str(arg) + " "
+			except Exception as e:
+				log_str += "<unprintable {type}: {err!r}> ".format(type = type(arg).__name__, err = e)
+
+		# Limit logging to 2000 characters
+		return ("..." + log_str[-LOG_MAX_MESSAGE:]) if len(log_str) > LOG_MAX_MESSAGE else log_str
+
+	def __snapshot(self, arg):
+		# The containers callers change in place, the rest is left as it is
+		if not isinstance(arg, (dict, list, set)):
+			return arg
+		try:
+			return copy.deepcopy(arg)
+		except Exception:
+			return self.__format("", [arg])
+
+	def __write_records(self):
+		while True:
+			record = self.records.get()
+			if record is None:
+				break
+
+			timestamp, log_str, args = record
+			try:
+				self.log_file.write(timestamp.strftime('%Y-%m-%d\t%H:%M:%S\t').expandtabs(4) + self.__format(log_str, args) + "\n")
+
+				with self.dropped_lock:
+					dropped, self.dropped = self.dropped, 0
+				if dropped:
+					self.log_file.write("{count} log records dropped, the log file could not keep up\n".format(count = dropped))
+
+				# Keep the file current whenever we catch up
+				if self.records.empty():
+					self.log_file.flush()
+			except Exception:
+				# E.g. the disk is full. Losing a record is better than a writer which stops draining.
+				pass
+
+		try:
+			self.log_file.flush()
+		except Exception:
+			pass
+
+	def log(self, log_level, log_str, *args):
 		# Write to console
 		if self.log_level >= log_level:
+			log_str = self.__format(log_str, args)
 			print(log_str)
+			# Formatted already, the file gets the same text
+			args = ()
+		else:
+			args = tuple(self.__snapshot(arg) for arg in args)
 
 		# Write to log file
-		log_str = datetime.now().strftime('%Y-%m-%d\t%H:%M:%S\t').expandtabs(4) + log_str
-		log_str += "\n"
-		with open(self.local_log_file, 'a') as log_file:
-			log_file.write(log_str)
+		record = (datetime.now(), log_str, args)
+		if log_level <= ERROR:
+			self.records.put(record)
+			return
+
+		try:
+			self.records.put(record, timeout=LOG_QUEUE_TIMEOUT)
+		except queue.Full:
+			with self.dropped_lock:
+				self.dropped += 1
+
+	def close(self):
+		if self.writer.is_alive():
+			self.records.put(None)
+			self.writer.join()
+		self.log_file.close()
 
 
 
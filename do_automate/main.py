@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
+import re
 import sys
 import json
 import subprocess
-import os.path
+import os
+import atexit
 from datetime import datetime
 from getpass import getpass
 from argparse import ArgumentParser, SUPPRESS, RawTextHelpFormatter
@@ -13,6 +15,12 @@ from do_automate.globals import *
 from do_automate.util import *
 from do_automate.do_qemu import auto_qemu
 from do_automate.vm_classes import da_vm_class
+from do_automate.do_ssh import shared_ssh_pool
+from do_automate.do_trace import shared_tracer
+from do_automate.do_addressing import ADDRESSING_MODES
+from do_automate.do_console_log import console_logs
+from do_automate.do_build_cache import da_build_cache
+from do_automate.do_tasks import da_task_graph
 #from do_automate.vm_classes import server
 
 # Globals
@@ -27,9 +35,9 @@ VM_SHARE_FOLDER = default_data_path + "/vm_share/"
 # This is only used when VMs are spin up from this main file
 SHARED_9P_TAG = "host0"
 
-def run_command_local(command):
+def run_command_local(argv):
 	try:
-		s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
+		s = subprocess.check_output(argv, stderr=subprocess.DEVNULL).decode('utf-8')
 		returncode = 0
 	except subprocess.CalledProcessError as e:
 		s = e.output
@@ -39,7 +47,7 @@ def run_command_local(command):
 	return returncode, s
 
 def get_host_password(log_obj):
-	ret, s = run_command_local("sudo -n true")
+	ret, s = run_command_local(["sudo", "-n", "true"])
 	if ret:
 		log_obj.log(0, 'Enter host password')
 		host_password = getpass()
@@ -68,6 +76,20 @@ def define_args():
 				help="send a command to VM. Option: shutdown, reboot.\n"
 				"Example: ./do_qemu -C reboot 192.168.22.1,192.168.22.2..\n")
 
+	req_arg.add_argument("-L", "--console-log", nargs='+',
+				help="search or tail the console logs of the VMs.\n"
+				"Options: grep PATTERN [VM], tail [LINES] [VM]\n"
+				"VM is a uuid (or its start), VM name or IP. Default: all VMs\n"
+				"Example: ./do_qemu -L grep 'Call Trace' 192.168.22.1\n")
+
+	req_arg.add_argument("-B", "--build-cache", nargs='*',
+				help="show or clean the cache of built kernels.\n"
+				"Options: list (default), remove KEY, remove all\n")
+
+	req_arg.add_argument("-j", "--jobs", type=int, default=DEFAULT_PARALLEL_JOBS,
+				help="number of VMs to send the command (-C) to at once.\n"
+				"Default: {jobs}\n".format(jobs = DEFAULT_PARALLEL_JOBS))
+
 	req_arg.add_argument("-u", "--username", help="username of the VM\n")
 	req_arg.add_argument("-p", "--password", help="password of the VM\n")
 
@@ -114,6 +136,13 @@ def check_and_set_def_values(config_dict):
 			print("Wrong mode {}, the possible values are \"snapshot\" or \"persistent\"".format(config_dict["mode"]))
 			raise SystemExit
 
+	# if not set then let DHCP pick the IPs
+	if "addressing" not in config_dict.keys():
+		config_dict["addressing"] = "dhcp"
+	elif config_dict["addressing"] not in ADDRESSING_MODES:
+		print("Wrong addressing {}, the possible values are {}".format(config_dict["addressing"], ADDRESSING_MODES))
+		raise SystemExit
+
 	return
 
 def parse_config_file(config_file):
@@ -140,49 +169,29 @@ def parse_config_file(config_file):
 
 	return server_dict, storage_dict
 
-def create_log_folder():
-	command = "mkdir -p {folder}".format(folder = LOCAL_LOG_FOLDER)
+def create_folder(folder):
 	try:
-		s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
-		returncode = 0
-	except subprocess.CalledProcessError as e:
-		print("create_log_folder() failed!")
+		os.makedirs(folder, exist_ok=True)
+	except OSError as e:
+		print("Creating folder {folder} failed: {err}".format(folder = folder, err = e))
 		return False
 
 	return True
 
-def create_pipes_folder():
-	command = "mkdir -p {folder}".format(folder = PIPES_FOLDER)
-	try:
-		s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
-		returncode = 0
-	except subprocess.CalledProcessError as e:
-		print("create_pipes_folder() failed!")
-		return False
+def create_log_folder():
+	return create_folder(LOCAL_LOG_FOLDER)
 
-	return True
+def create_pipes_folder():
+	return create_folder(PIPES_FOLDER)
 
 def create_monitor_folder():
-	command = "mkdir -p {folder}".format(folder = default_data_path + "vm_monitors/")
-	try:
-		s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
-		returncode = 0
-	except subprocess.CalledProcessError as e:
-		print("create_monitor_folder() failed!")
-		return False
+	return create_folder(MONITORS_FOLDER)
 
-	return True
+def create_console_logs_folder():
+	return create_folder(CONSOLE_LOGS_FOLDER)
 
 def create_img_folder():
-	command = "mkdir -p {folder}".format(folder=IMGS_FODLER)
-	try:
-		s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
-		returncode = 0
-	except subprocess.CalledProcessError as e:
-		print("create_img_folder() failed!")
-		return False
-
-	return True
+	return create_folder(IMGS_FODLER)
 
 def create_log_object(log_level):
 	# Create the log file
@@ -217,6 +226,108 @@ def create_log_obj_from_config_file(config_file):
 
 	return log_obj
 
+def close_ssh_pool(log_obj):
+	stats = shared_ssh_pool.stats()
+	log_obj.log(INFO, "SSH connection pool: {hits} reused, {misses} new connections, {reconnects} reconnects".format(
+			hits = stats["hits"], misses = stats["misses"], reconnects = stats["reconnects"]))
+	shared_ssh_pool.close_all()
+
+def save_trace(log_obj):
+	if not shared_tracer.has_spans():
+		return
+
+	trace_file = LOCAL_LOG_FOLDER + "trace_" + datetime.now().strftime('%Y-%m-%d_%H:%M:%S') + ".json"
+	if shared_tracer.save(trace_file):
+		log_obj.log(INFO, "Phase timings saved to {trace}, open it in chrome://tracing or ui.perfetto.dev".format(trace = trace_file))
+	else:
+		log_obj.log(ERROR, "Saving phase timings to {trace} failed".format(trace = trace_file))
+
+def console_log_uuids(log_obj, logs, vm):
+	'''
+	returns the uuids of the VMs whose console logs are asked for
+	'''
+	all_uuids = logs.all_uuids()
+	if vm is None:
+		return all_uuids
+
+	# Logs are kept after the VM is gone, so the uuid itself need not be in vm_details
+	uuids = [vm_uuid for vm_uuid in all_uuids if vm_uuid.startswith(vm)]
+	if uuids:
+		return uuids
+
+	vm_dict = da_get(log_obj, da_command(log_obj)).read_vm_details_json()
+	if vm_dict is None:
+		log_obj.log(ERROR, "Reading the VM details failed, cannot look up {vm}".format(vm = vm))
+		return []
+
+	for vm_uuid, vm_details in vm_dict.items():
+		if vm in vm_details.get("ips", []) or vm_details.get("vm_name") == vm:
+			uuids.append(vm_uuid)
+
+	return uuids
+
+def show_console_log(log_obj, options):
+	logs = console_logs(CONSOLE_LOGS_FOLDER)
+	action = options[0]
+
+	if action == "grep":
+		if len(options) < 2:
+			log_obj.log(0, "grep needs a pattern")
+			return False
+		pattern = options[1]
+		vm = options[2] if len(options) > 2 else None
+	elif action == "tail":
+		lines = 20
+		vm = None
+		for option in options[1:]:
+			if option.isdigit():
+				lines = int(option)
+			else:
+				vm = option
+	else:
+		log_obj.log(0, "Unknown console log option {opt}".format(opt = action))
+		return False
+
+	uuids = console_log_uuids(log_obj, logs, vm)
+	if not uuids:
+		log_obj.log(0, "No console log found")
+		return False
+
+	try:
+		for vm_uuid in uuids:
+			if action == "grep":
+				found = logs.grep(pattern, vm_uuid)
+			else:
+				found = logs.tail(lines, vm_uuid)
+
+			for line in found:
+				print(vm_uuid[:8], line)
+	except re.error as e:
+		log_obj.log(0, "Bad pattern {pat}: {err}".format(pat = pattern, err = e))
+		return False
+
+	return True
+
+def manage_build_cache(log_obj, options):
+	cache_obj = da_build_cache(log_obj)
+
+	module_cache_obj = da_build_cache(log_obj, MODULE_CACHE_FOLDER, MODULE_CACHE_MAX_BYTES)
+
+	if not options or options[0] == "list":
+		print("Kernels:")
+		cache_obj.print_entries()
+		print("\nModules:")
+		module_cache_obj.print_entries()
+		return True
+
+	if options[0] == "remove" and len(options) > 1:
+		removed = cache_obj.remove(options[1]) + module_cache_obj.remove(options[1])
+		log_obj.log(0, "Removed {num} cached builds".format(num = removed))
+		return removed > 0
+
+	log_obj.log(0, "Unknown build cache option {opt}".format(opt = " ".join(options)))
+	return False
+
 def check_build_options(args):
 	if not args.build:
 		args.build = "all"
@@ -226,6 +337,43 @@ def check_build_options(args):
 
 	return True
 
+def start_vm_classes(log_obj, class_dicts, build_option, host_password):
+	'''
+	Starts the VMs of all classes, as a graph of tasks. The steps of one class run in order,
+	the steps of different classes overlap, e.g. one class boots while the kernel of the next is built.
+	Builds use all the CPUs, so only one runs at a time.
+	returns dict of class -> IPs of its VMs, False on failure
+	'''
+	graph = da_task_graph(log_obj, resources = {"build": 1})
+	all_ips = {}
+
+	for vm_dict in class_dicts:
+		if int(vm_dict['num_of_vm']) <= 0:
+			continue
+
+		vm_class = vm_dict["type"]
+		# One object per class, they run at the same time
+		vm_obj = da_vm_class(log_obj)
+
+		def configure(vm_obj = vm_obj, vm_class = vm_class):
+			all_ips[vm_class] = vm_obj.configure()
+			return all_ips[vm_class]
+
+		params = graph.add(vm_class + ": params", lambda vm_obj = vm_obj, vm_dict = vm_dict: vm_obj.set_vm_params(vm_dict, build_option))
+		prepare = graph.add(vm_class + ": host check", lambda vm_obj = vm_obj: vm_obj.prepare(host_password), deps = [params])
+		kernel = graph.add(vm_class + ": kernel", vm_obj.build_kernel, deps = [prepare], resources = {"build": 1})
+		modules = graph.add(vm_class + ": modules", vm_obj.build_modules, deps = [kernel], resources = {"build": 1})
+		boot = graph.add(vm_class + ": boot", vm_obj.launch, deps = [modules])
+		graph.add(vm_class + ": configure", configure, deps = [boot])
+
+	ok = graph.run()
+	graph.log_report()
+	if not ok:
+		log_obj.log(ERROR, "Starting the VMs failed")
+		return False
+
+	return all_ips
+
 def main():
 	parser = define_args()
 
@@ -252,6 +400,10 @@ def main():
 		print("Create img copy folders failed")
 		raise SystemExit
 
+	if not create_console_logs_folder():
+		print("Creating console logs folder failed")
+		raise SystemExit
+
 	args = parse_arguments(parser)
 
 	if args.config_file:
@@ -263,6 +415,9 @@ def main():
 			print("Error creating log object")
 			raise SystemExit
 
+		# Save the phase timings however the run ends
+		atexit.register(save_trace, log_obj)
+
 		server_dict, storage_dict = parse_config_file(args.config_file)
 		if not server_dict:
 			log_obj.log(ERROR, "Error parsing config file")
@@ -279,37 +434,16 @@ def main():
 		# If sudo requires password, ask for it
 		host_password = get_host_password(log_obj)
 
-		server_ips = ""
-		storage_ips = ""
+		all_ips = start_vm_classes(log_obj, [server_dict, storage_dict], args.build, host_password)
+		if all_ips is False:
+			raise SystemExit(1)
 
-		my_vm_obj = da_vm_class(log_obj)
+		if all_ips.get("server"):
+			log_obj.log(0, "Server VM IPs: {ips}".format(ips = all_ips["server"]))
+		if all_ips.get("storage"):
+			log_obj.log(0, "Storage VM IPs: {ips}".format(ips = all_ips["storage"]))
 
-		if int(server_dict['num_of_vm']) > 0:
-			# Start server VM
-			if not my_vm_obj.set_vm_params(server_dict, args.build):
-				log_obj.log(ERROR, "set_vm_params() for server failed")
-				raise SystemExit
-			ret = my_vm_obj.start_auto(host_password)
-			if not ret:
-				log_obj.log(ERROR, "Server VM Init failed")
-				raise SystemExit
-			server_ips = ret
-
-		if int(storage_dict['num_of_vm']) > 0:
-			# Start storage VM
-			if not my_vm_obj.set_vm_params(storage_dict, args.build):
-				log_obj.log(ERROR, "set_vm_params() for storage failed")
-				raise SystemExit
-			ret = my_vm_obj.start_auto(host_password)
-			if not ret:
-				log_obj.log(ERROR, "Storage VM Init failed")
-				raise SystemExit
-			storage_ips = ret
-
-		if server_ips:
-			log_obj.log(0, "Server VM IPs: {ips}".format(ips = server_ips))
-		if storage_ips:
-			log_obj.log(0, "Storage VM IPs: {ips}".format(ips = storage_ips))
+		close_ssh_pool(log_obj)
 
 		# Done
 		raise SystemExit
@@ -330,15 +464,24 @@ def main():
 
 		raise SystemExit
 
+	if args.build_cache is not None:
+		if not manage_build_cache(log_obj, args.build_cache):
+			raise SystemExit(1)
+		raise SystemExit
+
+	if args.console_log:
+		if not show_console_log(log_obj, args.console_log):
+			raise SystemExit(1)
+		raise SystemExit
+
 	if args.command is not None:
 		# Just sending commands to already running VMs
 
-		my_vm_obj = da_vm_class(log_obj)
 		command = args.command[0]
 		if command == "shutdown":
-			my_func = my_vm_obj.shutdown_vm
+			my_func = da_vm_class.shutdown_vm
 		elif command == "reboot":
-			my_func = my_vm_obj.reboot_vm
+			my_func = da_vm_class.reboot_vm
 		else:
 			log_obj.log(0, "Unknown command {comm}".format(comm = command))
 			raise SystemExit
@@ -347,10 +490,31 @@ def main():
 		# Needed when IP is down and pipe console is to be used
 		host_password = get_host_password(log_obj)
 
+		dac_obj = da_command(log_obj)
+		dau_obj = da_util(log_obj, dac_obj)
+		vm_dict = dau_obj.read_and_update_vm_dict()
+		if vm_dict is False:
+			log_obj.log(ERROR, "read_and_update_vm_dict() failed")
+			raise SystemExit(1)
+
 		vm_ips = args.command[1].split(",")
-		for ip in vm_ips:
-			if not my_func(ip, args.username, args.password, host_password):
-				log_obj.log(ERROR, "{function} failed for ip {ip}".format(function = my_func.__name__, ip = ip))
+		if "all" in vm_ips or "a" in vm_ips:
+			vm_ips = [vm_details["ips"][0] for vm_details in vm_dict.values()]
+			if not vm_ips:
+				log_obj.log(0, "No running VM found")
+				raise SystemExit
+
+		def send_command(ip):
+			# Each VM gets its own object, since it keeps per VM state
+			return my_func(da_vm_class(log_obj), ip, args.username, args.password, host_password, vm_dict)
+
+		executor = da_parallel(log_obj, args.jobs)
+		results = executor.run(send_command, vm_ips)
+		failed = executor.log_summary(results, command)
+
+		close_ssh_pool(log_obj)
+		if failed:
+			raise SystemExit(1)
 		raise SystemExit
 
 	log_obj.log(ERROR, "Nothing to do.")
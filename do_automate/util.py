@@ -2,14 +2,27 @@
 
 import subprocess
 import sys
+import os
+import shutil
+import asyncio
 import time
 import json
 import errno
+import threading
 from os import kill
 from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 from do_automate.globals import *
-from do_automate.do_ssh import SSH
+from do_automate.do_ssh import SSH, set_host_key_pinning
+from do_automate.do_priv_helper import shared_priv_helper
+from do_automate.do_ip_discovery import ip_discovery
+from do_automate.do_qmp import da_qmp, qmp_socket_path
+from do_automate.do_wait import da_wait, cancel_waits
+from do_automate.do_console import shared_console_mux, console_fifos
+
+# Serializes read-modify-write cycles of vm_details.json between threads
+vm_details_lock = threading.RLock()
 
 class da_command:
 	def __init__(self, log_obj, username="", password="", host_password=""):
@@ -24,11 +37,7 @@ class da_command:
 		self.host_password = host_password
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
-
-		self.log_obj.log(log_level, message)
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
 
 	def set_param(self, username=None, password=None, host_password=None):
 		if username:
@@ -60,132 +69,286 @@ class da_command:
 		# failure returns 0 in status, stderr output in status_string
 		return status, status_string
 
-	def run_command_local(self, command):
+	def run_command_remote_stream(self, command, my_ip, line_callback=None, sudo=False):
+		# Output is logged and handed to line_callback(stream, line) line by line,
+		# while the command is still running
+		self.__log(DEBUG, "sudo " if sudo else "", command, " @ remote (streaming): ", my_ip)
+		exit_code = None
+		try:
+			for stream, line in self.my_ssh.stream_command(self.my_username, self.my_password, my_ip, command, sudo):
+				if stream == "exit":
+					exit_code = line
+					continue
+				self.__log(DEBUG, my_ip, stream, ": ", line.rstrip("\n"))
+				if line_callback:
+					line_callback(stream, line)
+		except:
+			return 0, "Exception occurred: " + str(sys.exc_info()[0])
+		self.__log(DEBUG, "exit code: ", exit_code)
+		# failure returns 0 in status, the exit code of the command is returned in both cases
+		return exit_code == 0, exit_code
+
+	def start_command_remote(self, command, my_ip, sudo=False):
+		# Returns a job handle with poll(), wait(timeout) and kill(),
+		# several of them can run at once on the same VM
+		self.__log(DEBUG, "sudo " if sudo else "", command, " @ remote (job): ", my_ip)
+		try:
+			job = self.my_ssh.start_job(self.my_username, self.my_password, my_ip, command, sudo)
+		except:
+			self.__log(ERROR, "Exception occurred: " + str(sys.exc_info()[0]))
+			return None
+		return job
+
+	def run_command_remote_batch(self, commands, my_ip, sudo=False):
+		self.__log(DEBUG, "batch of ", len(commands), " commands @ remote: ", my_ip)
+		try:
+			status, results, stderroutput = self.my_ssh.run_batch(self.my_username, self.my_password, my_ip, commands, sudo)
+		except:
+			return 0, "Exception occurred: " + str(sys.exc_info()[0])
+
+		for result in results:
+			self.__log(DEBUG, result["command"], " exit code: ", result["exit_code"],
+					"({:.3f}s)".format(result["duration"]), result["stdout"], result["stderr"])
+
+		if not status and len(results) < len(commands) and (not results or not results[-1]["exit_code"]):
+			# The script itself failed before reaching the next step
+			self.__log(DEBUG, stderroutput)
+			return 0, "Batch failed: " + "".join(stderroutput)
+
+		# failure returns 0 in status, the results of the steps run till the failing one in results
+		return status, results
+
+	def drop_remote_connection(self, my_ip):
+		# Pooled connection to this VM is useless after a shutdown or reboot
+		self.__log(DEBUG, "Dropping pooled connection to ", my_ip)
+		self.my_ssh.drop_connection(my_ip)
+
+	def run_command_local(self, command, cwd=None, timeout=None, env=None):
+		# A list is executed directly as argv, a string goes through the shell.
+		# Use the shell only for commands which really need it (pipes, globs, ..)
 		self.__log(DEBUG, command, " @ local")
 		try:
-			s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
+			if isinstance(command, list):
+				s = subprocess.check_output(command, stderr=subprocess.DEVNULL, cwd=cwd, timeout=timeout, env=env).decode('utf-8')
+			else:
+				s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True, cwd=cwd, timeout=timeout, env=env).decode('utf-8')
 			returncode = 0
 		except subprocess.CalledProcessError as e:
 			s = e.output
 			returncode = e.returncode
+		except subprocess.TimeoutExpired as e:
+			s = "Timeout after {t}s".format(t = timeout)
+			returncode = LOCAL_TIMEOUT_RETURNCODE
+		except OSError as e:
+			# Binary not found and such
+			s = str(e)
+			returncode = 127
 		self.__log(DEBUG, returncode, s)
 		# failure returns a positive returncode
 		# success return 0 as returncode
 		return returncode, s
 
-	def run_sudo_command_local(self, command):
-		self.__log(DEBUG, "__run_sudo_command_local(): sudo ", command, " @ local")
-		command = "sudo -S " + command
+	def run_command_local_stream(self, argv, log_file, line_callback=None, cwd=None, env=None):
+		# For long running commands with a lot of output (kernel builds).
+		# stdout and stderr are written to log_file as they arrive, and each line
+		# is handed to line_callback, instead of being kept in memory.
+		# returns the returncode
+		self.__log(DEBUG, argv, " @ local, output to ", log_file)
+		try:
+			with open(log_file, 'w') as f:
+				proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+						stderr=subprocess.STDOUT, cwd=cwd, env=env)
+				for line in proc.stdout:
+					line = line.decode('utf-8', errors="replace")
+					f.write(line)
+					if line_callback:
+						line_callback(line)
+				returncode = proc.wait()
+		except OSError as e:
+			self.__log(ERROR, "run_command_local_stream(): ", e)
+			return 127
+
+		self.__log(DEBUG, returncode)
+		return returncode
+
+	async def run_command_local_async(self, argv, cwd=None, timeout=None):
+		# Same as run_command_local with an argv list, as a coroutine
+		self.__log(DEBUG, argv, " @ local (async)")
+		try:
+			proc = await asyncio.create_subprocess_exec(*argv, stdout=subprocess.PIPE,
+					stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, cwd=cwd)
+		except OSError as e:
+			return 127, str(e)
+
+		try:
+			out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+		except asyncio.TimeoutError:
+			proc.kill()
+			await proc.wait()
+			self.__log(DEBUG, argv, " timed out after ", timeout, "s")
+			return LOCAL_TIMEOUT_RETURNCODE, "Timeout after {t}s".format(t = timeout)
+
+		s = out.decode('utf-8', errors="replace")
+		self.__log(DEBUG, proc.returncode, s)
+		return proc.returncode, s
+
+	def run_commands_local(self, all_argv, timeout=None):
+		# Runs all the argv lists at once
+		# returns list of (returncode, output), in the order of all_argv
+		async def run_all():
+			return await asyncio.gather(*[self.run_command_local_async(argv, timeout=timeout) for argv in all_argv])
+
+		return asyncio.run(run_all())
+
+	def make_dirs_local(self, *folders):
+		self.__log(DEBUG, "mkdir -p ", *folders)
+		try:
+			for folder in folders:
+				os.makedirs(folder, exist_ok=True)
+		except OSError as e:
+			self.__log(ERROR, "make_dirs_local(): ", e)
+			return False
+		return True
+
+	def remove_tree_local(self, folder):
+		self.__log(DEBUG, "rm -rf ", folder)
+		try:
+			shutil.rmtree(folder)
+		except FileNotFoundError:
+			pass
+		except OSError as e:
+			self.__log(ERROR, "remove_tree_local(): ", e)
+			return False
+		return True
+
+	def link_tree_local(self, src, dst):
+		# Copies the folder src to dst with hard links, so it takes no space.
+		# The files must not be changed in place afterwards, only replaced.
+		self.__log(DEBUG, "cp -al ", src, dst)
 
-		feed_password = subprocess.Popen("echo " + self.host_password, stdout=subprocess.PIPE, shell=True)
-		status_string = subprocess.Popen(command, stdin=feed_password.stdout, stdout=subprocess.PIPE, shell=True)
-		self.__log(DEBUG, status_string)
+		def link_or_copy(src_file, dst_file):
+			try:
+				os.link(src_file, dst_file)
+			except OSError:
+				# Other filesystem
+				shutil.copy2(src_file, dst_file)
 
+		try:
+			shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy)
+		except OSError as e:
+			self.__log(ERROR, "link_tree_local(): ", e)
+			return False
+		return True
+
+	def copy_file_local(self, src, dst):
+		self.__log(DEBUG, "cp ", src, dst)
+		try:
+			shutil.copyfile(src, dst)
+		except OSError as e:
+			self.__log(ERROR, "copy_file_local(): ", e)
+			return False
 		return True
 
-	def run_sudo_command_local_get_pid(self, command):
+	def __priv_helper(self):
+		# Started on first use, then shared by all the objects of this session
+		if not shared_priv_helper.is_running():
+			self.__log(DEBUG, "Starting privileged helper")
+			if not shared_priv_helper.start(self.host_password):
+				self.__log(ERROR, "Starting privileged helper failed. Is the host password correct?")
+				return None
+		return shared_priv_helper
+
+	def run_sudo_command_local(self, command):
 		self.__log(DEBUG, "__run_sudo_command_local(): sudo ", command, " @ local")
-		command = "sudo -S " + command
 
-		feed_password = subprocess.Popen("echo " + self.host_password, stdout=subprocess.PIPE, shell=True)
-		status_string = subprocess.Popen(command, stdin=feed_password.stdout, stdout=subprocess.PIPE, shell=True).pid
-		self.__log(DEBUG, status_string)
+		helper = self.__priv_helper()
+		if not helper:
+			return False
 
-		return status_string
+		pid = helper.spawn(command)
+		self.__log(DEBUG, pid)
 
-	def run_sudo_command_local_ret_out(self, command):
-		self.__log(DEBUG, "__run_sudo_command_local_ret_out(): sudo ", command, " @ local")
-		command = "sudo {comm}".format(comm = command)
+		return pid is not None
 
-		feed_password = subprocess.Popen("echo " + self.host_password, stdout=subprocess.PIPE, shell=True)
-		status_string = subprocess.Popen(command, stdin=feed_password.stdout, stdout=subprocess.PIPE, shell=True)
+	def run_sudo_command_local_get_pid(self, command, console_log_file=None):
+		# The command is executed directly (no shell), so the pid is the one of the command
+		# Its output goes to console_log_file (rotated), or is dropped
+		self.__log(DEBUG, "__run_sudo_command_local(): sudo ", command, " @ local")
 
-		# Get the output from stdout
-		status_string = status_string.stdout.read().decode()
-		self.__log(DEBUG, "status_string ", status_string)
+		helper = self.__priv_helper()
+		if not helper:
+			return None
 
-		return status_string
+		console_log = None
+		if console_log_file:
+			console_log = {"file": console_log_file, "max_bytes": CONSOLE_LOG_MAX_BYTES, "backups": CONSOLE_LOG_BACKUPS}
 
-	def run_command_remote_pipe(self, uuid, rem_command, timeout):
-		if not self.pipe:
-			self.__log(ERROR, "__run_command_remote_pipe: Pipe not active.")
-			return False
+		pid = helper.spawn(command, shell=False, console_log=console_log)
+		self.__log(DEBUG, pid)
 
-		global vm_comm_delay_mult
+		return pid
 
-		self.__log(DEBUG, rem_command, " @ local using pipe")
-		this_pipe_in = PIPES_FOLDER + "/" + uuid + ".in"
-		this_pipe_out = PIPES_FOLDER + "/" + uuid + ".out"
+	def run_sudo_command_local_status(self, command):
+		self.__log(DEBUG, "run_sudo_command_local_status(): sudo ", command, " @ local")
 
-		# Flush any stdout content before using
-		command = "timeout 2 cat {pipe}".format(pipe = this_pipe_out)
-		status_string = self.__run_sudo_command_local_ret_out(command)
+		helper = self.__priv_helper()
+		if not helper:
+			return 1, ""
 
-		rem_command = rem_command + "\n"
-		try:
-			with open(this_pipe_in, 'w') as f:
-				f.write(rem_command)
-		except:
-			self.__log(DEBUG, "__run_command_remote_pipe Failed with Exception: " + str(sys.exc_info()[0]))
-			return 0, "Failure"
+		returncode, status_string = helper.run(command)
+		self.__log(DEBUG, "returncode ", returncode, " status_string ", status_string)
+		if returncode is None:
+			# The helper went away
+			return 1, status_string
 
-		command = "timeout {t_val} cat {pipe}".format(t_val = timeout * vm_comm_delay_mult, pipe = this_pipe_out)
-		status_string = self.__run_sudo_command_local_ret_out(command)
-		if not status_string:
-			self.__log(DEBUG, "__run_sudo_command_local_ret_out Failed:", status_string)
-			return 0, status_string
+		# failure returns a positive returncode
+		return returncode, status_string
 
-		# Remove the first line which contains the command,
-		# and the last one which will contain the prompt
-		status_string = "\n".join(status_string.split('\n')[1:-1])
+	def run_sudo_command_local_ret_out(self, command):
+		self.__log(DEBUG, "__run_sudo_command_local_ret_out(): sudo ", command, " @ local")
 
-		# failure returns 0 in status, stderr output in status_string
-		return 1, status_string
+		helper = self.__priv_helper()
+		if not helper:
+			return ""
 
-	def run_sudo_command_remote_pipe(self, uuid, rem_command, timeout):
-		if not self.pipe:
-			self.__log(ERROR, "__run_sudo_command_remote_pipe: Pipe not active.")
-			return False
+		returncode, status_string = helper.run(command)
+		self.__log(DEBUG, "status_string ", status_string)
 
-		global vm_comm_delay_mult
+		return status_string
 
-		self.__log(DEBUG, "sudo ", rem_command, " @ local using pipe")
-		this_pipe_in = PIPES_FOLDER + "/" + uuid + ".in"
-		this_pipe_out = PIPES_FOLDER + "/" + uuid + ".out"
+	def __console(self, uuid):
+		# The console reader of this VM, logged in
+		console = shared_console_mux.open(uuid)
+		if console is None:
+			self.__log(ERROR, "Opening the console fifos of VM {uuid} failed".format(uuid = uuid))
+			return None
 
-		# Flush any stdout content before using
-		command = "timeout 2 cat {pipe}".format(pipe = this_pipe_out)
-		status_string = self.__run_sudo_command_local_ret_out(command)
+		if not console.login(self.my_username, self.my_password, PIPE_PROMPT_TIMEOUT, PIPE_PROMPT_TIMEOUT):
+			self.__log(ERROR, "Login on the console of VM {uuid} failed".format(uuid = uuid))
+			return None
 
-		command = "sudo " + rem_command + "\n"
-		try:
-			with open(this_pipe_in, 'w') as f:
-				f.write(command)
-		except:
-			self.__log(DEBUG, "__run_sudo_command_remote_pipe Failed with Exception: " + str(sys.exc_info()[0]))
-			return 0, "Failure"
+		return console
 
-		time.sleep(1 * vm_comm_delay_mult)
-		command = "{password}\n".format(password = self.my_password)
-		try:
-			with open(this_pipe_in, 'w') as f:
-				f.write(command)
-		except:
-			self.__log(DEBUG, "__run_sudo_command_remote_pipe Failed with Exception: " + str(sys.exc_info()[0]))
-			return 0, "Failure"
+	def __run_command_console(self, uuid, rem_command, timeout, sudo):
+		console = self.__console(uuid)
+		if console is None:
+			return 0, "Console not available"
 
-		command = "timeout {t_val} cat {pipe}".format(t_val = timeout * vm_comm_delay_mult, pipe = this_pipe_out)
-		status_string = self.__run_sudo_command_local_ret_out(command)
-		if not status_string:
-			self.__log(DEBUG, "__run_sudo_command_local_ret_out Failed:", status_string)
-			return 0, status_string
+		returncode, status_string = console.run(rem_command, timeout, sudo, self.my_password)
+		self.__log(DEBUG, "returncode ", returncode, " status_string ", status_string)
+		if returncode is None:
+			return 0, "Timed out after {timeout}s".format(timeout = timeout)
 
-		# Remove the first line which contains the command,
-		# and the last one which will contain the prompt
-		status_string = "\n".join(status_string.split('\n')[1:-1])
+		# failure returns 0 in status, output in status_string
+		return int(returncode == 0), status_string
 
-		# failure returns 0 in status, stderr output in status_string
-		return 1, status_string
+	def run_command_remote_pipe(self, uuid, rem_command, timeout):
+		self.__log(DEBUG, rem_command, " @ local using pipe")
+		return self.__run_command_console(uuid, rem_command, timeout, False)
+
+	def run_sudo_command_remote_pipe(self, uuid, rem_command, timeout):
+		self.__log(DEBUG, "sudo ", rem_command, " @ local using pipe")
+		return self.__run_command_console(uuid, rem_command, timeout, True)
 
 class da_get:
 	def __init__(self, log_obj, dac_object):
@@ -193,11 +356,7 @@ class da_get:
 		self.dac_obj = dac_object
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
-
-		self.log_obj.log(log_level, message)
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
 
 	def read_vm_details_json(self):
 		vm_details_dict = {}
@@ -212,30 +371,26 @@ class da_get:
 			self.__log(ERROR, "read_vm_details_json(): Exception occurred: " + str(sys.exc_info()[0]))
 			return None
 
+		# VMs started by an earlier do_qemu run
+		for vm in vm_details_dict.values():
+			set_host_key_pinning(vm.get('ips', []), vm.get('pinned_host_key', False))
+
 		return vm_details_dict
 
-	def get_ip_from_mac(self, my_mac_addr):
-		global vm_comm_delay_mult
+	def get_ips_from_macs(self, all_macs, timeout = IP_DISCOVERY_TIMEOUT):
+		'''
+		Waits for the IPs of all the given macs at once.
+		returns dict of mac -> ip, macs without an IP after timeout seconds are left out
+		'''
+		found = ip_discovery(self.log_obj).resolve(all_macs, timeout)
+		if len(found) < len(all_macs):
+			self.__log(ERROR, "Timed out after {secs}s waiting for the IPs of ".format(secs = timeout),
+					[mac for mac in all_macs if mac not in found])
 
-		command = "arp -n"
-		ip_attempts = 0
-		while ip_attempts < 500:
-			self.__log(DEBUG, "Attempt", ip_attempts + 1)
-			status, s = self.dac_obj.run_command_local(command)
-			if status:
-				return None
-			lines_list = s.split("\n")
-
-			for line in lines_list:
-				if my_mac_addr in line:
-					delay_mult = int(ip_attempts / 5) + 1
-					if vm_comm_delay_mult < delay_mult:
-						vm_comm_delay_mult = delay_mult
-					return line[:line.index(" ")]
-			ip_attempts += 1
-			self.__log(DEBUG, "Failed! Waiting 1 seconds before next try\n")
-			time.sleep(1)
-		return None
+		return {my_mac_addr: my_ip for my_mac_addr, (my_ip, seconds) in found.items()}
+
+	def get_ip_from_mac(self, my_mac_addr):
+		return self.get_ips_from_macs([my_mac_addr]).get(my_mac_addr)
 
 	def get_dev_name_from_ip(self, my_ip):
 		command = "ip -o -4 a | grep '{ip}' | awk '{{print $2}}'".format(ip = my_ip)
@@ -273,16 +428,30 @@ class da_util:
 		self.dac_obj = dac_object
 
 		self.dag_obj = da_get(self.log_obj, self.dac_obj)
+		self.wait_obj = da_wait(self.log_obj)
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def __ping_once(self, my_ip):
+		command = ["ping", "-c", "1", "-W", "1", my_ip]
+		status, s = self.dac_obj.run_command_local(command)
+		return not status
 
-		self.log_obj.log(log_level, message)
+	def wait_for_ping(self, my_ip, timeout):
+		'''
+		returns True as soon as my_ip answers a ping, False if it did not within timeout seconds
+		'''
+		return bool(self.wait_obj.until("ping reply from " + my_ip, lambda: self.__ping_once(my_ip), timeout))
+
+	def wait_for_no_ping(self, my_ip, timeout):
+		'''
+		returns True as soon as my_ip stops answering pings, False if it still did after timeout seconds
+		'''
+		return bool(self.wait_obj.until(my_ip + " going down", lambda: not self.__ping_once(my_ip), timeout))
 
 	def ping_check(self, ping_attempts, my_ip, my_interval=1):
-		command = "ping -c 1 -i {interval} {ip}".format(ip = my_ip, interval = my_interval)
+		command = ["ping", "-c", "1", "-i", str(my_interval), my_ip]
 		my_attempts = 0
 		while my_attempts < ping_attempts:
 			self.__log(DEBUG, "Attempt", my_attempts + 1)
@@ -290,26 +459,47 @@ class da_util:
 			if not status:
 				return True
 			my_attempts += 1
-			self.__log(DEBUG, "Failed! Waiting 2 seconds before next try\n")
-			time.sleep(2)
+			if my_attempts < ping_attempts:
+				self.__log(DEBUG, "Failed! Waiting 2 seconds before next try\n")
+				if not self.wait_obj.sleep(2):
+					break
 		return False
 
-	def is_vm_running(self, vm_details_list):
+	def is_vm_running(self, vm_details_list, vm_uuid=None):
+		'''
+		returns (process running, network up, qemu run state). The run state is None when qemu could not be asked
+		'''
+		# Ask qemu first, this works even when we may not signal the process
+		run_state = None
+		if vm_uuid is not None and os.path.exists(qmp_socket_path(vm_uuid)):
+			with da_qmp(self.log_obj, vm_uuid) as qmp:
+				if qmp.connect():
+					run_state = qmp.query_status()
+				elif qmp.gone:
+					# Socket left behind by a qemu which is not running anymore
+					return False, False, None
+
+		if run_state is not None:
+			# qemu is up, whether the guest is reachable is another question
+			if not self.ping_check(1, vm_details_list['ips'][0], 0.2):
+				return True, False, run_state
+			return True, True, run_state
+
 		try:
 			kill(vm_details_list["pid"], 0)
 		except OSError as err:
 			if err.errno == errno.ESRCH:
 				# VM process not running
-				return False, False
+				return False, False, None
 			elif err.errno == errno.EPERM:
 				# VM running, but we do not have permission to send signal
 				# check network
 				if not self.ping_check(1, vm_details_list['ips'][0], 0.2):
 					# Network down
-					return True, False
+					return True, False, None
 
 		# First is for process, second is network connectivity
-		return True, True
+		return True, True, None
 
 	def is_path_absolute(self, path):
 		if path[0] == '/' or path[0] == '~':
@@ -333,7 +523,38 @@ class da_util:
 
 		return True
 
+	def __delete_pipe_files(self, uuid):
+		shared_console_mux.close(uuid)
+
+		for fifo in console_fifos(uuid):
+			try:
+				os.remove(fifo)
+			except FileNotFoundError:
+				pass
+			except OSError as e:
+				self.__log(ERROR, "Deleting pipe file failed: ", e)
+				return False
+
+		return True
+
 	def read_and_update_vm_dict(self):
+		with vm_details_lock:
+			return self.__read_and_update_vm_dict()
+
+	def remove_vm_details(self, vm_uuids):
+		# Re-read, so that removals done in parallel by others are not lost
+		with vm_details_lock:
+			vm_dict = self.dag_obj.read_vm_details_json()
+			if vm_dict is None:
+				self.__log(ERROR, "read_vm_details_json() failed: ", vm_dict)
+				return False
+
+			for vm_uuid in vm_uuids:
+				vm_dict.pop(vm_uuid, None)
+
+			return self.save_vm_details_to_json(vm_dict)
+
+	def __read_and_update_vm_dict(self):
 		vm_dict = self.dag_obj.read_vm_details_json()
 		if vm_dict is None:
 			self.__log(ERROR, "read_vm_details_json() failed: ", vm_dict)
@@ -342,7 +563,7 @@ class da_util:
 		temp_dict = vm_dict.copy()
 		for uuid, vm_details_list in temp_dict.items():
 			# Update the dict by checking if the vms are running
-			vm_proc, vm_net = self.is_vm_running(vm_details_list)
+			vm_proc, vm_net, run_state = self.is_vm_running(vm_details_list, uuid)
 			if not vm_proc:
 				self.__log(DEBUG, "read_and_update_vm_dict(): VM {this_uuid} not found".format(this_uuid = uuid))
 				del vm_dict[uuid]
@@ -351,10 +572,15 @@ class da_util:
 					if not self.__delete_pipe_files(uuid):
 						self.__log(DEBUG, "save_vm_details_to_json Failed")
 						return False
+			elif run_state is not None and run_state != "running":
+				# Stopped in qemu (paused, ...), the guest cannot answer pings either
+				vm_dict[uuid]["state"] = "Paused ({run_state})".format(run_state = run_state)
 			elif not vm_net:
 				vm_dict[uuid]["state"] = "Network Down (Maybe)"
 			else:
 				self.__log(DEBUG, "read_and_update_vm_dict(): VM {this_uuid} found running".format(this_uuid = uuid))
+				# E.g. resumed after a pause
+				vm_dict[uuid]["state"] = "Network Up"
 
 		if not self.save_vm_details_to_json(vm_dict):
 			self.__log(DEBUG, "save_vm_details_to_json Failed")
@@ -378,3 +604,60 @@ class da_util:
 
 		for vm_details in vm_dict.values():
 			print("{name}\t{ip1}\t{ip2}".format(name=vm_details["vm_name"],ip1=vm_details["ips"][0],ip2=vm_details["ips"][1]))
+
+class da_parallel:
+	'''
+	Runs the same operation on many targets (VMs) at once,
+	with at most max_workers of them in flight.
+	'''
+	def __init__(self, log_obj, max_workers=DEFAULT_PARALLEL_JOBS):
+		self.log_obj = log_obj
+		self.max_workers = max(1, int(max_workers))
+
+	def __log(self, log_level, *args):
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
+
+	def __run_one(self, func, target):
+		start = time.time()
+		try:
+			status = bool(func(target))
+			error = "" if status else "returned failure"
+		except Exception as e:
+			status = False
+			error = "Exception occurred: " + repr(e)
+
+		return {"status": status, "duration": time.time() - start, "error": error}
+
+	def run(self, func, targets):
+		'''
+		Calls func(target) for every target.
+		returns dict of target to result, where result has the
+		status (bool), duration (seconds) and error (string) of that call.
+		'''
+		results = {}
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			futures = {target: executor.submit(self.__run_one, func, target) for target in targets}
+			try:
+				for target, future in futures.items():
+					results[target] = future.result()
+			except KeyboardInterrupt:
+				# Get the workers out of their waits, so that the executor can shut down
+				cancel_waits()
+				for future in futures.values():
+					future.cancel()
+				raise
+
+		return results
+
+	def log_summary(self, results, name):
+		failed = 0
+		for target, result in results.items():
+			if result["status"]:
+				self.__log(0, "{name} {target}: OK ({duration:.1f}s)".format(name = name, target = target, duration = result["duration"]))
+			else:
+				failed += 1
+				self.__log(0, "{name} {target}: FAILED ({duration:.1f}s) {error}".format(name = name, target = target,
+						duration = result["duration"], error = result["error"]))
+
+		self.__log(0, "{name}: {ok} succeeded, {failed} failed".format(name = name, ok = len(results) - failed, failed = failed))
+		return failed
@@ -1,16 +1,25 @@
 #!/usr/bin/python3
 
-import subprocess
 import uuid
 import os.path
+import threading
 
 from do_automate.util import *
 from do_automate.globals import *
 from do_automate.do_qemu import auto_qemu
 from do_automate.do_softROCE import softROCE
+from do_automate.do_trace import span
+from do_automate.do_addressing import da_addressing
+from do_automate.do_qmp import da_qmp
+from do_automate.do_ssh import set_host_key_pinning
 
 MAC_ADDR_PREFIX = "52:54:00:12:43:"
 
+# Macs handed out by this process. VMs of a class started at the same time as
+# another one are not in vm_details.json yet, when the other class picks its macs.
+allocated_macs = set()
+allocated_macs_lock = threading.Lock()
+
 class post_boot_configuration:
 	def __init__(self, log_obj,  dac_object):
 		self.log_obj = log_obj
@@ -20,76 +29,43 @@ class post_boot_configuration:
 		self.my_roce = softROCE(self.log_obj)
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
-
-		self.log_obj.log(log_level, message)
-
-
-	def __vm_configure_share_modules(self, my_ip, shared_9p_tag):
-		command = "rm -rf /mnt/shared_modules/"
-		status, status_string = self.dac_obj.run_command_remote(command, my_ip)
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
-
-		command = "mkdir /mnt/shared_modules"
-		status, status_string = self.dac_obj.run_command_remote(command, my_ip)
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
 
-		command = "mount -t 9p -o trans=virtio {st} /mnt/shared_modules -oversion=9p2000.L".format(st = shared_9p_tag)
-		status, status_string = self.dac_obj.run_command_remote(command, my_ip)
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
 
-		command = "ln -s -f /mnt/shared_modules/lib/modules/*/ /lib/modules/"
-		status, status_string = self.dac_obj.run_command_remote(command, my_ip)
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
+	def __vm_share_modules_steps(self, shared_9p_tag):
+		return ["rm -rf /mnt/shared_modules/",
+			"mkdir /mnt/shared_modules",
+			"mount -t 9p -o trans=virtio {st} /mnt/shared_modules -oversion=9p2000.L".format(st = shared_9p_tag),
+			"ln -s -f /mnt/shared_modules/lib/modules/*/ /lib/modules/"]
 
-		return True
+	def __vm_insert_modules_steps(self):
+		# Some tests expect these modules to be already inserted
+		return ["modprobe null_blk nr_devices=5",
+			"modprobe brd rd_nr=5 rd_size=204800",
+			"modprobe loop"]
 
-	def fixed_pbc(self, list_of_ips, username, password, shared_9p_tag):
+	def fixed_pbc(self, list_of_ips, username, password, shared_9p_tag, vm_uuid = None):
 		# ping test
 		for my_ip in list_of_ips:
 			self.__log(INFO, "Checking connectivity to ", my_ip)
-			if not self.dau_obj.ping_check(50, my_ip):
+			with span("ping check", vm_uuid, ip = my_ip):
+				ping_ok = self.dau_obj.wait_for_ping(my_ip, VM_NETWORK_TIMEOUT)
+			if not ping_ok:
 				self.__log(ERROR, "ping failed")
 				return False
 			self.__log(INFO, "Passed!\n")
 
-		self.__log(INFO, "Configuring shared folder for modules")
-		if not self.__vm_configure_share_modules(list_of_ips[0], shared_9p_tag):
-			self.__log(ERROR, "__vm_configure_share_modules() failed")
-			return False
-		self.__log(INFO, "Done!\n")
-
-		self.__log(INFO, "Inserting required modules in the VM")
-		# Insert null_blk module. Some tests expect the module to be already inserted
-		command = "modprobe null_blk nr_devices=5"
-		status, status_string = self.dac_obj.run_sudo_command_remote(command, list_of_ips[0])
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
-
-		# Insert ram block module. Some tests expect the module to be already inserted
-		command = "modprobe brd rd_nr=5 rd_size=204800"
-		status, status_string = self.dac_obj.run_sudo_command_remote(command, list_of_ips[0])
-		if not status:
-			self.__log(ERROR, status_string)
-			return False
-		self.__log(INFO, "Done!\n")
-
-		# Insert ram block module. Some tests expect the module to be already inserted
-		command = "modprobe loop"
-		status, status_string = self.dac_obj.run_sudo_command_remote(command, list_of_ips[0])
+		# Configure shared folder for modules and insert required modules in one go
+		self.__log(INFO, "Configuring shared folder for modules and inserting required modules in the VM")
+		commands = self.__vm_share_modules_steps(shared_9p_tag) + self.__vm_insert_modules_steps()
+		with span("shared folder and modules", vm_uuid):
+			status, results = self.dac_obj.run_command_remote_batch(commands, list_of_ips[0], sudo=True)
 		if not status:
-			self.__log(ERROR, status_string)
+			if isinstance(results, str):
+				self.__log(ERROR, results)
+			elif results:
+				self.__log(ERROR, "Step \"{comm}\" failed with exit code {code}: ".format(
+						comm = results[-1]["command"], code = results[-1]["exit_code"]), results[-1]["stderr"])
 			return False
 		self.__log(INFO, "Done!\n")
 
@@ -103,7 +79,9 @@ class post_boot_configuration:
 			rdma_dev_name = "mlx4_" + str(i)
 
 			# Configure softROCE on the interface
-			if not self.my_roce.setup_softroce(username, password, my_ip, rdma_dev_name):
+			with span("softROCE", vm_uuid, ip = my_ip):
+				roce_ok = self.my_roce.setup_softroce(username, password, my_ip, rdma_dev_name)
+			if not roce_ok:
 				self.__log(ERROR, "SoftROCE configuration Failed!")
 
 		return True
@@ -134,28 +112,16 @@ class da_vm_class:
 		self.dau_obj = da_util(self.log_obj, self.dac_obj)
 
 		self.pbc_obj = post_boot_configuration(self.log_obj, self.dac_obj)
+		self.addr_obj = da_addressing(self.log_obj, self.dac_obj)
 
 		self.__log(DEBUG, "In constructor")
 		self.__log(INFO, "Storage object created")
 
 	def __log(self, log_level, *args):
-		message = self.__class__.__name__ + ": "
-		for arg in args:
-			message += str(arg) + " "
-
-		self.log_obj.log(log_level, message)
+		self.log_obj.log(log_level, self.__class__.__name__ + ": ", *args)
 
 	def __create_default_folders(self):
-		command = "mkdir -p {folder1} {folder2}".format(folder1 = self.linux_kernel_folder,
-				folder2 = self.vm_share_folder)
-		try:
-			s = subprocess.check_output([command], stderr=subprocess.DEVNULL, shell=True).decode('utf-8')
-			returncode = 0
-		except subprocess.CalledProcessError as e:
-			self.__log(DEBUG, "Fail!")
-			return False
-
-		return True
+		return self.dac_obj.make_dirs_local(self.linux_kernel_folder, self.vm_share_folder)
 
 	def __generate_vm_uuids(self):
 		num_of_vm = self.vm_params_dict['num_of_vm']
@@ -170,9 +136,9 @@ class da_vm_class:
 		return all_uuids
 
 	def __mac_addr_used(self, mac_addr):
-		command = "arp -n | grep {mac_addr}".format(mac_addr = mac_addr)
+		command = ["arp", "-n"]
 		status, status_string = self.dac_obj.run_command_local(command)
-		if status or mac_addr not in status_string.rstrip():
+		if status or mac_addr not in status_string:
 			for vm_details in self.vm_dict_cur.values():
 				if mac_addr in vm_details["macs"]:
 					return True
@@ -185,17 +151,20 @@ class da_vm_class:
 		num_of_vm = self.vm_params_dict['num_of_vm']
 		all_macs = []
 
-		i = 0
-		octet = 10
-		while i < NUM_OF_ETH_INT * num_of_vm:
-			this_mac_addr = MAC_ADDR_PREFIX + str(octet)
-			if not self.__mac_addr_used(this_mac_addr):
-				all_macs.append(this_mac_addr)
-				i += 1
-			octet += 1
-			if octet == 100:
-				self.__log(ERROR, "__generate_vm_macs() failed.")
-				return False
+		with allocated_macs_lock:
+			i = 0
+			octet = 10
+			while i < NUM_OF_ETH_INT * num_of_vm:
+				this_mac_addr = MAC_ADDR_PREFIX + str(octet)
+				if this_mac_addr not in allocated_macs and not self.__mac_addr_used(this_mac_addr):
+					all_macs.append(this_mac_addr)
+					i += 1
+				octet += 1
+				if octet == 100:
+					self.__log(ERROR, "__generate_vm_macs() failed.")
+					return False
+
+			allocated_macs.update(all_macs)
 
 		return all_macs
 
@@ -212,11 +181,9 @@ class da_vm_class:
 			if os.path.exists(img_path):
 				self.__log(INFO, ("{} exist, no copy.".format(img_path)))
 			else:
-				dir = os.path.dirname(img_path)
-				command = "mkdir -p {dir} && cp {src} {dst}".format(dir=dir, src=qcow, dst=img_path)
-				status, status_string = self.dac_obj.run_command_local(command)
-				if status:
-					self.__log(ERROR, status, status_string)
+				if not self.dac_obj.make_dirs_local(os.path.dirname(img_path)) or \
+						not self.dac_obj.copy_file_local(qcow, img_path):
+					self.__log(ERROR, "Copying {src} to {dst} failed".format(src = qcow, dst = img_path))
 					return False
 			all_imgs.append(img_path)
 			next_avail_pers_slot += 1
@@ -250,6 +217,27 @@ class da_vm_class:
 		if "optional" in vm_params_dict:
 			vm_dict_aq['optional'] = vm_params_dict['optional']
 
+		if "build_cache" in vm_params_dict:
+			vm_dict_aq['build_cache'] = vm_params_dict['build_cache']
+
+		if "ccache" in vm_params_dict:
+			vm_dict_aq['ccache'] = vm_params_dict['ccache']
+
+		if "kernel_ref" in vm_params_dict:
+			vm_dict_aq['kernel_ref'] = vm_params_dict['kernel_ref']
+
+		if "kernel_config" in vm_params_dict:
+			vm_dict_aq['kernel_config'] = vm_params_dict['kernel_config']
+
+		if "config_profiles" in vm_params_dict:
+			vm_dict_aq['config_profiles'] = vm_params_dict['config_profiles']
+
+		# Pinned host keys only for images made by do_automate_setup -i, unless the class says otherwise
+		if "pinned_host_key" in vm_params_dict:
+			vm_dict_aq['pinned_host_key'] = bool(vm_params_dict['pinned_host_key'])
+		else:
+			vm_dict_aq['pinned_host_key'] = os.path.exists(vm_params_dict['qcow'] + GUEST_IMAGE_MARKER_SUFFIX)
+
 		if "scsi_images" in vm_params_dict:
 			for i in range(len(vm_params_dict['scsi_images'])):
 				vm_params_dict['scsi_images'][i] = self.dau_obj.check_and_make_path_abs(vm_params_dict['scsi_images'][i])
@@ -294,8 +282,10 @@ class da_vm_class:
 			this_vm_details['state'] = "Network Up"
 			this_vm_details['macs'] = [self.all_macs[(i*NUM_OF_ETH_INT)+0], self.all_macs[(i*NUM_OF_ETH_INT)+1]]
 			this_vm_details['bridges'] = self.vm_params_dict['bridges']
+			this_vm_details['addressing'] = self.vm_params_dict['addressing']
 			this_vm_details['shared_9p_tag'] = self.shared_9p_tag
 			this_vm_details['base_image'] = self.vm_dict_aq['qcow'][i]
+			this_vm_details['pinned_host_key'] = self.vm_dict_aq['pinned_host_key']
 
 			if "scsi_images" in self.vm_dict_aq:
 				this_vm_details['scsi_images'] = []
@@ -308,9 +298,6 @@ class da_vm_class:
 
 		return True
 
-	def __remove_vm_details(self, vm_uuid):
-		del self.vm_dict_cur[vm_uuid]
-
 	def set_vm_params(self, vm_params_dict, build_option):
 		self.__log(DEBUG, "In set_vm_params")
 
@@ -339,6 +326,9 @@ class da_vm_class:
 		if "optional" not in self.vm_params_dict:
 			self.vm_params_dict["optional"] = []
 
+		if "addressing" not in self.vm_params_dict:
+			self.vm_params_dict["addressing"] = "dhcp"
+
 		self.username = vm_params_dict['username']
 		self.password = vm_params_dict['password']
 
@@ -379,6 +369,14 @@ class da_vm_class:
 		self.vm_dict_aq["uuids"] = self.all_uuids
 		self.vm_dict_aq["macs"] = self.all_macs
 
+		# With reserved addressing the IPs are known before the VMs are started
+		if self.vm_params_dict["addressing"] == "reserved":
+			self.vm_dict_aq["ips"] = self.addr_obj.plan_ips(self.all_macs, self.vm_params_dict['bridges'])
+			if not self.vm_dict_aq["ips"]:
+				self.__log(ERROR, "Planning reserved IPs failed.")
+				return False
+			self.__log(DEBUG, "In set_vm_params: planned IPs = ", self.vm_dict_aq["ips"])
+
 		if not self.my_qemu.set_vm_params(self.vm_dict_aq, build_option):
 			self.__log(ERROR, "set_vm_params failed.")
 			return False
@@ -387,9 +385,9 @@ class da_vm_class:
 		self.vm_params_set = True
 		return True
 
-	def start_auto(self, host_password):
-		self.__log(DEBUG, "In start_auto")
-		self.__log(INFO, "Calling auto_qemu to start VMs")
+	# The phases of start_auto, in their order. They can be run one by one, e.g. by a task graph.
+	def prepare(self, host_password):
+		self.__log(DEBUG, "In prepare")
 
 		if not self.vm_params_set:
 			self.__log(ERROR, "start_auto called before calling set_vm_params.")
@@ -399,46 +397,135 @@ class da_vm_class:
 		# To call start_auto again, call set_vm_params again with relevant info
 		self.vm_params_set = False
 
+		if "ips" in self.vm_dict_aq:
+			self.dac_obj.set_param(None, None, host_password)
+			with span("reserve IPs"):
+				reserved = self.addr_obj.reserve(self.vm_dict_aq["ips"], self.vm_params_dict['bridges'], self.all_macs)
+			if not reserved:
+				self.__log(ERROR, "Reserving IPs failed.")
+				return False
+
+		return self.my_qemu.check_host(host_password)
+
+	def build_kernel(self):
+		return self.my_qemu.build_kernel()
+
+	def build_modules(self):
+		return self.my_qemu.build_modules()
+
+	def launch(self):
 		# Send the start VM command
-		all_info = self.my_qemu.start_auto(host_password)
-		if not all_info:
-			self.__log(INFO, "start_auto failed.")
+		self.all_info = self.my_qemu.launch()
+		if not self.all_info:
+			self.__log(INFO, "launch failed.")
 			return False
 
-		all_ips = all_info["all_ips"]
-		all_pids = all_info["all_pids"]
+		return True
+
+	def configure(self):
+		all_ips = self.all_info["all_ips"]
+		all_pids = self.all_info["all_pids"]
 
 		# Do post boot configurations
-		for list_of_ips in all_ips:
-			if not self.pbc_obj.fixed_pbc(list_of_ips, self.username, self.password, self.shared_9p_tag):
+		for list_of_ips, vm_uuid in zip(all_ips, self.vm_dict_aq["uuids"]):
+			set_host_key_pinning(list_of_ips, self.vm_dict_aq['pinned_host_key'])
+			with span("fixed_pbc", vm_uuid):
+				pbc_ok = self.pbc_obj.fixed_pbc(list_of_ips, self.username, self.password, self.shared_9p_tag, vm_uuid)
+			if not pbc_ok:
 				self.__log(INFO, "fixed_pbc failed.")
 				return False
 
-		self.vm_dict_cur = self.dau_obj.read_and_update_vm_dict()
-		if self.vm_dict_cur is False:
-			self.__log(ERROR, "read_and_update_vm_dict() failed: ", self.vm_dict_cur)
-			return False
+		# Other classes may be adding their VMs at the same time
+		with vm_details_lock:
+			self.vm_dict_cur = self.dau_obj.read_and_update_vm_dict()
+			if self.vm_dict_cur is False:
+				self.__log(ERROR, "read_and_update_vm_dict() failed: ", self.vm_dict_cur)
+				return False
 
-		if not self.__add_new_vm_details(all_ips, all_pids):
-			self.__log(ERROR, "__add_new_vm_details() failed: ")
-			return False
+			if not self.__add_new_vm_details(all_ips, all_pids):
+				self.__log(ERROR, "__add_new_vm_details() failed: ")
+				return False
 
-		if not self.dau_obj.save_vm_details_to_json(self.vm_dict_cur):
-			self.__log(ERROR, "save_vm_details_to_json failed: ")
-			return False
+			if not self.dau_obj.save_vm_details_to_json(self.vm_dict_cur):
+				self.__log(ERROR, "save_vm_details_to_json failed: ")
+				return False
 
 		return all_ips
 
-	def shutdown_vm(self, vm_ip, username, password, host_password):
+	def start_auto(self, host_password):
+		self.__log(DEBUG, "In start_auto")
+		self.__log(INFO, "Calling auto_qemu to start VMs")
+
+		with span("auto_qemu " + self.vm_class):
+			started = self.prepare(host_password) and self.build_kernel() and self.build_modules() and self.launch()
+		if not started:
+			self.__log(INFO, "start_auto failed.")
+			return False
+
+		return self.configure()
+
+	def __qmp_shutdown(self, vm_uuid):
+		# Power button first, so the guest can shut down cleanly
+		with da_qmp(self.log_obj, vm_uuid) as qmp:
+			if not qmp.connect():
+				return False
+
+			if qmp.powerdown(QMP_POWERDOWN_TIMEOUT):
+				return True
+
+			self.__log(INFO, "VM {uuid} did not power down in time, stopping qemu".format(uuid = vm_uuid))
+			return qmp.quit()
+
+	def __qmp_reset(self, vm_uuid):
+		with da_qmp(self.log_obj, vm_uuid) as qmp:
+			if not qmp.connect():
+				return False
+
+			return qmp.reset()
+
+	def __guest_reboot(self, vm_uuid, vm_ip):
+		'''
+		Reboots the guest through its OS, so it can flush its disks first.
+		A guest which is unreachable or does not go down in time is reset through QMP.
+		returns True once the VM went down for the reboot
+		'''
+		if self.dau_obj.ping_check(1, vm_ip):
+			status, status_string = self.dac_obj.run_sudo_command_remote("reboot", vm_ip)
+			if not status:
+				# In case, log this for debuggging
+				self.__log(DEBUG, status_string)
+
+			# A failed command may still have rebooted the guest, before it could answer
+			timeout = VM_REBOOT_DOWN_TIMEOUT if status else VM_REBOOT_NO_ANSWER_TIMEOUT
+			# Do not mistake the old system for the rebooted one
+			if self.dau_obj.wait_for_no_ping(vm_ip, timeout):
+				return True
+
+			self.__log(INFO, "VM with ip {ip} did not go down for the reboot, resetting it".format(ip = vm_ip))
+		else:
+			self.__log(INFO, "VM with ip {ip} is unreachable, resetting it".format(ip = vm_ip))
+
+		if self.__qmp_reset(vm_uuid):
+			self.__log(DEBUG, "VM {uuid} reset through QMP".format(uuid = vm_uuid))
+			return True
+
+		return False
+
+	def shutdown_vm(self, vm_ip, username, password, host_password, vm_dict=None):
 		'''
 		Sending a shutdown command and checking status is tricky
 		Sometimes the command executes successfully, but the system goes down
 		way too fast to send a successful return status and status_string.
 		So we are gonna rely on ping to confirm the shutdown
+
+		vm_dict can be passed to skip re-reading the VM details,
+		when many VMs are handled at once.
 		'''
 		self.dac_obj.set_param(username, password, host_password)
 
-		self.vm_dict_cur = self.dau_obj.read_and_update_vm_dict()
+		if vm_dict is None:
+			vm_dict = self.dau_obj.read_and_update_vm_dict()
+		self.vm_dict_cur = vm_dict
 		if self.vm_dict_cur is False:
 			self.__log(ERROR, "read_and_update_vm_dict() failed: ", self.vm_dict_cur)
 			return False
@@ -466,14 +553,22 @@ class da_vm_class:
 			else:
 				self.pipe = False
 
+			if this_vm_detail.get("addressing") == "reserved":
+				self.addr_obj.release(this_vm_detail["macs"], this_vm_detail["bridges"])
+
 			self.__log(INFO, "Shutting down VM with ip {ip}".format(ip = vm_ip))
 
-			command = "shutdown -h now"
-			# if self.dau_obj.ping_check(1, vm_ip):
-			status, status_string = self.dac_obj.run_sudo_command_remote(command, vm_ip)
-			if not status:
-				# In case, log this for debuggging
-				self.__log(DEBUG, status_string)
+			if self.__qmp_shutdown(this_vm_uuid):
+				self.__log(DEBUG, "VM {uuid} shut down through QMP".format(uuid = this_vm_uuid))
+			else:
+				# VMs started without a QMP socket
+				command = "shutdown -h now"
+				# if self.dau_obj.ping_check(1, vm_ip):
+				status, status_string = self.dac_obj.run_sudo_command_remote(command, vm_ip)
+				if not status:
+					# In case, log this for debuggging
+					self.__log(DEBUG, status_string)
+			self.dac_obj.drop_remote_connection(vm_ip)
 			'''
 			else:
 				self.__log(INFO, "Ping failed. Attempting to shutdown through pipe console")
@@ -483,22 +578,22 @@ class da_vm_class:
 					self.__log(DEBUG, status_string)
 			'''
 
-			self.__remove_vm_details(this_vm_uuid)
-
-		if not self.dau_obj.save_vm_details_to_json(self.vm_dict_cur):
-			self.__log(ERROR, "save_vm_details_to_json failed: ")
+		if not self.dau_obj.remove_vm_details(vm_uuids):
+			self.__log(ERROR, "remove_vm_details failed: ")
 			return False
 
 		self.__log(INFO, "Done!")
 		return True
 
-	def reboot_vm(self, vm_ip, username, password, host_password):
+	def reboot_vm(self, vm_ip, username, password, host_password, vm_dict=None):
 		self.username = username
 		self.password = password
 
 		self.dac_obj.set_param(username, password, host_password)
 
-		self.vm_dict_cur = self.dau_obj.read_and_update_vm_dict()
+		if vm_dict is None:
+			vm_dict = self.dau_obj.read_and_update_vm_dict()
+		self.vm_dict_cur = vm_dict
 		if self.vm_dict_cur is False:
 			self.__log(ERROR, "read_and_update_vm_dict() failed: ", self.vm_dict_cur)
 			return False
@@ -528,20 +623,15 @@ class da_vm_class:
 
 			self.shared_9p_tag = this_vm_detail["shared_9p_tag"]
 
-			self.__log(INFO, "Getting MAC of all network devices for VM with IP {ip}".format(ip = vm_ip))
-
-			command = "reboot"
-			#if self.dau_obj.ping_check(1, vm_ip):
-			all_macs = self.dag_obj.get_mac_of_all_interfaces(vm_ip)
-			if not all_macs:
-				self.__log(ERROR, "get_mac_of_all_interfaces() Failed")
-				return False
+			# The macs were picked by us when the VM was started, no need to ask the VM
+			all_macs = this_vm_detail["macs"]
+			reserved = this_vm_detail.get("addressing") == "reserved"
 
 			self.__log(INFO, "Rebooting VM with ip {ip}".format(ip = vm_ip))
-			status, status_string = self.dac_obj.run_sudo_command_remote(command, vm_ip)
-			if not status:
-				# In case, log this for debuggging
-				self.__log(DEBUG, status_string)
+			if not self.__guest_reboot(this_vm_uuid, vm_ip):
+				self.__log(ERROR, "VM with ip {ip} did not go down for the reboot".format(ip = vm_ip))
+				return False
+			self.dac_obj.drop_remote_connection(vm_ip)
 			'''
 			else:
 				# Networking seems to be down. Try reboot through pipe console
@@ -554,18 +644,16 @@ class da_vm_class:
 					self.__log(DEBUG, status_string)
 			'''
 
-			# Breathe
-			time.sleep(5)
-
-			list_of_ips = []
-
-			self.__log(INFO, "Attempting to get all the IPs of the VM through mac addrs")
-			for my_mac_addr in all_macs:
-				my_ip = self.dag_obj.get_ip_from_mac(my_mac_addr)
-				if my_ip is None:
+			if reserved:
+				# The VM gets its reserved IPs back, nothing to look up
+				list_of_ips = this_vm_detail["ips"]
+			else:
+				self.__log(INFO, "Attempting to get all the IPs of the VM through mac addrs")
+				found_ips = self.dag_obj.get_ips_from_macs(all_macs)
+				if len(found_ips) != len(all_macs):
 					self.__log(ERROR, "Cannot find IP of the launched VM.")
 					return False
-				list_of_ips.append(my_ip)
+				list_of_ips = [found_ips[my_mac_addr] for my_mac_addr in all_macs]
 
 			'''
 			if not self.__login_to_vm_pipe(this_uuid):